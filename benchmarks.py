@@ -0,0 +1,323 @@
+'''
+Benchmarks of the pipeline's slowest steps, run from the repository root
+once the database is built, e.g.
+
+    python3 benchmarks.py clean
+
+Benchmarks of the web interface run from ui/, like the web app.
+'''
+import argparse
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+
+import reopening_guide
+import scenarios
+import substring_index
+
+UI_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "ui")
+# Filters of the map and table the web interface benchmarks draw, as passed
+# by the web form and as applied by create_map
+MAP_ARGS = {"city": "CHICAGO", "month": "10", "grade_level": "HIGH SCHOOL"}
+MAP_FILTERS = {"City": "CHICAGO", "Month": 10,
+               "Grade_Level_Cat": "HIGH SCHOOL"}
+
+
+def in_ui(benchmark):
+    '''
+    Wraps a benchmark of the web interface to run from ui/, where its modules
+    and relative paths resolve as in the web app
+    '''
+    def run():
+        cwd = os.getcwd()
+        if UI_DIR not in sys.path:
+            sys.path.append(UI_DIR)
+        os.chdir(UI_DIR)
+        try:
+            return benchmark()
+        finally:
+            os.chdir(cwd)
+    return run
+
+
+def benchmark_clean_data(scales=(1, 10, 100), data=None):
+    '''
+    Times clean_data on the LA data repeated at each scale
+
+    Inputs:
+        scales (tuple): multiples of the LA row count to time
+        data (Pandas DataFrame): uncleaned data to repeat, defaults to LA
+            from the database
+    Returns: (dict) seconds taken at each scale
+    '''
+    if data is None:
+        data = reopening_guide.collect_requests()[0]
+    timings = {}
+    for scale in scales:
+        scaled = pd.concat([data] * scale, ignore_index=True)
+        start = time.perf_counter()
+        reopening_guide.clean_data(scaled)
+        timings[scale] = time.perf_counter() - start
+        print(f"clean_data {scale}x ({len(scaled)} rows): "
+              f"{timings[scale]:.3f}s")
+    return timings
+
+
+def benchmark_scenarios(n_scenarios=5000, data=None, seed=0):
+    '''
+    Times a sweep of random scenarios
+
+    Inputs:
+        n_scenarios (int): number of scenarios to evaluate
+        data (tuple): tuple of dataframes, defaults to the three cities in
+            the database
+        seed (int): random seed
+    Returns: (float) scenarios evaluated per second
+    '''
+    if data is None:
+        data = reopening_guide.collect_requests()
+    rng = np.random.default_rng(seed)
+    sweep = [{"covid_low": rng.integers(5, 15),
+              "covid_moderate_from": rng.integers(5, 15),
+              "covid_moderate": rng.integers(30, 70),
+              "covid_substantial": rng.integers(80, 150),
+              "broadband_low": rng.uniform(.6, .85),
+              "broadband_high": rng.uniform(.85, .95),
+              "attendance_low": rng.uniform(.1, .4),
+              "attendance_high": rng.uniform(.6, .9),
+              "covid_weight": rng.integers(1, 4)}
+             for _ in range(n_scenarios)]
+    start = time.perf_counter()
+    scenarios.evaluate_scenarios(sweep, data)
+    rate = n_scenarios / (time.perf_counter() - start)
+    print(f"{n_scenarios} scenarios at {rate:,.0f} scenarios/sec")
+    return rate
+
+
+def benchmark_viz(args_to_ui=MAP_ARGS, repeat=3, fig_file=None):
+    '''
+    Times create_map.create_viz with the base layer drawn from scratch, then
+    loaded from BASE_LAYER_DIR, then from memory
+
+    Inputs:
+        args_to_ui (dict): filters of the map to draw
+        repeat (int): number of maps drawn with the base layer in memory
+        fig_file (str): path to save the maps to, defaults to a temporary
+            file
+    Returns: (dict) seconds taken per map in each case
+    '''
+    import create_map
+    if fig_file is None:
+        with tempfile.TemporaryDirectory() as directory:
+            return benchmark_viz(args_to_ui, repeat,
+                                 os.path.join(directory, "map.png"))
+    timings = {}
+    version = create_map.map_version()
+    for case in ("drawn", "disk", "memory"):
+        create_map.load_base_canvas.cache_clear()
+        if case == "drawn":
+            prefix = os.path.join(create_map.BASE_LAYER_DIR, "{}_{}_{}".format(
+                create_map.CITIES_MAP[args_to_ui["city"]]["abbr"],
+                int(args_to_ui["month"]), version))
+            for layer_file in (prefix + ".png", prefix + ".json"):
+                if os.path.exists(layer_file):
+                    os.remove(layer_file)
+        runs = repeat if case == "memory" else 1
+        if case == "memory":
+            create_map.create_viz(args_to_ui, fig_file)
+        start = time.perf_counter()
+        for _ in range(runs):
+            create_map.create_viz(args_to_ui, fig_file)
+        timings[case] = (time.perf_counter() - start) / runs
+        print(f"create_viz, base layer {case}: {timings[case]:.3f}s")
+    return timings
+
+
+def benchmark_filter(filters=MAP_FILTERS, repeat=1000):
+    '''
+    Times loading the categorized schools for the map and filtering them
+    once loaded
+
+    Inputs:
+        filters (dict): filters to apply, as built by create_map.get_schools
+        repeat (int): number of times to filter
+    Returns: (dict) seconds to load, seconds per filter and bytes held
+    '''
+    import create_map
+    create_map.load_categorized.cache_clear()
+    start = time.perf_counter()
+    cat_df, _ = create_map.get_categorized()
+    load = time.perf_counter() - start
+    start = time.perf_counter()
+    for _ in range(repeat):
+        create_map.filter_categorized(filters)
+    per_filter = (time.perf_counter() - start) / repeat
+    memory = int(cat_df.memory_usage(deep=True).sum())
+    print(f"load {load:.3f}s, filter {per_filter * 1000:.3f}ms, "
+          f"{memory / 2 ** 20:.1f}MB for {len(cat_df)} rows")
+    return {"load": load, "filter": per_filter, "bytes": memory}
+
+
+def benchmark_search(database="school_access.sqlite3",
+                     texts=("SCHOOL", "ELEMENTARY", "HYDE", "MS"), repeat=100):
+    '''
+    Times finding the categorized_schools rows whose name contains each text
+    through a leading-wildcard LIKE, the FTS5 table and the in-memory index
+
+    Inputs:
+        database (str): path of the database
+        texts (tuple): searches to time
+        repeat (int): number of times to run each search
+    Returns: (dict) seconds per search for each text and method
+    '''
+    connection = sqlite3.connect(database)
+    rows_query = ("SELECT COUNT(*) FROM " + substring_index.CATEGORIZED_TABLE +
+                  " WHERE Name IN (SELECT value FROM temp.matches)")
+    connection.execute("CREATE TEMP TABLE matches (value TEXT PRIMARY KEY)")
+
+    def matched_rows(search, text):
+        connection.execute("DELETE FROM temp.matches")
+        connection.executemany("INSERT OR IGNORE INTO temp.matches "
+                               "VALUES (?)",
+                               [(value,) for value in search.search(
+                                   "Name", text, connection)])
+        return connection.execute(rows_query).fetchone()[0]
+
+    searches = {"fts5": substring_index.NameSearch(database),
+                "memory": substring_index.NameSearch(database, use_fts=False)}
+    if not searches["fts5"].fts:
+        print(f"No {substring_index.SEARCH_TABLE} table, skipping fts5")
+        del searches["fts5"]
+
+    timings = {}
+    for text in texts:
+        start = time.perf_counter()
+        for _ in range(repeat):
+            count = connection.execute(
+                "SELECT COUNT(*) FROM " + substring_index.CATEGORIZED_TABLE +
+                " WHERE Name LIKE upper('%'||?||'%')", (text,)).fetchone()[0]
+        timings[(text, "like")] = (time.perf_counter() - start) / repeat
+        for method, search in searches.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                matched = matched_rows(search, text)
+            timings[(text, method)] = (time.perf_counter() - start) / repeat
+            if matched != count:
+                print(f"{method} matched {matched} rows for {text!r}, "
+                      f"LIKE matched {count}")
+        print(f"{text!r} ({count} rows): " + ", ".join(
+            f"{method} {timings[(text, method)] * 1000:.2f}ms"
+            for method in ["like"] + list(searches)))
+    connection.close()
+    return timings
+
+
+def benchmark_queries(repeat=20):
+    '''
+    Runs query_schools' results query for every combination of the form's
+    city, month and grade level filters with each sort, reporting its
+    latency and whether its plan reads the whole of categorized_schools.
+    The filter values are those of the largest city, month and grade level.
+
+    Inputs:
+        repeat (int): number of times to run each query
+    Returns: (dict) mapping each (filters, sort) to its seconds per query
+        and the full scans in its plan
+    '''
+    import query_schools
+    connection = sqlite3.connect(query_schools.DATABASE_FILENAME)
+    c = connection.cursor()
+    city, month, grade = c.execute(
+        "SELECT City, Month, Grade_Level_Cat FROM categorized_schools "
+        "GROUP BY City, Month, Grade_Level_Cat "
+        "ORDER BY COUNT(*) DESC LIMIT 1").fetchone()
+    values = {"city": city, "month": str(month), "grade_level": grade}
+
+    results = {}
+    for n in range(len(query_schools.FORM_FILTERS) + 1):
+        for filters in combinations(query_schools.FORM_FILTERS, n):
+            for sort_by in [None] + list(query_schools.SORT_COLUMNS):
+                args_from_ui = {key: values[key] for key in filters}
+                if sort_by is not None:
+                    args_from_ui["sort_by"] = sort_by
+                s, args = query_schools.build_query(args_from_ui, c)
+                plan = [row[3] for row in
+                        c.execute("EXPLAIN QUERY PLAN " + s, args)]
+                # A search through an index reads only the matching rows
+                scans = [step for step in plan
+                         if re.match(r"SCAN (?:TABLE )?(?:s|categorized)",
+                                     step)]
+                start = time.perf_counter()
+                for _ in range(repeat):
+                    rows = len(c.execute(s, args).fetchall())
+                seconds = (time.perf_counter() - start) / repeat
+                results[(filters, sort_by)] = {"seconds": seconds,
+                                               "scans": scans}
+                print(f"{'+'.join(filters) or '(none)':<24} "
+                      f"{sort_by or '':<24} {seconds * 1000:8.2f}ms "
+                      f"{rows:7d} rows  {'; '.join(plan)}")
+    connection.close()
+
+    scanned = [key for key, result in results.items()
+               if result["scans"] and key[0]]
+    print(f"{len(results)} queries, {len(scanned)} filtered queries with a "
+          f"full scan")
+    return results
+
+
+# Each benchmark with its description
+BENCHMARKS = {
+    "clean": (benchmark_clean_data,
+              "reopening_guide.clean_data on the LA data at 1x, 10x and "
+              "100x its size"),
+    "scenarios": (benchmark_scenarios,
+                  "scenarios.evaluate_scenarios on 5000 random scenarios"),
+    "viz": (in_ui(benchmark_viz),
+            "create_map.create_viz with its base layer drawn, on disk and in "
+            "memory"),
+    "filter": (in_ui(benchmark_filter),
+               "create_map.get_categorized, then 1000 filters of the loaded "
+               "schools"),
+    "search": (benchmark_search,
+               "school name searches through LIKE, the FTS5 table and the "
+               "in-memory index"),
+    "queries": (in_ui(benchmark_queries),
+                "the results table query of every combination of the form's "
+                "filters and sorts"),
+}
+
+
+def parse_args(args):
+    '''
+    Parses the command line
+
+    Inputs: args (lst): command line arguments, without the program name
+    Returns: argparse Namespace
+    '''
+    parser = argparse.ArgumentParser(
+        description="Time the pipeline's slowest steps.",
+        epilog="benchmarks: " + "; ".join(
+            f"{name}: {description}"
+            for name, (_, description) in BENCHMARKS.items()))
+    parser.add_argument("benchmarks", nargs="+", choices=list(BENCHMARKS),
+                        metavar="BENCHMARK", help="benchmarks to run")
+    return parser.parse_args(args)
+
+
+def main():
+    '''
+    Runs the benchmarks named on the command line
+    '''
+    for name in parse_args(sys.argv[1:]).benchmarks:
+        BENCHMARKS[name][0]()
+
+
+if __name__ == "__main__":
+    main()
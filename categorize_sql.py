@@ -0,0 +1,222 @@
+'''
+SQL engine for the reopening guide
+
+Generates one SQL statement per city that does everything clean_data and
+categorize_vectorized do in reopening_guide: upper-casing, grade level
+mapping, attendance rescaling, covid and broadband categories, attendance
+quartiles (with window functions, interpolated the same way as pandas) and
+the suggestion vote. The categorized rows are inserted straight into
+categorized_schools, so no city's data is ever loaded into pandas.
+'''
+import sqlite3
+import reopening_guide as rg
+from create_table import create_indexes, register_functions
+
+
+def case_lookup(expression, values, labels=False):
+    '''
+    Builds a CASE expression mapping the values of an expression
+
+    Inputs:
+        expression (str): SQL expression to map
+        values (dict): mapping of each expression value to its result
+        labels (bool): True if the results are strings to quote
+    Returns: (str) SQL CASE expression, NULL for unmapped values
+    '''
+    whens = []
+    for key, value in values.items():
+        if isinstance(key, str):
+            key = "'" + key.replace("'", "''") + "'"
+        if labels:
+            value = "'" + value.replace("'", "''") + "'"
+        whens.append(f"WHEN {key} THEN {value}")
+    return f"CASE {expression} " + " ".join(whens) + " END"
+
+
+def table_lookup(table, category, grade):
+    '''
+    Builds a CASE expression looking up one of reopening_guide's rule tables
+
+    Inputs:
+        table (numpy array): action code for each [category, grade]
+        category (str): SQL expression for the category code
+        grade (str): SQL expression for the grade code
+    Returns: (str) SQL CASE expression giving the action code
+    '''
+    n_grades = table.shape[1]
+    values = {i * n_grades + j: int(table[i, j])
+              for i in range(table.shape[0]) for j in range(n_grades)}
+    return case_lookup(f"({category}) * {n_grades} + ({grade})", values)
+
+
+def vote_sql(votes):
+    '''
+    Builds the SQL for reopening_guide.vote: the most common action, ties
+    going to the action that appears first
+
+    Inputs: votes (lst): SQL expressions for each vote's action code
+    Returns: (str) SQL expression giving the winning action code
+    '''
+    n_votes = len(votes)
+    scores = []
+    for action in range(len(rg.ACTIONS)):
+        count = " + ".join(f"({vote} = {action})" for vote in votes)
+        first = "CASE " + " ".join(f"WHEN {vote} = {action} THEN {i}"
+                                   for i, vote in enumerate(votes)) + \
+                f" ELSE {n_votes} END"
+        scores.append(f"(({count}) * {n_votes + 1} - ({first}))")
+    whens = []
+    for action in range(len(rg.ACTIONS) - 1):
+        beats = " AND ".join(f"{scores[action]} > {scores[other]}"
+                             for other in range(action + 1, len(rg.ACTIONS)))
+        whens.append(f"WHEN {beats} THEN {action}")
+    return "CASE " + " ".join(whens) + f" ELSE {len(rg.ACTIONS) - 1} END"
+
+
+def city_sql(connection, city):
+    '''
+    Generates the statement that cleans and categorizes one city, and
+    registers the Python functions it calls on the connection
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection, used to
+            find the columns the city query returns
+        city (str): key of reopening_guide.CITY_QUERIES
+    Returns: (str) SELECT statement giving the CATEGORIZED_COLS columns
+    '''
+    register_functions(connection)
+    query = rg.CITY_QUERIES[city].strip().rstrip(";")
+    columns = [col[0] for col in connection.execute(
+        "SELECT * FROM (" + query + ") LIMIT 0").description]
+    if "Year" in columns:
+        year = "Year"
+    else:
+        year = "CASE WHEN Month < 4 THEN 2021 ELSE 2020 END"
+    grade_level_cat = case_lookup("py_upper(Grade_Level)", rg.GL_DICT, True)
+    grade = case_lookup("Grade_Level_Cat",
+                        {label: i for i, label in enumerate(rg.GRADES)})
+    covid = '''CASE WHEN Covid_Rates >= 0 AND Covid_Rates <= 9 THEN 0
+               WHEN Covid_Rates > 10 AND Covid_Rates <= 49 THEN 1
+               WHEN Covid_Rates > 49 AND Covid_Rates <= 99 THEN 2
+               ELSE 3 END'''
+    broadband = '''CASE WHEN Percent_Broadband <= .8 THEN 0
+                   WHEN Percent_Broadband > .8 AND Percent_Broadband < .9
+                   THEN 1 ELSE 2 END'''
+    attendance = '''CASE WHEN Attendance < q25 THEN 0
+                    WHEN Attendance <= q75 THEN 1 ELSE 2 END'''
+    votes = ["covid_vote", "covid_vote", "broadband_vote", "grade_vote",
+             "attendance_vote"]
+
+    return f'''
+        WITH base AS ({query}),
+        cleaned AS (
+            SELECT py_upper(Name) AS Name,
+            py_upper(Grade_Level) AS Grade_Level,
+            py_upper(Community) AS Community,
+            CAST(Percent_Broadband AS REAL) AS Percent_Broadband,
+            CAST(Covid_Rates AS REAL) AS Covid_Rates,
+            CAST(Attendance AS REAL) AS Attendance, {year} AS Year, Month,
+            {grade_level_cat} AS Grade_Level_Cat
+            FROM base),
+        limits AS (
+            SELECT MIN(Attendance) AS low, MAX(Attendance) AS high
+            FROM cleaned),
+        rescaled AS (
+            SELECT c.Name, c.Grade_Level, c.Community, c.Percent_Broadband,
+            c.Covid_Rates, CASE WHEN l.low < 0
+            THEN .5 * (c.Attendance - l.low) / (l.high - l.low) + .5
+            ELSE c.Attendance END AS Attendance, c.Year, c.Month,
+            c.Grade_Level_Cat
+            FROM cleaned AS c, limits AS l),
+        ranked AS (
+            SELECT Attendance, ROW_NUMBER() OVER (ORDER BY Attendance) - 1
+            AS pos
+            FROM rescaled WHERE Attendance IS NOT NULL),
+        positions AS (
+            SELECT (COUNT(*) - 1) * .25 AS h25, (COUNT(*) - 1) * .75 AS h75,
+            COUNT(*) - 1 AS last
+            FROM ranked),
+        bounds AS (
+            SELECT p.h25, p.h75,
+            MAX(CASE WHEN r.pos = CAST(p.h25 AS INTEGER)
+                THEN r.Attendance END) AS lo25,
+            MAX(CASE WHEN r.pos = MIN(CAST(p.h25 AS INTEGER) + 1, p.last)
+                THEN r.Attendance END) AS hi25,
+            MAX(CASE WHEN r.pos = CAST(p.h75 AS INTEGER)
+                THEN r.Attendance END) AS lo75,
+            MAX(CASE WHEN r.pos = MIN(CAST(p.h75 AS INTEGER) + 1, p.last)
+                THEN r.Attendance END) AS hi75
+            FROM ranked AS r, positions AS p),
+        cuts AS (
+            SELECT lo25 + (hi25 - lo25) * (h25 - CAST(h25 AS INTEGER))
+            AS q25, lo75 + (hi75 - lo75) * (h75 - CAST(h75 AS INTEGER))
+            AS q75,
+            (SELECT AVG(Attendance) FROM rescaled) AS mean
+            FROM bounds),
+        coded AS (
+            SELECT r.*, {covid} AS covid_code, {broadband} AS broadband_code,
+            {attendance} AS attendance_code, {grade} AS grade_code,
+            cuts.mean
+            FROM rescaled AS r, cuts),
+        voted AS (
+            SELECT *,
+            {table_lookup(rg.COVID_TABLE, "covid_code", "grade_code")}
+            AS covid_vote,
+            {table_lookup(rg.BROADBAND_TABLE, "broadband_code", "grade_code")}
+            AS broadband_vote,
+            {case_lookup("grade_code", dict(enumerate(
+                int(action) for action in rg.GRADE_TABLE)))} AS grade_vote,
+            {table_lookup(rg.ATTENDANCE_TABLE, "attendance_code",
+                          "grade_code")} AS attendance_vote
+            FROM coded)
+        SELECT Name, Grade_Level, Community, Percent_Broadband, Covid_Rates,
+        CASE WHEN mean >= 1 THEN Attendance / 100 ELSE Attendance END
+        AS Attendance, Year, Month, '{city}' AS City, Grade_Level_Cat,
+        {case_lookup("covid_code", dict(enumerate(rg.COVID_CATS)), True)}
+        AS Covid_Rates_Cat,
+        {case_lookup("attendance_code", dict(enumerate(rg.LEVEL_CATS)),
+                     True)} AS Attendance_Cat,
+        {case_lookup(vote_sql(votes), dict(enumerate(rg.ACTIONS)), True)}
+        AS Suggested_Action
+        FROM voted'''
+
+
+def go(connection=None):
+    '''
+    Creates the categorized_schools table with one INSERT ... SELECT per
+    city, without loading the data into pandas
+
+    Inputs:
+        connection (sqlite3 Connection): open connection inside a
+            transaction managed by the caller. If None, school_access.sqlite3
+            is updated in a transaction of its own.
+    Returns: (dict) number of rows written
+    '''
+    own_connection = connection is None
+    if own_connection:
+        connection = sqlite3.connect("school_access.sqlite3")
+        connection.execute("BEGIN")
+    try:
+        rg.create_categorized_table(connection)
+        rows = 0
+        for city in rg.CITY_QUERIES:
+            c = connection.execute("INSERT INTO " + rg.CATEGORIZED_TABLE +
+                                   " (" + ", ".join(rg.CATEGORIZED_COLS) +
+                                   ") " + city_sql(connection, city))
+            rows += c.rowcount
+        create_indexes(connection, rg.CATEGORIZED_TABLE,
+                       rg.CATEGORIZED_INDEXES)
+        if own_connection:
+            connection.commit()
+    except Exception:
+        if own_connection:
+            connection.rollback()
+        raise
+    finally:
+        if own_connection:
+            connection.close()
+    return {"rows_read": rows, "rows_written": rows}
+
+
+if __name__ == "__main__":
+    go()
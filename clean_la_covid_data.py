@@ -16,8 +16,7 @@ URL1 = "https://raw.githubusercontent.com/datadesk/california-coronavirus" + \
 URL2 = "https://raw.githubusercontent.com/datadesk/california-coronavirus" + \
        "-data/master/latimes-place-polygons.geojson"
 
-LA_BROADBAND = pd.read_csv("data/la_broadband.csv") \
-                        .loc[:,['Name','geometry']]
+LA_BROADBAND = "data/la_broadband.csv"
 COL_DROP = ["fips_x", "fips_y", "id_x", "id_y", "county_y", "note", "geometry",
             "centroid_x", "centroid_y", "index_right", "population_y"]
 
@@ -42,7 +41,8 @@ def grab_csv(url):
 def merge_data(df):
     geo = geopandas.read_file(URL2)
     df_w_geo = geo.merge(df, on="name")
-    df_bb = geopandas.GeoDataFrame(LA_BROADBAND)
+    df_bb = geopandas.GeoDataFrame(pd.read_csv(LA_BROADBAND) \
+                                     .loc[:,['Name','geometry']])
     df_bb["geometry"] = df_bb["geometry"].apply(wkt.loads)
     df_bb.crs = "EPSG:4326"
     final_df = geopandas.sjoin(df_w_geo, df_bb)
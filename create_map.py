@@ -12,35 +12,64 @@ https://matplotlib.org/stable/tutorials/colors/colormaps.html
 https://www.tutorialspoint.com/How-to-use-variables-in-Python-regular-expression
 https://www.tutorialspoint.com/apply-uppercase-to-a-column-in-pandas-dataframe-in-python
 https://www.geeksforgeeks.org/how-to-change-the-font-size-of-the-title-in-a-matplotlib-figure/
+
+The covid choropleth depends only on the city and month, so it is drawn once
+per (city, month) and database build as a base layer: a PNG plus the
+position and limits of its map axes. Each process keeps a figure with the
+base layer drawn in it and its pixels saved, so that a map only restores
+those pixels and draws the filtered school points onto them.
+
+School and area geometries are read from the geometry store, which the build
+writes as WKB once the data is collected, and are kept in memory by each
+process until the store is rebuilt. The categorized schools are likewise kept
+in memory until the database is rebuilt, with categorical columns and the row
+positions of each city, month and grade level, so that filtering a map's
+schools does not depend on the size of the table. School and community
+searches go through the same substring index as the results table.
 """
 
+import numpy as np
 import pandas as pd
-from shapely import wkt
+from shapely import wkb, wkt
 import geopandas as gpd
 import matplotlib.pyplot as plt
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
 from mpl_toolkits.axes_grid1 import make_axes_locatable
+from PIL import Image
+from functools import lru_cache
 import reopening_guide
+import substring_index
+import glob
+import json
 import re
 import os
+import sqlite3
 
 CITIES_MAP = {
             'CHICAGO': {
                 'viz_var': 'Avg_Monthly_Case_Rate',
                 'title': 'Chicago Schools and Covid Rates, ',
                 'legend': 'Avg Monthly Covid Rates per 100k',
-                'abbr': 'chi'
+                'abbr': 'chi',
+                'schools': 'chicago_schools',
+                'areas': 'chicago_zips'
             },
             'NEW YORK CITY':{
                 'viz_var': 'case_rate_100k',
                 'title': 'New York City Schools and Covid Rates, ',
                 'legend': 'Covid Case Rate per 100k',
-                'abbr': 'nyc'
+                'abbr': 'nyc',
+                'schools': 'nyc_schools',
+                'areas': 'nyc_modzcta'
             },
             'LOS ANGELES':{
                 'viz_var': 'Covid_Rates',
                 'title': 'Los Angeles Schools and Covid Rates, ',
                 'legend': 'Covid Case Rate per 100k',
-                'abbr': 'la'
+                'abbr': 'la',
+                'schools': 'la_schools',
+                'areas': 'la_areas'
             }
             }
 
@@ -49,7 +78,198 @@ COL_DICT = {'neighborhood': 'Community',
             'grade_level': 'Grade_Level_Cat',
             'city': 'City'}
 
-FIG_FILE = 'static/school_map.png'
+FIG_SIZE = (20, 12)
+FIG_DPI = 300
+DATABASE_FILENAME = '../school_access.sqlite3'
+DATA_DIR = '../data/'
+GEOMETRY_STORE = '../geometry.sqlite3'
+BASE_LAYER_DIR = '../base_layers'
+# Base layer figures kept by each process (about 170MB each, for the
+# figure's pixels and the saved copy of the base layer)
+BASE_LAYER_MEMO = 1
+# Maps are cached once drawn, so favor encoding speed over file size
+PNG_COMPRESS_LEVEL = 1
+
+# Geometry layers of the geometry store: the source file of each, and its
+    # columns to keep, renamed
+GEOMETRY_LAYERS = {
+    'chicago_schools': ('chicago_schools_with_community.csv',
+                        {'long_name': 'school_name',
+                         'school_geometry': 'geometry'}),
+    'nyc_schools': ('nyc_schools.csv',
+                    {'location_n': 'school_name', 'geometry': 'geometry'}),
+    'la_schools': ('la_schools.csv',
+                   {'MPD_NAME': 'school_name', 'geometry': 'geometry'}),
+    'chicago_zips': ('Boundaries - ZIP Codes.geojson',
+                     {'zip': 'zip', 'geometry': 'geometry'}),
+    'nyc_modzcta': ('nyc_modzcta.csv',
+                    {'modzcta': 'modzcta', 'geometry': 'geometry'}),
+    'la_areas': ('la_broadband.csv', {'Name': 'Name', 'geometry': 'geometry'})
+}
+
+# Columns of categorized_schools the maps use, and those stored as categoricals
+CATEGORIZED_COLS = ['Name', 'Community', 'City', 'Month', 'Grade_Level_Cat',
+                    'Suggested_Action']
+CATEGORICAL_COLS = ['City', 'Grade_Level_Cat', 'Suggested_Action', 'Community']
+# Filters with precomputed row positions, most specific first
+INDEXED_FILTERS = [('City', 'Month', 'Grade_Level_Cat'), ('City', 'Month')]
+
+
+def read_geometry_source(layer, data_dir=DATA_DIR):
+    '''
+    Reads a geometry layer from its source file, parsing its geometries
+
+    Inputs:
+        layer (str): key of GEOMETRY_LAYERS
+        data_dir (str): directory of the source files
+    Returns (gdf): the layer's columns, with school names upper-cased
+    '''
+    filename, columns = GEOMETRY_LAYERS[layer]
+    if filename.endswith('.geojson'):
+        df = gpd.read_file(data_dir + filename)
+    else:
+        df = pd.read_csv(data_dir + filename)
+    df = df.loc[:, list(columns)].rename(columns=columns)
+    if not filename.endswith('.geojson'):
+        df['geometry'] = df['geometry'].apply(wkt.loads)
+    if 'school_name' in df:
+        df['school_name'] = df['school_name'].str.upper()
+    return gpd.GeoDataFrame(df)
+
+
+def build_geometry_store(data_dir=DATA_DIR, store=GEOMETRY_STORE):
+    '''
+    Writes every geometry layer with a source file into the geometry store,
+    one table per layer with its geometries as WKB. The store is written to
+    a temporary file and swapped in, so web processes never read a partial
+    store.
+
+    Inputs:
+        data_dir (str): directory of the source files
+        store (str): path of the geometry store
+    Returns (dict): rows written and the layers stored
+    '''
+    temp_store = '{}.{}.tmp'.format(store, os.getpid())
+    connection = sqlite3.connect(temp_store)
+    layers = []
+    rows = 0
+    for layer, (filename, _) in GEOMETRY_LAYERS.items():
+        if not os.path.exists(data_dir + filename):
+            print('No {}, {} is not stored'.format(filename, layer))
+            continue
+        gdf = read_geometry_source(layer, data_dir)
+        df = pd.DataFrame(gdf.drop(columns='geometry'))
+        df['geometry'] = gdf['geometry'].apply(lambda geom: geom.wkb)
+        df.to_sql(layer, connection, index=False)
+        layers.append(layer)
+        rows += len(df)
+    connection.commit()
+    connection.close()
+    os.replace(temp_store, store)
+    return {'rows_written': rows, 'layers': layers}
+
+
+@lru_cache(maxsize=len(GEOMETRY_LAYERS))
+def load_geometry(layer, version):
+    '''
+    Loads a geometry layer from the geometry store, or from its source file
+    if the store does not have it. The result is kept for the life of the
+    process, so it must not be modified.
+
+    Inputs:
+        layer (str): key of GEOMETRY_LAYERS
+        version (str): build of the geometry store, from file_version
+    Returns (gdf): the layer, as from read_geometry_source
+    '''
+    if version != 'none':
+        connection = sqlite3.connect(GEOMETRY_STORE)
+        stored = connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+            (layer,)).fetchone()
+        if stored:
+            df = pd.read_sql_query('SELECT * FROM ' + layer, connection)
+        connection.close()
+        if stored:
+            df['geometry'] = df['geometry'].apply(wkb.loads)
+            return gpd.GeoDataFrame(df)
+    return read_geometry_source(layer)
+
+
+def get_geometry(layer):
+    '''
+    Returns (gdf) a geometry layer from the current geometry store, see
+        load_geometry
+    '''
+    return load_geometry(layer, file_version(GEOMETRY_STORE))
+
+
+@lru_cache(maxsize=1)
+def load_categorized(version):
+    '''
+    Loads the categorized schools of a database build, with CATEGORICAL_COLS
+    as categoricals and Month as a small integer, and the row positions of
+    every combination of values of each of INDEXED_FILTERS. Only the latest
+    build is kept, for the life of the process, so neither may be modified.
+
+    Inputs:
+        version (str): database build, from data_version
+    Returns (tuple): the categorized schools DataFrame, and a dict mapping
+        each of INDEXED_FILTERS to a dict of value tuples to row positions
+    '''
+    connection = sqlite3.connect(DATABASE_FILENAME)
+    cat_df = pd.read_sql_query('SELECT ' + ', '.join(CATEGORIZED_COLS) +
+                               ' FROM ' + reopening_guide.CATEGORIZED_TABLE,
+                               connection)
+    connection.close()
+    # Every map has a month, so rows without one are never shown
+    cat_df = cat_df[cat_df['Month'].notna()].reset_index(drop=True)
+    cat_df = cat_df.astype({col: 'category' for col in CATEGORICAL_COLS})
+    cat_df['Month'] = cat_df['Month'].astype('int8')
+
+    indexes = {}
+    for cols in INDEXED_FILTERS:
+        indexes[cols] = cat_df.groupby(list(cols), observed=True).indices
+    return cat_df, indexes
+
+
+def get_categorized():
+    '''
+    Returns (tuple) the categorized schools of the current database build
+        and their row positions, see load_categorized
+    '''
+    return load_categorized(data_version())
+
+
+def filter_categorized(filters):
+    '''
+    Filters the categorized schools, looking the rows of the city, month and
+    grade level up in the precomputed indexes, and the names containing the
+    school or community search through substring_index
+
+    Inputs:
+        filters (dict): maps columns of categorized_schools to the value to
+            keep, or for Community and Name to part of the value
+    Returns (DataFrame): the matching categorized schools
+    '''
+    cat_df, indexes = get_categorized()
+    search = substring_index.load_search(DATABASE_FILENAME, data_version())
+    for cols in INDEXED_FILTERS:
+        if all(col in filters for col in cols):
+            key = tuple(filters[col] for col in cols)
+            rows = indexes[cols].get(key if len(key) > 1 else key[0], [])
+            cat_df = cat_df.take(rows)
+            break
+    else:
+        cols = ()
+
+    for col, val in filters.items():
+        if col in cols:
+            continue
+        if col in substring_index.TEXT_COLS:
+            cat_df = cat_df[cat_df[col].isin(search.search(col, val))]
+        else:
+            cat_df = cat_df[cat_df[col] == val]
+    return cat_df
 
 
 def get_schools(args_to_ui):
@@ -81,45 +301,19 @@ def get_schools(args_to_ui):
             else:
                 filters[COL_DICT[col]] = val.upper()
     
-    # Import categorized school table created by reopening_guide.py,
-        # filter by user inputs
-    cat_df = pd.read_csv('../data/categorized_schools.csv')
-    for col, val in filters.items():
-        if col in ['Community', 'Name']:
-            cat_df = cat_df[cat_df[col].str.extract( \
-                            pat='.*(' + val + ').*',expand=False) == val]
-        else:
-            cat_df = cat_df[cat_df[col] == val]
-
+    # Filter the categorized school table created by reopening_guide.py
+        # by user inputs
+    cat_df = filter_categorized(filters)
     cat_df_filt = cat_df.loc[:, ('Name','Suggested_Action')]
+    # Color by the actions on the map only, not every category of the table
+    cat_df_filt = cat_df_filt.astype({'Suggested_Action': object})
 
-    # Depending on the chosen city, import and format school data as df
-    if city == 'CHICAGO':
-        schools_df = pd.read_csv('../data/chicago_schools_with_community.csv')
-        schools_df.rename(columns={'school_geometry': 'geometry', 
-            'long_name': 'school_name'}, inplace=True)
-        schools_df = schools_df.loc[:,('school_name','geometry')]
-
-    if city == 'NEW YORK CITY':
-        schools_df = pd.read_csv('../data/nyc_schools.csv')
-        schools_df = schools_df.loc[:,('location_n','location_1','geometry')]
-        schools_df.rename(columns={'location_n': 'school_name', 
-            'location_1': 'school_type'}, inplace=True)
-
-    if city == 'LOS ANGELES':
-        schools_df = pd.read_csv('../data/la_schools.csv')
-        schools_df = schools_df.loc[:,('FULLNAME',
-                            'MPD_NAME', 'Neighborhood', 'geometry')]
-        schools_df.loc[:, 'school_name'] = schools_df['MPD_NAME']
-
-    # Merge school df with categorized df to filter and add categorizations,
-        # create schools_gdf to use in final map
-    schools_df['school_name'] = schools_df['school_name'].str.upper()
-    schools_df = schools_df.merge(cat_df_filt, 
+    # Merge the city's school locations with categorized df to filter and add
+        # categorizations, create schools_gdf to use in final map
+    schools_gdf = get_geometry(CITIES_MAP[city]['schools'])
+    schools_gdf = schools_gdf.merge(cat_df_filt,
                         left_on = "school_name", right_on = "Name")
-    schools_df = schools_df.drop('Name', axis=1)
-    schools_df['geometry'] = schools_df['geometry'].apply(wkt.loads)
-    schools_gdf = gpd.GeoDataFrame(schools_df)
+    schools_gdf = schools_gdf.drop('Name', axis=1)
 
     return schools_gdf
     
@@ -152,14 +346,13 @@ def get_covid_geo(args_to_ui):
         covid_df['ZIP'] = covid_df['ZIP'].astype('str')
         covid_df_mo = covid_df[covid_df['month'] == month]
        
-        zip_gdf = gpd.read_file('../data/Boundaries - ZIP Codes.geojson')
-        zip_gdf = zip_gdf.loc[:,('zip','geometry')]
-        
+        zip_gdf = get_geometry('chicago_zips')
+
         covid_gdf = covid_df_mo.merge(zip_gdf, left_on="ZIP", right_on="zip")
         covid_gdf = gpd.GeoDataFrame(covid_gdf)
     
     if city == 'NEW YORK CITY':
-        modzcta_df = pd.read_csv('../data/nyc_modzcta.csv')
+        modzcta_df = get_geometry('nyc_modzcta')
         modzcta_df = modzcta_df.astype({'modzcta': 'string'})
 
         covid_df = pd.read_csv('../data/nyc_covid.csv')
@@ -167,13 +360,11 @@ def get_covid_geo(args_to_ui):
         covid_df_mo = covid_df[covid_df.loc[:,'month'] == month]
 
         covid_gdf = modzcta_df.merge(covid_df_mo, left_on="modzcta", right_on="modzcta")
-        covid_gdf['geometry'] = covid_gdf['geometry'].apply(wkt.loads)
         covid_gdf = gpd.GeoDataFrame(covid_gdf)
 
     if city == "LOS ANGELES":
-        broadband_df = pd.read_csv('../data/la_broadband.csv')
-        broadband_df = broadband_df.loc[:,('Name','geometry')]
-        
+        broadband_df = get_geometry('la_areas')
+
         covid_df = pd.read_csv('../data/la_covid.csv')
         covid_df_mo = covid_df[covid_df.loc[:,'month'] == month]
         covid_df_mo = covid_df_mo.loc[:,('Community','Covid_Rates')]
@@ -181,17 +372,219 @@ def get_covid_geo(args_to_ui):
         covid_gdf = covid_df_mo.merge(broadband_df, 
                             left_on="Community", right_on="Name")
         covid_gdf = covid_gdf.drop('Name', axis=1)
-        covid_gdf['geometry'] = covid_gdf['geometry'].apply(wkt.loads)
         covid_gdf = gpd.GeoDataFrame(covid_gdf)
 
     return covid_gdf
 
 
-def create_viz(args_to_ui):
+def map_title(city, month):
+    '''
+    Title of the map of a city and month
+
+    Inputs:
+        city (str): city key of CITIES_MAP
+        month (int): month of the school year
+    Returns (str): the title
+    '''
+    if month >= 4:
+        year = 2020
+    else:
+        year = 2021
+    return CITIES_MAP[city]['title'] + str(month) + '/' + str(year)
+
+
+def file_version(path):
+    '''
+    Identifies the current build of a file that builds replace as a whole,
+    so that its modification time and size change with every build
+
+    Inputs:
+        path (str): path of the file
+    Returns (str): version string, or 'none' if there is no file
+    '''
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return 'none'
+    return '{}-{}'.format(stat.st_mtime_ns, stat.st_size)
+
+
+def data_version():
+    '''
+    Identifies the current database build
+
+    Returns (str): version string
+    '''
+    return file_version(DATABASE_FILENAME)
+
+
+def map_version():
+    '''
+    Identifies the current builds of the database and the geometry store,
+    which the base layers are drawn from
+
+    Returns (str): version string
+    '''
+    return data_version() + '_' + file_version(GEOMETRY_STORE)
+
+
+def render_base_layer(city, month):
+    '''
+    Draws the covid choropleth and title of a city and month
+
+    Inputs:
+        city (str): city key of CITIES_MAP
+        month (int): month of the school year
+
+    Returns (tuple): the drawn figure as an RGBA PIL Image, and a dict with
+        the position (in figure coordinates) and limits of the map axes
+    '''
+    covid_gdf = get_covid_geo({'city': city, 'month': month})
+    fig, ax = plt.subplots(figsize=FIG_SIZE, dpi=FIG_DPI)
+    covid_gdf.plot(column=CITIES_MAP[city]['viz_var'], cmap='RdYlBu_r',
+                   legend=True, ax=ax,
+                   legend_kwds={'label': CITIES_MAP[city]['legend'],
+                                'orientation': "vertical"})
+    ax.axis('off')
+    ax.set_title(map_title(city, month), fontsize=20)
+
+    fig.canvas.draw()
+    image = Image.frombuffer('RGBA', fig.canvas.get_width_height(),
+                             fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0, 1)
+    axes = {'position': list(ax.get_position().bounds),
+            'xlim': list(ax.get_xlim()), 'ylim': list(ax.get_ylim())}
+    image = image.copy()
+    plt.close(fig)
+    return image, axes
+
+
+def load_base_layer(city, month, version):
+    '''
+    Loads the base layer of a city and month for a database and geometry
+    store build from BASE_LAYER_DIR, drawing and saving it if it is not
+    there, and replacing any base layers of older builds
+
+    Inputs:
+        city (str): city key of CITIES_MAP
+        month (int): month of the school year
+        version (str): database and geometry store builds, from
+            map_version
+
+    Returns (tuple): RGBA PIL Image and dict of map axes, as from
+        render_base_layer
+    '''
+    prefix = os.path.join(BASE_LAYER_DIR, '{}_{}_'.format(
+        CITIES_MAP[city]['abbr'], month))
+    png_file = prefix + version + '.png'
+    axes_file = prefix + version + '.json'
+    if os.path.exists(png_file) and os.path.exists(axes_file):
+        with open(axes_file) as f:
+            axes = json.load(f)
+        with Image.open(png_file) as image:
+            return image.convert('RGBA'), axes
+
+    image, axes = render_base_layer(city, month)
+    os.makedirs(BASE_LAYER_DIR, exist_ok=True)
+    for old_file in glob.glob(glob.escape(prefix) + '*'):
+        if old_file not in (png_file, axes_file):
+            try:
+                os.remove(old_file)
+            except FileNotFoundError:
+                pass
+    temp = '.{}.tmp'.format(os.getpid())
+    image.save(png_file + temp, format='PNG',
+               compress_level=PNG_COMPRESS_LEVEL)
+    with open(axes_file + temp, 'w') as f:
+        json.dump(axes, f)
+    os.replace(axes_file + temp, axes_file)
+    os.replace(png_file + temp, png_file)
+    return image, axes
+
+
+class MapCanvas(FigureCanvasAgg):
+    '''
+    Agg canvas that only redraws when asked to. geopandas requests a redraw
+    of the whole figure after each plot, which would paint over the base
+    layer pixels the map is drawn onto.
+    '''
+    def draw_idle(self, *args, **kwargs):
+        pass
+
+
+@lru_cache(maxsize=BASE_LAYER_MEMO)
+def load_base_canvas(city, month, version):
+    '''
+    Sets up a figure for drawing maps of a city and month: the base layer is
+    drawn into it once and its pixels saved, and its map axes match the base
+    layer's. The figure is kept outside pyplot, so it lives as long as it is
+    memoized.
+
+    Inputs:
+        city (str): city key of CITIES_MAP
+        month (int): month of the school year
+        version (str): database and geometry store builds, from
+            map_version
+
+    Returns (tuple): the figure, its map axes and the saved base layer pixels
+    '''
+    image, axes = load_base_layer(city, month, version)
+    fig = Figure(figsize=FIG_SIZE, dpi=FIG_DPI)
+    canvas = MapCanvas(fig)
+    base = fig.figimage(np.asarray(image), origin='upper')
+    ax = fig.add_axes(axes['position'])
+    ax.axis('off')
+    ax.set_xlim(axes['xlim'])
+    ax.set_ylim(axes['ylim'])
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox)
+    base.remove()
+    return fig, ax, background
+
+
+def render_schools(schools_gdf, base_canvas):
+    '''
+    Draws the school points and their legend onto the base layer: the base
+    layer pixels are restored and only the new artists are drawn, after
+    which they are removed again so the figure can draw the next map
+
+    Inputs:
+        schools_gdf (gdf): schools to draw, from get_schools
+        base_canvas (tuple): figure, map axes and base layer pixels, from
+            load_base_canvas
+
+    Returns (Image): the map as an RGB PIL Image
+    '''
+    fig, ax, background = base_canvas
+    xlim = ax.get_xlim()
+    ylim = ax.get_ylim()
+    schools_gdf.plot(ax=ax, marker='o', column='Suggested_Action',
+                     cmap='jet', legend=True, markersize=7)
+    # Keep the base layer's view, whatever the points' extent
+    ax.set_aspect('auto')
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+    artists = list(ax.collections)
+    if ax.get_legend() is not None:
+        artists.append(ax.get_legend())
+    try:
+        fig.canvas.restore_region(background)
+        for artist in artists:
+            ax.draw_artist(artist)
+        image = Image.frombuffer('RGBA', fig.canvas.get_width_height(),
+                                 fig.canvas.buffer_rgba(), 'raw', 'RGBA', 0,
+                                 1).convert('RGB')
+    finally:
+        for artist in artists:
+            artist.remove()
+    return image
+
+
+def create_viz(args_to_ui, fig_file):
     '''
     Create map of covid rates by zip/neighborhood with schools identified
         by their suggested opening classification. Store map for use by
-        ui/query_schools.py in Django interface.
+        ui/query_schools.py in Django interface. The covid rates come from
+        the cached base layer of the city and month.
 
     Inputs:
         args_to_ui (dict): dictionary containing user input filters from Django
@@ -201,30 +594,16 @@ def create_viz(args_to_ui):
             - grade_level (str): (required)
             - school (str): (optional) partial or full school name
             - neighborhood (str): (optional) partial or full neighborhood
+        fig_file (str): path to save the map to, which no other render
+            may share (see map_cache.MapCache.render_path)
+
+    Returns (str): fig_file
     '''
 
     city = args_to_ui['city']
     month = int(args_to_ui['month'])
-    if month >= 4:
-        year = 2020
-    else:
-        year = 2021
-
-    schools_gdf = get_schools(args_to_ui)
-    covid_gdf = get_covid_geo(args_to_ui)
-    
-    viz_var = CITIES_MAP[city]['viz_var']
-    pt_var = 'Suggested_Action'
-    fig, ax = plt.subplots(figsize=(20, 12))
 
-    base = covid_gdf.plot(column=viz_var, cmap='RdYlBu_r', legend=True,
-        ax=ax, legend_kwds={'label': CITIES_MAP[city]['legend'],
-                            'orientation': "vertical"})
-
-    schools_gdf.plot(ax=base, marker='o', column=pt_var, 
-                cmap='jet', legend=True, markersize=7)
-    ax.axis('off')
-    title = CITIES_MAP[city]['title'] + str(month) + '/' + str(year)
-    ax.set_title(title, fontsize=20)
-    
-    fig.savefig(FIG_FILE, dpi=300)
+    base_canvas = load_base_canvas(city, month, map_version())
+    render_schools(get_schools(args_to_ui), base_canvas).save(
+        fig_file, format='PNG', compress_level=PNG_COMPRESS_LEVEL)
+    return fig_file
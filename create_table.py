@@ -1,15 +1,26 @@
 '''
 Create table in SQL database
 '''
+import hashlib
+import json
+import os
 import sqlite3
 import sys
 import re
+import time
+from datetime import datetime
+from itertools import islice
 import geopandas
 import pandas as pd
 
 DIC_OF_TYPES = {"int64": "INTEGER", "object": "nvarchar", "float64": "REAL",
                 "bool": "bit", "datetime64": "datetime"}
 
+CHUNK_SIZE = 5000
+LOAD_PRAGMAS = {"synchronous": "OFF", "journal_mode": "MEMORY"}
+MANIFEST_TABLE = "build_manifest"
+HASH_BLOCK_SIZE = 1 << 20
+
 
 def import_data(filename, datatype):
     '''
@@ -32,24 +43,246 @@ def import_data(filename, datatype):
     return df
 
 
-def create_table(filename, unwantedcols=None):
+def set_load_pragmas(connection):
+    '''
+    Switches the connection to the faster, non-durable settings in
+    LOAD_PRAGMAS for the duration of a bulk load
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+    Returns:
+        (dict) the previous value of each pragma, to pass to restore_pragmas
+    '''
+    previous = {}
+    for pragma, value in LOAD_PRAGMAS.items():
+        previous[pragma] = connection.execute("PRAGMA " + pragma).fetchone()[0]
+        connection.execute("PRAGMA " + pragma + " = " + value)
+    return previous
+
+
+def restore_pragmas(connection, previous):
+    '''
+    Restores the pragmas changed by set_load_pragmas
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        previous (dict): pragma values returned by set_load_pragmas
+    '''
+    for pragma, value in previous.items():
+        connection.execute("PRAGMA " + pragma + " = " + str(value))
+
+
+def chunk_rows(df, size=CHUNK_SIZE):
+    '''
+    Streams the rows of a dataframe as lists of tuples of at most size rows
+
+    Inputs:
+        df (Pandas DataFrame): data to be inserted
+        size (int): number of rows per chunk
+    Returns:
+        generator of lists of tuples
+    '''
+    rows = df.itertuples(index=False, name=None)
+    chunk = list(islice(rows, size))
+    while chunk:
+        yield chunk
+        chunk = list(islice(rows, size))
+
+
+def load_rows(connection, create_table_str, add_row_str, df):
+    '''
+    Creates the table and inserts the dataframe in chunks, inside whatever
+    transaction the connection currently has open
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        create_table_str (str): CREATE TABLE statement
+        add_row_str (str): parameterized INSERT statement
+        df (Pandas DataFrame): data to be inserted
+    Returns:
+        (int) number of rows inserted
+    '''
+    c = connection.cursor()
+    c.execute(create_table_str)
+    rows = 0
+    for chunk in chunk_rows(df):
+        c.executemany(add_row_str, chunk)
+        rows += len(chunk)
+    c.close()
+    return rows
+
+
+def file_fingerprint(filename, known=None):
+    '''
+    Fingerprints a source file by its content hash, size and mtime. If the
+    size and mtime match a previously recorded fingerprint, its hash is
+    reused rather than reading the whole file again.
+
+    Inputs:
+        filename (str): path of the file
+        known (dict): fingerprint recorded by a previous build, if any
+    Returns:
+        (dict) with keys sha256, size and mtime
+    '''
+    stat = os.stat(filename)
+    if known and known["size"] == stat.st_size and \
+            known["mtime"] == stat.st_mtime:
+        return {"sha256": known["sha256"], "size": stat.st_size,
+                "mtime": stat.st_mtime}
+    sha = hashlib.sha256()
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            sha.update(block)
+    return {"sha256": sha.hexdigest(), "size": stat.st_size,
+            "mtime": stat.st_mtime}
+
+
+def read_manifest(connection):
+    '''
+    Reads the build manifest, along with the schema each table currently has
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+    Returns:
+        (dict) mapping table name to its manifest entry, empty if the
+        database has never recorded a build
+    '''
+    exists = connection.execute("SELECT 1 FROM sqlite_master WHERE "
+                                "type = 'table' AND name = ?",
+                                (MANIFEST_TABLE,)).fetchone()
+    if not exists:
+        return {}
+    rows = connection.execute('''SELECT m.table_name, m.source_file,
+                                 m.sha256, m.size, m.mtime, m.options,
+                                 m.table_schema, t.sql
+                                 FROM ''' + MANIFEST_TABLE + ''' AS m
+                                 LEFT JOIN sqlite_master AS t
+                                 ON t.type = 'table' AND
+                                 t.name = m.table_name''').fetchall()
+    manifest = {}
+    for table, source, sha, size, mtime, options, schema, current in rows:
+        manifest[table] = {"source_file": source, "sha256": sha, "size": size,
+                           "mtime": mtime, "options": options,
+                           "table_schema": schema, "current_schema": current}
+    return manifest
+
+
+def is_unchanged(entry, fingerprint, options):
+    '''
+    Checks whether a table can be kept from the previous build
+
+    Inputs:
+        entry (dict): the table's manifest entry, or None
+        fingerprint (dict): fingerprint of the source file now
+        options: build options for the table (dropped columns, indexes);
+            anything that can be serialized to JSON
+    Returns:
+        (bool) True if the source, options and table schema all still match
+    '''
+    return entry is not None and \
+        entry["sha256"] == fingerprint["sha256"] and \
+        entry["options"] == json.dumps(options) and \
+        entry["current_schema"] is not None and \
+        entry["table_schema"] == entry["current_schema"]
+
+
+def record_manifest(connection, table_name, filename, fingerprint, options):
     '''
-    Creates the table in the school_access database if none exists
+    Records the source fingerprint and resulting schema of a freshly built
+    table in the build manifest
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        table_name (str): name of the table built
+        filename (str): source file the table was built from
+        fingerprint (dict): fingerprint of the source file
+        options: build options for the table (dropped columns, indexes);
+            anything that can be serialized to JSON
+    '''
+    connection.execute('''CREATE TABLE IF NOT EXISTS ''' + MANIFEST_TABLE +
+                       ''' (table_name nvarchar PRIMARY KEY,
+                       source_file nvarchar, sha256 nvarchar, size INTEGER,
+                       mtime REAL, options nvarchar, table_schema nvarchar,
+                       built_at datetime)''')
+    schema = connection.execute("SELECT sql FROM sqlite_master WHERE "
+                                "type = 'table' AND name = ?",
+                                (table_name,)).fetchone()[0]
+    connection.execute("INSERT OR REPLACE INTO " + MANIFEST_TABLE +
+                       " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                       (table_name, filename, fingerprint["sha256"],
+                        fingerprint["size"], fingerprint["mtime"],
+                        json.dumps(options), schema,
+                        datetime.now().isoformat(timespec="seconds")))
+
+
+def py_upper(value):
+    '''
+    Upper-cases text the way pandas' str.upper() does, for use in SQL, whose
+    UPPER() only changes ASCII letters. NULLs and numbers are left alone.
+    '''
+    if isinstance(value, str):
+        return value.upper()
+    return value
+
+
+def register_functions(connection):
+    '''
+    Registers the Python functions SQL statements may use: py_upper
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+    '''
+    try:
+        connection.create_function("py_upper", 1, py_upper,
+                                   deterministic=True)
+    except TypeError:
+        # Python 3.7 has no deterministic flag
+        connection.create_function("py_upper", 1, py_upper)
+
+
+def create_indexes(connection, table_name, indexes):
+    '''
+    Creates the indexes declared for a table. Called once the table has been
+    loaded, which is much faster than maintaining the index on every insert.
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        table_name (str): name of the table
+        indexes (list): list of tuples of column names, one tuple per index
+    '''
+    for cols in indexes:
+        index_name = "idx_" + table_name + "_" + "_".join(cols)
+        connection.execute("CREATE INDEX IF NOT EXISTS " + index_name +
+                           " ON " + table_name + " (" + ", ".join(cols) + ")")
+
+
+def create_table(filename, unwantedcols=None, connection=None, indexes=None):
+    '''
+    Creates the table in the school_access database if none exists and bulk
+    loads it in a single transaction
 
     Inputs:
         filename (str): name of file containing data to be added
         unwantedcols (list): list of column string names that are not to be
             added to the database
+        connection (sqlite3 Connection): open connection with a transaction
+            already begun by the caller, who is then responsible for
+            committing or rolling back. If None, a connection to
+            school_access.sqlite3 is opened and the table is committed on
+            its own.
+        indexes (list): list of tuples of column names to index once the
+            rows are loaded
     Returns:
-        Nothing, adds table to SQL database
+        (dict) table name, rows inserted, seconds taken and rows per second
     '''
     if unwantedcols is None:
         unwantedcols = []
+    if indexes is None:
+        indexes = []
     parsed_filename = re.search(r'((?:[\w-]+))\.((?:[\w-]+))', filename)
+    table_name = parsed_filename.group(1)
     df = import_data(filename, parsed_filename.group(2)).drop(unwantedcols,
                                                               axis=1)
-    connection = sqlite3.connect('school_access.sqlite3')
-    c = connection.cursor()
     table_cols = []
 
     for col in df:
@@ -58,19 +291,38 @@ def create_table(filename, unwantedcols=None):
             raise Exception(f"Error: Number starts column {col}, please rename")
         string = col + ' ' + coltype
         table_cols.append(string)
-    create_table_str = '''CREATE TABLE IF NOT EXISTS ''' + \
-                       parsed_filename.group(1) + ' (' + \
-                       ', '.join(table_cols) + ')'
-    c.execute(create_table_str)
+    create_table_str = '''CREATE TABLE IF NOT EXISTS ''' + table_name + \
+                       ' (' + ', '.join(table_cols) + ')'
 
     question_marks = ", ".join(["?"] * len(df.columns))
-    add_row_str = '''INSERT INTO ''' + parsed_filename.group(1) + \
+    add_row_str = '''INSERT INTO ''' + table_name + \
                     ' VALUES (' + question_marks + ')'
-    for row in df.itertuples(index=False):
-        args = list(row)
-        c.execute(add_row_str, args)
-    connection.commit()
-    connection.close()
+
+    start = time.perf_counter()
+    if connection is not None:
+        rows = load_rows(connection, create_table_str, add_row_str, df)
+        create_indexes(connection, table_name, indexes)
+    else:
+        connection = sqlite3.connect('school_access.sqlite3')
+        previous = set_load_pragmas(connection)
+        try:
+            connection.execute("BEGIN")
+            rows = load_rows(connection, create_table_str, add_row_str, df)
+            create_indexes(connection, table_name, indexes)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        finally:
+            restore_pragmas(connection, previous)
+            connection.close()
+    seconds = time.perf_counter() - start
+
+    rate = rows / seconds if seconds > 0 else float(rows)
+    print(f"Loaded {rows} rows into {table_name} in {seconds:.2f}s "
+          f"({rate:,.0f} rows/sec)")
+    return {"table": table_name, "rows": rows, "seconds": seconds,
+            "rows_per_sec": rate}
 
 
 if __name__ == "__main__":
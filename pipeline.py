@@ -0,0 +1,303 @@
+'''
+Runs the data update stages as a dependency graph, running stages that do
+not depend on each other at the same time in a process pool
+
+Each stage declares the files it reads and writes. A stage waits for every
+earlier-declared stage that writes a file it reads, writes a file it also
+writes, or reads a file it writes, so the results are the same as running
+the stages one after another in the order given.
+
+Stages are cached make-style: a stage whose input files all match the last
+successful run, and whose outputs all still exist, is skipped.
+'''
+import json
+import os
+import resource
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from create_table import file_fingerprint
+
+STAGE_CACHE = ".stage_cache.json"
+
+
+class Stage:
+    '''
+    Class describing one step of the data update
+    '''
+    def __init__(self, name, func, inputs=None, outputs=None, args=(),
+                 cacheable=True):
+        '''
+        Inputs:
+            name (str): unique name of the stage
+            func (function): module-level function that runs the stage
+            inputs (lst): files the stage reads
+            outputs (lst): files the stage writes
+            args (tuple): arguments to pass to func
+            cacheable (bool): False for stages that read data from the web,
+                which can change without any local input changing
+        '''
+        self.name = name
+        self.func = func
+        self.inputs = {os.path.normpath(path) for path in inputs or []}
+        self.outputs = {os.path.normpath(path) for path in outputs or []}
+        self.args = args
+        self.cacheable = cacheable
+
+    def conflicts_with(self, earlier):
+        '''
+        Checks whether this stage has to wait for an earlier stage
+
+        Inputs: earlier (Stage): a stage declared before this one
+        Returns: (bool) True if the two stages share a file that either one
+            writes
+        '''
+        return bool(self.inputs & earlier.outputs or
+                    self.outputs & earlier.outputs or
+                    self.outputs & earlier.inputs)
+
+
+class StageCache:
+    '''
+    Class that records the input fingerprints of each stage's last
+    successful run in a JSON file
+    '''
+    def __init__(self, path=STAGE_CACHE):
+        self.path = path
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.entries = json.load(f)
+
+    def fingerprints(self, stage):
+        '''
+        Fingerprints the stage's inputs, reusing recorded hashes for files
+        whose size and mtime have not changed
+
+        Inputs: stage (Stage): the stage
+        Returns: (dict) mapping each input to its fingerprint, or None if an
+            input is missing
+        '''
+        known = self.entries.get(stage.name, {}).get("inputs", {})
+        fingerprints = {}
+        for path in sorted(stage.inputs):
+            if not os.path.isfile(path):
+                return None
+            fingerprints[path] = file_fingerprint(path, known.get(path))
+        return fingerprints
+
+    def is_fresh(self, stage):
+        '''
+        Checks whether a stage can be skipped
+
+        Inputs: stage (Stage): the stage
+        Returns: (bool) True if the stage's inputs match its last successful
+            run and all of its outputs exist
+        '''
+        entry = self.entries.get(stage.name)
+        if not stage.cacheable or entry is None:
+            return False
+        if not all(os.path.exists(path) for path in stage.outputs):
+            return False
+        fingerprints = self.fingerprints(stage)
+        if fingerprints is None or set(fingerprints) != set(entry["inputs"]):
+            return False
+        return all(fingerprints[path]["sha256"] ==
+                   entry["inputs"][path]["sha256"] for path in fingerprints)
+
+    def record(self, stage):
+        '''
+        Records a successful run of the stage and saves the cache file
+
+        Inputs: stage (Stage): the stage that just finished
+        '''
+        fingerprints = self.fingerprints(stage)
+        if not stage.cacheable or fingerprints is None:
+            self.entries.pop(stage.name, None)
+        else:
+            self.entries[stage.name] = {"inputs": fingerprints,
+                                        "outputs": sorted(stage.outputs)}
+        temp_path = self.path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(temp_path, self.path)
+
+
+def find_dependencies(stages):
+    '''
+    Works out which stages each stage has to wait for
+
+    Inputs: stages (lst): list of Stage objects, in run order
+    Returns: (dict) mapping each stage name to a set of stage names
+    '''
+    names = [stage.name for stage in stages]
+    if len(set(names)) != len(names):
+        raise Exception("Error: stage names must be unique")
+    dependencies = {}
+    for i, stage in enumerate(stages):
+        dependencies[stage.name] = {earlier.name for earlier in stages[:i]
+                                    if stage.conflicts_with(earlier)}
+    return dependencies
+
+
+def reset_peak_rss():
+    '''
+    Resets the peak resident set size of the current process where the OS
+    allows it (Linux), so that a reused pool worker reports the peak of the
+    stage it is about to run rather than of every stage it has run
+    '''
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def peak_rss_kb():
+    '''
+    Returns (int) the peak resident set size of the current process in KB
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024
+    return peak
+
+
+def count_rows(paths):
+    '''
+    Counts the data rows in the CSV files among the given paths
+
+    Inputs: paths (collection): file paths
+    Returns: (int) number of lines after the header in each CSV file, or None
+        if there are no CSV files
+    '''
+    csv_paths = [path for path in paths
+                 if path.endswith(".csv") and os.path.isfile(path)]
+    if not csv_paths:
+        return None
+    rows = 0
+    for path in csv_paths:
+        with open(path, "rb") as f:
+            lines = sum(block.count(b"\n") for block in
+                        iter(lambda: f.read(1 << 20), b""))
+        rows += max(lines - 1, 0)
+    return rows
+
+
+def run_stage(func, args, inputs, outputs):
+    '''
+    Runs a stage inside a worker process and measures it
+
+    Inputs:
+        func (function): module-level function to run. It may return a dict
+            with rows_read, rows_written and tables keys to report its own
+            row counts.
+        args (tuple): arguments to pass to func
+        inputs (collection): files the stage reads
+        outputs (collection): files the stage writes
+    Returns: (dict) seconds, peak_rss_kb, rows_read, rows_written and
+        tables for the stage
+    '''
+    reset_peak_rss()
+    start = time.perf_counter()
+    result = func(*args)
+    seconds = time.perf_counter() - start
+    if not isinstance(result, dict):
+        result = {}
+    return {"status": "ran", "seconds": seconds, "peak_rss_kb": peak_rss_kb(),
+            "rows_read": result.get("rows_read", count_rows(inputs)),
+            "rows_written": result.get("rows_written", count_rows(outputs)),
+            "tables": result.get("tables", [])}
+
+
+def run_pipeline(stages, max_workers=None, force=(), cache=None,
+                 report=None):
+    '''
+    Runs the stages in a process pool as soon as the stages they depend on
+    have finished, skipping stages whose inputs have not changed since their
+    last successful run. If a stage fails, no further stages are started,
+    the stages already running are allowed to finish and the error is
+    raised.
+
+    Inputs:
+        stages (lst): list of Stage objects, in run order
+        max_workers (int): size of the process pool, defaults to the number
+            of CPUs
+        force (collection): names of stages to run even if they are cached,
+            or True to run every stage
+        cache (StageCache): cache of previous runs, defaults to STAGE_CACHE
+        report (dict): dict to fill in as stages finish, so that the
+            measurements are still available if a stage fails
+    Returns:
+        (dict) mapping each stage name to the measurements from run_stage,
+        or {"status": "skipped"} for stages that were skipped
+    '''
+    dependencies = find_dependencies(stages)
+    by_name = {stage.name: stage for stage in stages}
+    if force is True:
+        force = set(by_name)
+    unknown = set(force) - set(by_name)
+    if unknown:
+        raise Exception(f"Error: unknown stage(s) {sorted(unknown)}")
+    if cache is None:
+        cache = StageCache()
+    waiting = [stage.name for stage in stages]
+    finished = set()
+    if report is None:
+        report = {}
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        running = {}
+        while waiting or running:
+            for name in [name for name in waiting
+                         if dependencies[name] <= finished]:
+                stage = by_name[name]
+                waiting.remove(name)
+                if name not in force and cache.is_fresh(stage):
+                    print(f"Skipping stage {name}, inputs unchanged")
+                    report[name] = {"status": "skipped"}
+                    finished.add(name)
+                    continue
+                print(f"Starting stage {name}...")
+                future = pool.submit(run_stage, stage.func, stage.args,
+                                     stage.inputs, stage.outputs)
+                running[future] = name
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                error = future.exception()
+                if error is not None:
+                    for other in running:
+                        other.cancel()
+                    print(f"Stage {name} failed, stopping the update")
+                    report[name] = {"status": "failed", "error": repr(error)}
+                    print_timings(report, time.perf_counter() - start)
+                    raise error
+                report[name] = future.result()
+                cache.record(by_name[name])
+                finished.add(name)
+                print(f"Finished stage {name} in "
+                      f"{report[name]['seconds']:.1f}s")
+
+    print_timings(report, time.perf_counter() - start)
+    return report
+
+
+def print_timings(report, total):
+    '''
+    Prints the time and peak memory of each stage and the total wall time
+
+    Inputs:
+        report (dict): mapping of stage name to its measurements
+        total (float): wall time of the whole pipeline in seconds
+    '''
+    width = max([len(name) for name in report] + [len("Total (wall)")])
+    print("\nStage timings:")
+    for name, stage in report.items():
+        if stage["status"] == "ran":
+            print(f"  {name:<{width}}  {stage['seconds']:8.1f}s  "
+                  f"{stage['peak_rss_kb'] / 1024:8.1f} MB peak")
+        else:
+            print(f"  {name:<{width}}  {stage['status']:>9}")
+    print(f"  {'Total (wall)':<{width}}  {total:8.1f}s")
@@ -0,0 +1,217 @@
+'''
+Pre-renders the map of every city, month and grade level search without a
+school or neighborhood filter, which covers most of the searches made, so
+that those maps are ready as soon as the build is.
+
+The maps are drawn in a pool of worker processes, one job per city and month
+so that each worker draws the city/month base layer once and reuses it for
+every grade level, then drops it before its next job. A worker drawing 300
+dpi maps takes the best part of a gigabyte, so the pool is only as large as
+the memory available allows. They are stored in the web interface's
+pre-rendered map directory under the cache keys of the new build, replacing
+the maps of the previous build.
+'''
+import multiprocessing
+import os
+import sqlite3
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+import reopening_guide
+
+UI_DIR = os.path.abspath("ui")
+
+DATABASE = "school_access.sqlite3"
+GEOMETRY_STORE = "geometry.sqlite3"
+PRERENDER_WORKERS = 2
+# Memory to allow for each rendering process: the base layer figure and its
+# saved pixels, the map being encoded, and geopandas and matplotlib
+WORKER_MEMORY = 2 ** 30
+# Where the pipeline sees the stage's output: map_cache.PRERENDER_DIR, under
+# ui/
+PRERENDER_DIR = os.path.join("ui", "static", "prerendered")
+
+
+def map_searches(connection):
+    '''
+    Lists the searches to pre-render: every city and month in the
+    categorized schools, with each of its grade levels and with none
+
+    Inputs:
+        connection (sqlite3 Connection): connection to the database
+    Returns: (dict) mapping each (city, month) to its list of args_to_ui
+    '''
+    searches = {}
+    rows = connection.execute(
+        "SELECT DISTINCT City, Month, Grade_Level_Cat FROM " +
+        reopening_guide.CATEGORIZED_TABLE + " WHERE City IS NOT NULL AND "
+        "Month IS NOT NULL ORDER BY City, Month, Grade_Level_Cat").fetchall()
+    for city, month, grade in rows:
+        group = searches.setdefault((city, int(month)), [
+            {'city': city, 'month': str(int(month))}])
+        if grade is not None:
+            group.append({'city': city, 'month': str(int(month)),
+                          'grade_level': grade})
+    return searches
+
+
+def available_memory():
+    '''
+    Returns: (int) bytes of memory available to new processes without
+        swapping, or None where /proc/meminfo does not say
+    '''
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def worker_count(max_workers=PRERENDER_WORKERS):
+    '''
+    Sizes the pool: at most max_workers processes, one per CPU, and only as
+    many as fit in the memory available now
+
+    Inputs:
+        max_workers (int): largest number of rendering processes
+    Returns: (int) number of rendering processes, at least one
+    '''
+    workers = min(max_workers, os.cpu_count() or 1)
+    memory = available_memory()
+    if memory is not None:
+        workers = min(workers, memory // WORKER_MEMORY)
+    return max(1, workers)
+
+
+def start_worker(ui_dir, root):
+    '''
+    Runs in each worker before its first job. create_map reads its data
+    relative to ui/, as it does in the web interface.
+
+    Inputs:
+        ui_dir (str): absolute path of ui/
+        root (str): absolute path of the directory create_map is in
+    '''
+    os.chdir(ui_dir)
+    if root not in sys.path:
+        sys.path.insert(0, root)
+
+
+def render_group(searches, render_paths):
+    '''
+    Draws the maps of one city and month inside a worker process. The base
+    layer is dropped once they are drawn, so that a worker never holds more
+    than one.
+
+    Inputs:
+        searches (lst): args_to_ui of each map
+        render_paths (lst): absolute path to save each map to
+    Returns: (lst) None for each map drawn, or the error that stopped it
+    '''
+    import create_map
+    errors = []
+    try:
+        for args_to_ui, render_path in zip(searches, render_paths):
+            try:
+                create_map.create_viz(args_to_ui, render_path)
+                errors.append(None)
+            except Exception as e:
+                errors.append(repr(e))
+    finally:
+        create_map.load_base_canvas.cache_clear()
+    return errors
+
+
+def remove_renders(render_paths):
+    '''
+    Deletes renders that were not added to the pre-rendered maps, which
+    would otherwise show as pending maps to the web interface
+
+    Inputs:
+        render_paths (iterable): paths maps were rendered to
+    '''
+    for render_path in render_paths:
+        try:
+            os.remove(render_path)
+        except FileNotFoundError:
+            pass
+
+
+def go(database=DATABASE, max_workers=PRERENDER_WORKERS,
+       geometry_store=GEOMETRY_STORE):
+    '''
+    Pre-renders the maps of the current builds of the database and the
+    geometry store
+
+    Inputs:
+        database (str): path of the database
+        max_workers (int): largest number of rendering processes, see
+            worker_count
+        geometry_store (str): path of the geometry store
+    Returns: (dict) number of maps pre-rendered and the searches that
+        failed. Raises an Exception if a rendering process dies, after
+        deleting the renders in progress.
+    '''
+    if UI_DIR not in sys.path:
+        sys.path.append(UI_DIR)
+    import map_cache
+    cache = map_cache.MapCache(
+        directory=os.path.join(UI_DIR, map_cache.CACHE_DIR),
+        database=database,
+        prerender_dir=os.path.join(UI_DIR, map_cache.PRERENDER_DIR),
+        geometry_store=geometry_store)
+    connection = sqlite3.connect(database)
+    searches = map_searches(connection)
+    connection.close()
+    max_workers = worker_count(max_workers)
+    print(f"Pre-rendering maps for {len(searches)} city/months in "
+          f"{max_workers} processes...")
+
+    keys = set()
+    failed = []
+    jobs = {}
+    root = os.path.dirname(os.path.abspath(__file__))
+    pool = ProcessPoolExecutor(
+        max_workers, mp_context=multiprocessing.get_context('spawn'),
+        initializer=start_worker, initargs=(UI_DIR, root))
+    try:
+        # searches are in city and month order, so each worker moves
+        # through the base layers of one city at a time
+        for group in searches.values():
+            group_keys = [cache.key(args_to_ui) for args_to_ui in group]
+            render_paths = [os.path.abspath(cache.render_path(key))
+                            for key in group_keys]
+            future = pool.submit(render_group, group, render_paths)
+            jobs[future] = (group, group_keys, render_paths)
+        for future in as_completed(jobs):
+            group, group_keys, render_paths = jobs[future]
+            for args_to_ui, key, render_path, error in zip(
+                    group, group_keys, render_paths, future.result()):
+                if error is None:
+                    cache.add_prerendered(key, render_path)
+                    keys.add(key)
+                    continue
+                print(f"Map for {args_to_ui} failed: {error}")
+                failed.append(args_to_ui)
+    except BrokenProcessPool as e:
+        raise Exception("Error: a map rendering process died, most likely "
+                        "killed for lack of memory; pre-rendered "
+                        f"{len(keys)} maps") from e
+    finally:
+        for future in jobs:
+            future.cancel()
+        pool.shutdown(wait=True)
+        remove_renders(render_path for _, _, render_paths in jobs.values()
+                       for render_path in render_paths)
+
+    cache.prune_prerendered(keys)
+    print(f"Pre-rendered {len(keys)} maps, {len(failed)} failed")
+    return {"maps": len(keys), "failed": failed}
+
+
+if __name__ == "__main__":
+    go()
@@ -0,0 +1,204 @@
+'''
+Mergeable streaming quantile sketch (KLL)
+
+A KLL sketch keeps a stack of compactors. New values go into level 0, and a
+level that outgrows its capacity is sorted and every other value (starting at
+a random offset) is promoted to the level above, where each value stands for
+twice as many. The capacities shrink geometrically going down from the top
+level, so the sketch holds O(k) values however many it has seen, and two
+sketches are merged by concatenating their levels and compacting again. The
+sketch can be built per chunk or per city, merged, and stored as JSON.
+
+Until its first compaction the sketch holds every value and its quantiles
+are exact, interpolated the same way as numpy and pandas.
+'''
+import json
+import numpy as np
+
+CAPACITY_RATIO = 2 / 3
+MIN_CAPACITY = 2
+# DataSketches' empirical fit of the KLL normalized rank error (99%
+# confidence, single quantile) as a function of k
+ERROR_SCALE = 2.296
+ERROR_EXPONENT = 0.9723
+
+
+def k_for_error(error):
+    '''
+    Finds the smallest k whose rank error is within the given bound
+
+    Inputs: error (float): normalized rank error, e.g. .01 for 1%
+    Returns: (int) k
+    '''
+    if not 0 < error < 1:
+        raise ValueError("Error: rank error must be between 0 and 1")
+    return max(int(np.ceil((ERROR_SCALE / error) ** (1 / ERROR_EXPONENT))),
+               MIN_CAPACITY)
+
+
+class KLLSketch:
+    '''
+    Class describing a KLL quantile sketch of a stream of floats
+    '''
+    def __init__(self, k=200, seed=0):
+        '''
+        Inputs:
+            k (int): capacity of the top compactor; larger is more accurate
+            seed (int): seed of the random compaction offsets, so that
+                builds are reproducible
+        '''
+        self.k = k
+        self.n = 0
+        self.min = np.inf
+        self.max = -np.inf
+        self.levels = [np.empty(0)]
+        self.rng = np.random.default_rng(seed)
+
+    @classmethod
+    def for_error(cls, error, seed=0):
+        '''
+        Creates a sketch sized for the given normalized rank error
+
+        Inputs:
+            error (float): normalized rank error, e.g. .01 for 1%
+            seed (int): seed of the random compaction offsets
+        Returns: (KLLSketch) empty sketch
+        '''
+        return cls(k_for_error(error), seed)
+
+    def rank_error(self):
+        '''
+        Returns (float) the normalized rank error of the sketch's quantiles,
+        0 while the sketch is still exact
+        '''
+        if self.is_exact():
+            return 0.0
+        return ERROR_SCALE / self.k ** ERROR_EXPONENT
+
+    def is_exact(self):
+        '''
+        Returns (bool) True if the sketch still holds every value it has seen
+        '''
+        return len(self.levels) == 1
+
+    def capacity(self, level):
+        '''
+        Inputs: level (int): compactor level
+        Returns: (int) number of values the level holds before compacting
+        '''
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * CAPACITY_RATIO ** depth)),
+                   MIN_CAPACITY)
+
+    def update(self, values):
+        '''
+        Adds values to the sketch, ignoring missing values
+
+        Inputs: values (array-like): floats to add
+        '''
+        values = np.asarray(values, dtype=float).ravel()
+        values = values[~np.isnan(values)]
+        if not len(values):
+            return
+        self.n += len(values)
+        self.min = min(self.min, values.min())
+        self.max = max(self.max, values.max())
+        self.levels[0] = np.concatenate([self.levels[0], values])
+        self.compress()
+
+    def merge(self, other):
+        '''
+        Merges another sketch into this one
+
+        Inputs: other (KLLSketch): sketch with the same k
+        Returns: (KLLSketch) this sketch
+        '''
+        if other.k != self.k:
+            raise ValueError("Error: can only merge sketches with the same k")
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        for level, values in enumerate(other.levels):
+            self.levels[level] = np.concatenate([self.levels[level], values])
+        self.n += other.n
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+        self.compress()
+        return self
+
+    def compress(self):
+        '''
+        Compacts the lowest level over capacity until the sketch fits
+        '''
+        while sum(len(values) for values in self.levels) > \
+                sum(self.capacity(level) for level in range(len(self.levels))):
+            for level, values in enumerate(self.levels):
+                if len(values) > self.capacity(level):
+                    self.compact(level)
+                    break
+
+    def compact(self, level):
+        '''
+        Sorts a level and promotes every other value to the level above,
+        keeping the last value behind if the level has an odd count
+
+        Inputs: level (int): compactor level
+        '''
+        values = np.sort(self.levels[level])
+        kept = values[len(values) - len(values) % 2:]
+        values = values[:len(values) - len(values) % 2]
+        if level + 1 == len(self.levels):
+            self.levels.append(np.empty(0))
+        promoted = values[self.rng.integers(2)::2]
+        self.levels[level + 1] = np.concatenate([self.levels[level + 1],
+                                                 promoted])
+        self.levels[level] = kept
+
+    def quantile(self, q):
+        '''
+        Estimates the q-th quantile of the values seen
+
+        Inputs: q (float): quantile between 0 and 1
+        Returns: (float) the exact, linearly interpolated quantile while the
+            sketch is exact, otherwise a value whose rank is within
+            rank_error() of q; NaN if the sketch is empty
+        '''
+        if self.n == 0:
+            return np.nan
+        if self.is_exact():
+            return float(np.quantile(self.levels[0], q))
+        values = np.concatenate(self.levels)
+        weights = np.concatenate([np.full(len(values), 2 ** level)
+                                  for level, values in enumerate(self.levels)])
+        order = np.argsort(values, kind="stable")
+        ranks = np.cumsum(weights[order])
+        position = np.searchsorted(ranks, q * (self.n - 1), side="right")
+        return float(values[order][min(position, len(values) - 1)])
+
+    def to_json(self):
+        '''
+        Returns (str) the sketch serialized as JSON, including the state of
+        its random generator so that a reloaded sketch compacts the same way
+        '''
+        return json.dumps({"k": self.k, "n": self.n,
+                           "min": None if self.n == 0 else self.min,
+                           "max": None if self.n == 0 else self.max,
+                           "levels": [values.tolist()
+                                      for values in self.levels],
+                           "rng": self.rng.bit_generator.state})
+
+    @classmethod
+    def from_json(cls, text):
+        '''
+        Inputs: text (str): JSON written by to_json
+        Returns: (KLLSketch) the sketch
+        '''
+        state = json.loads(text)
+        sketch = cls(state["k"])
+        sketch.n = state["n"]
+        if sketch.n:
+            sketch.min = state["min"]
+            sketch.max = state["max"]
+        sketch.levels = [np.array(values, dtype=float)
+                         for values in state["levels"]]
+        sketch.rng.bit_generator.state = state["rng"]
+        return sketch
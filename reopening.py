@@ -4,8 +4,13 @@ collect the data, build the sqlite database, and open the django interface
 Created by: Natalie Ayers, Sabrina Sedovic, Michelle Orden, references
 work from tracker.py by Lamont Samuels
 '''
+import argparse
+import json
+import os
 import sqlite3
 import sys
+import time
+from datetime import datetime
 import re
 import runpy
 import chicago_covid_clean
@@ -14,8 +19,15 @@ import clean_chi_attendance
 import scrape_la_schools
 import clean_la_covid_data
 import reopening_guide
+import categorize_sql
 import convert_la_data
-from create_table import create_table
+import create_map
+import prerender_maps
+import substring_index
+from pipeline import Stage, run_pipeline, peak_rss_kb
+from create_table import (create_table, set_load_pragmas, restore_pragmas,
+                          file_fingerprint, read_manifest, is_unchanged,
+                          record_manifest)
 
 FILENAMES = {"chicago_covid_grouped.csv": None, "la_broadband.csv": ["Unnamed: 0",
              "geometry"], "la_schools.csv": ["Unnamed: 0","geometry"],
@@ -23,9 +35,32 @@ FILENAMES = {"chicago_covid_grouped.csv": None, "la_broadband.csv": ["Unnamed: 0
              "LA_Chronic_Absence_Rates.csv": None,
              "LA_Excellent_Attendance.csv": None,
              "chicago_broadband.csv": None, "nyc_covid.csv": None,
-             "chicago_schools_with_community.csv": "Unnamed: 0"}
+             "chicago_schools_with_community.csv": "Unnamed: 0",
+             "la_covid.csv": None, "nyc_attendance.csv": None,
+             "chicago_attendance_clean.csv": "Unnamed: 0"}
+
+# Indexes on the join keys used by the city queries in reopening_guide,
+# created after each table is loaded
+INDEXES = {"la_schools.csv": [("Neighborhood",), ("CDSCODE",),
+                              ("MPD_NAME",)],
+           "la_broadband.csv": [("Name",)],
+           "la_covid.csv": [("Community",)],
+           "LA_Chronic_Absence_Rates.csv": [("CDSCode",)],
+           "LA_Excellent_Attendance.csv": [("CDSCode",)],
+           "chicago_schools_with_community.csv": [("community",), ("zip",),
+                                                  ("school_id",)],
+           "chicago_broadband.csv": [("community_area",)],
+           "chicago_covid_grouped.csv": [("ZIP",)],
+           "chicago_attendance_clean.csv": [("school_id",)],
+           "nyc_schools.csv": [("modzcta",), ("system_cod",)],
+           "nyc_broadband.csv": [("MODZCTA",)],
+           "nyc_covid.csv": [("modzcta",)],
+           "nyc_attendance.csv": [("dbn",)]}
 
 DATA_DIR = "./data/"
+DATABASE = "school_access.sqlite3"
+STAGING_DATABASE = DATABASE + ".staging"
+GEOMETRY_STORE = "geometry.sqlite3"
 
 MENU = '''
 Select Update Option
@@ -43,19 +78,27 @@ OPTIONS_HANDLER = {
 START = 1
 END = 4
 
+CITIES = ["chicago", "nyc", "la"]
+OPTION_CITIES = {1: CITIES, 2: ["chicago", "nyc"], 3: []}
+REPORT_DIR = "reports/"
+CATEGORIZE_ENGINES = {"python": reopening_guide.go, "sql": categorize_sql.go,
+                      "incremental": reopening_guide.update_categorized}
+
 class DataUpdate:
     '''
     Class that updates data depending on restriction value
     '''
-    def __init__(self, delete=True, data=None):
+    def __init__(self, delete=True, data=None, force=False, force_stages=()):
         self.delete=delete
         self.data=None
+        self.force=force
+        self.force_stages=force_stages
 
     def update_data(self):
         '''
         Launches go function using class' data as restriction
         '''
-        go(self.data)
+        go(self.data, self.force, self.force_stages)
 
 
 def clean_chicago_data():
@@ -68,47 +111,392 @@ def clean_chicago_data():
     clean_chi_attendance.clean_attendance()
 
 
-def build_db(files):
+def stage_database():
+    '''
+    Copies the live database into the staging file with SQLite's backup API,
+    so that tables which are not being rebuilt carry over unchanged. Any
+    staging file left behind by an earlier failed build is discarded.
     '''
-    Builds/updates database using the files collected
+    if os.path.exists(STAGING_DATABASE):
+        os.remove(STAGING_DATABASE)
+    staging = sqlite3.connect(STAGING_DATABASE)
+    if os.path.exists(DATABASE):
+        live = sqlite3.connect(DATABASE)
+        live.backup(staging)
+        live.close()
+    staging.close()
 
-    Inputs: files (lst): list of filenames to add to database
-    Returns: None, updates SQL database school_access.sqlite3
+
+def validate_database(connection, tables):
     '''
-    print("Creating tables in the sqlite3 database.")
-    connection = sqlite3.connect('school_access.sqlite3')
-    c = connection.cursor()
+    Checks the staged database before it is promoted
+
+    Inputs:
+        connection (sqlite3 Connection): connection to the staging database
+        tables (lst): names of the tables rebuilt in this build
+    Returns: None, raises an Exception if the database fails a check
+    '''
+    result = connection.execute("PRAGMA quick_check").fetchone()[0]
+    if result != "ok":
+        raise Exception(f"Error: staged database failed quick_check: {result}")
+    for table in tables:
+        count = connection.execute("SELECT COUNT(*) FROM " + table) \
+                          .fetchone()[0]
+        if count == 0:
+            raise Exception(f"Error: staged table {table} is empty")
+    check_query_plans(connection)
+
+
+def check_query_plans(connection):
+    '''
+    Runs EXPLAIN QUERY PLAN on each city query and checks that only the
+    outermost table of each join is scanned. Every inner table must be
+    searched through a declared index; an automatic index counts as a scan,
+    since SQLite has to read the whole table to build it.
+
+    Inputs:
+        connection (sqlite3 Connection): connection to the staging database
+    Returns: None, raises an Exception naming the query and plan steps if an
+        inner join table is fully scanned
+    '''
+    for city, query in reopening_guide.CITY_QUERIES.items():
+        plan = [row[3] for row in
+                connection.execute("EXPLAIN QUERY PLAN " + query).fetchall()]
+        scans = [step for step in plan
+                 if re.match(r'SCAN (?:TABLE )?\w+', step)
+                 and "SUBQUERY" not in step
+                 and "CONSTANT ROW" not in step]
+        problems = scans[1:] + [step for step in plan if "AUTOMATIC" in step]
+        if problems:
+            raise Exception(f"Error: {city} query does a full scan on an "
+                            f"inner join table: {problems}")
+
+
+def table_options(filename):
+    '''
+    Build options for a source file, recorded in the build manifest so that
+    changing them forces the table to be rebuilt
+
+    Inputs: filename (str): name of the source file
+    Returns: (tuple) of the unwanted columns and the indexes for the table
+    '''
+    return FILENAMES.get(filename, None), INDEXES.get(filename, [])
+
+
+def promote_database():
+    '''
+    Atomically replaces the live database with the staging file. Readers
+    that already have the old file open keep reading a complete snapshot of
+    it, and every new connection sees the new build.
+    '''
+    fd = os.open(STAGING_DATABASE, os.O_RDONLY)
+    os.fsync(fd)
+    os.close(fd)
+    os.replace(STAGING_DATABASE, DATABASE)
+    if hasattr(os, "O_DIRECTORY"):
+        fd = os.open(os.path.dirname(os.path.abspath(DATABASE)),
+                     os.O_RDONLY | os.O_DIRECTORY)
+        os.fsync(fd)
+        os.close(fd)
+
+
+def tables_to_build(files, force=False):
+    '''
+    Compares each source file against the build manifest of the live
+    database and keeps only the files whose table needs rebuilding
+
+    Inputs:
+        files (lst): list of filenames to add to database
+        force (bool): rebuild every table regardless of the manifest
+    Returns:
+        (lst) of (filename, table name, fingerprint) tuples to rebuild
+    '''
+    manifest = {}
+    if os.path.exists(DATABASE):
+        connection = sqlite3.connect(DATABASE)
+        manifest = read_manifest(connection)
+        connection.close()
+
+    to_build = []
     for filename in files:
-        parsed_filename = re.search(r'((?:[\w-]+))\.[\w-]+', filename).group(1)
-        print(f"Updating {parsed_filename} in SQL database...")
-        query1 = "DROP TABLE IF EXISTS " + parsed_filename
-        c.execute(query1)
-        unwanted_cols = FILENAMES.get(filename, None)
-        create_table(DATA_DIR + filename, unwanted_cols)
+        parsed_filename = re.search(r'((?:[\w-]+))\.[\w-]+',
+                                    filename).group(1)
+        entry = manifest.get(parsed_filename)
+        fingerprint = file_fingerprint(DATA_DIR + filename, entry)
+        if not force and is_unchanged(entry, fingerprint,
+                                      table_options(filename)):
+            print(f"{parsed_filename} is unchanged, skipping")
+            continue
+        to_build.append((filename, parsed_filename, fingerprint))
+    return to_build
+
+
+def build_staged(build):
+    '''
+    Runs a build against a staging copy of the database over one connection
+    and one transaction. The staging copy is validated and then swapped in
+    for the live database, so the web interface never sees a partly built
+    database.
+
+    Inputs:
+        build (function): takes the staging connection, updates it inside
+            the open transaction and returns its result along with the list
+            of tables it rebuilt
+    Returns: the result of build
+    '''
+    stage_database()
+    connection = sqlite3.connect(STAGING_DATABASE)
+    previous = set_load_pragmas(connection)
+    try:
+        connection.execute("BEGIN")
+        result, tables = build(connection)
+        connection.execute("ANALYZE")
+        connection.commit()
+        validate_database(connection, tables)
+    except Exception:
+        connection.rollback()
+        restore_pragmas(connection, previous)
+        connection.close()
+        os.remove(STAGING_DATABASE)
+        print("Build failed, the live database was not changed")
+        raise
+    restore_pragmas(connection, previous)
+    connection.close()
+    promote_database()
+    return result
+
+
+def build_db(files, force=False):
+    '''
+    Builds/updates database using the files collected. Tables whose source
+    file, options and schema match the build manifest are skipped unless
+    force is set. The rest are rebuilt together in a staging copy of the
+    database, which is swapped in once it passes validation.
+
+    Inputs:
+        files (lst): list of filenames to add to database
+        force (bool): rebuild every table even if its source is unchanged
+    Returns: (dict) rows read and written and the load statistics of each
+        table rebuilt, updates SQL database school_access.sqlite3
+    '''
+    print("Creating tables in the sqlite3 database.")
+    to_build = tables_to_build(files, force)
+    if not to_build:
+        print("All tables up to date")
+        return {"rows_read": 0, "rows_written": 0, "tables": []}
+
+    def load(connection):
+        stats = []
+        for filename, parsed_filename, fingerprint in to_build:
+            print(f"Updating {parsed_filename} in SQL database...")
+            connection.execute("DROP TABLE IF EXISTS " + parsed_filename)
+            unwanted_cols, indexes = table_options(filename)
+            stats.append(create_table(DATA_DIR + filename, unwanted_cols,
+                                      connection, indexes))
+            record_manifest(connection, parsed_filename, filename,
+                            fingerprint, table_options(filename))
+        return stats, [table["table"] for table in stats]
+
+    stats = build_staged(load)
     print("Table(s) updated")
+    rows = sum(table["rows"] for table in stats)
+    return {"rows_read": rows, "rows_written": rows, "tables": stats}
 
 
-def go(restriction):
+def build_categorized(engine="python", sketch_error=None):
+    '''
+    Categorizes the three cities straight into the categorized_schools table
+    of a staging copy of the database, along with the school and community
+    search table, which is swapped in once it passes validation
+
+    Inputs: engine (str): key of CATEGORIZE_ENGINES, "python" to categorize
+        in pandas, "sql" to categorize inside SQLite or "incremental" to
+        only categorize the school/months that changed
+        sketch_error (float): if given, the python and incremental engines
+            take attendance cut points from quantile sketches with this rank
+            error
+    Returns: (dict) rows read and written, updates SQL database
+        school_access.sqlite3
     '''
-    Updates data
+    print("Updating reopening guidelines...")
+
+    def categorize(connection):
+        if sketch_error is not None:
+            result = CATEGORIZE_ENGINES[engine](connection,
+                                                sketch_error=sketch_error)
+        else:
+            result = CATEGORIZE_ENGINES[engine](connection)
+        tables = [reopening_guide.CATEGORIZED_TABLE]
+        if substring_index.create_search_table(connection):
+            tables.append(substring_index.SEARCH_TABLE)
+        return result, tables
+
+    result = build_staged(categorize)
+    print("Reopening guidelines updated")
+    return result
+
+
+def run_nyc_scripts():
+    '''
+    Runs the NYC script, which collects and cleans all NYC files when run.
+    '''
+    runpy.run_path('scrape_ny_schools.py')
+
+
+def data_files(filenames):
+    '''
+    Adds the data directory to a list of data filenames
+    '''
+    return [DATA_DIR + filename for filename in filenames]
+
+
+def update_stages(cities, force=False, engine="python", sketch_error=None):
+    '''
+    Lists the stages of the data update, with the files each one reads and
+    writes. The Chicago, NYC and LA stages only depend on each other through
+    the database build, so the pipeline runs the three cities at the same
+    time. Once the database is built, the map geometries are stored as WKB
+    and the common maps are pre-rendered for the web interface.
+
+    Inputs:
+        cities (lst): cities to collect and clean data for, from CITIES.
+            With no cities only the categorization is updated.
+        force (bool): rebuild every table even if its source is unchanged
+        engine (str): categorization engine, a key of CATEGORIZE_ENGINES
+        sketch_error (float): rank error of the attendance quantile sketches,
+            or None for exact attendance cut points
+    Returns: (lst) of Stage objects, in run order
+    '''
+    stages = []
+    if "chicago" in cities:
+        stages += [
+            Stage("chicago_covid", chicago_covid_clean.clean,
+                  data_files(["chicago_covid.csv"]),
+                  data_files(["chicago_covid_grouped.csv"])),
+            Stage("chicago_schools", chicago_geom_geopandas.schools_to_community,
+                  data_files(["Boundaries - ZIP Codes.geojson"]),
+                  data_files(["chicago_schools_with_community.csv"]),
+                  cacheable=False),
+            Stage("chicago_attendance", clean_chi_attendance.clean_attendance,
+                  data_files(["metrics_attendance_2019.xls"]),
+                  data_files(["chicago_attendance_clean.csv"]))]
+    if "nyc" in cities:
+        stages.append(
+            Stage("nyc", run_nyc_scripts, [],
+                  data_files(["nyc_schools.csv", "nyc_broadband.csv",
+                              "nyc_attendance.csv", "nyc_covid.csv",
+                              "nyc_modzcta.csv", "nyc_geo"]),
+                  cacheable=False))
+    if "la" in cities:
+        stages += [
+            Stage("la_scrape", scrape_la_schools.go, [],
+                  scrape_la_schools.FILENAMES, cacheable=False),
+            Stage("la_convert", convert_la_data.go,
+                  [convert_la_data.LA_SCHOOLS, convert_la_data.LA_BROADBAND],
+                  data_files(["la_schools.csv", "la_broadband.csv"])),
+            Stage("la_covid", clean_la_covid_data.go,
+                  data_files(["la_broadband.csv"]),
+                  data_files(["la_covid.csv"]), cacheable=False)]
+    if cities:
+        stages.append(Stage("build_db", build_db, data_files(FILENAMES),
+                            [DATABASE], (list(FILENAMES), force)))
+    stages.append(Stage("categorize", build_categorized, [DATABASE],
+                        [DATABASE], (engine, sketch_error)))
+    stages.append(Stage("geometry_store", create_map.build_geometry_store,
+                        data_files(filename for filename, _ in
+                                   create_map.GEOMETRY_LAYERS.values()),
+                        [GEOMETRY_STORE], (DATA_DIR, GEOMETRY_STORE)))
+    stages.append(Stage("prerender_maps", prerender_maps.go,
+                        [DATABASE, GEOMETRY_STORE],
+                        [prerender_maps.PRERENDER_DIR]))
+    return stages
+
+
+def run_update(cities, force=False, force_stages=(), only_stages=None,
+               report=None, engine="python", sketch_error=None):
+    '''
+    Runs the update pipeline for the given cities and builds a run report
+
+    Inputs:
+        cities (lst): cities to collect and clean data for, from CITIES
+        force (bool): rerun every stage and rebuild every table even if its
+            source is unchanged
+        force_stages (collection): names of stages to rerun even if their
+            inputs are unchanged
+        only_stages (collection): if given, run only these stages
+        report (dict): dict to fill in with the run report, so that it is
+            still available if the update fails
+        engine (str): categorization engine, a key of CATEGORIZE_ENGINES
+        sketch_error (float): rank error of the attendance quantile sketches,
+            or None for exact attendance cut points
+    Returns: (dict) run report with the wall time, per-stage measurements
+        and per-table load statistics
+    '''
+    if report is None:
+        report = {}
+    report.update({"started": datetime.now().isoformat(timespec="seconds"),
+                   "cities": list(cities), "engine": engine,
+                   "sketch_error": sketch_error, "stages": {}, "tables": []})
+    start = time.perf_counter()
+
+    force_tables = force or "build_db" in force_stages
+    stages = update_stages(cities, force_tables, engine, sketch_error)
+    if only_stages is not None:
+        stages = [stage for stage in stages if stage.name in only_stages]
+    force_stages = {stage.name for stage in stages} & set(force_stages)
+    try:
+        run_pipeline(stages, force=True if force else force_stages,
+                     report=report["stages"])
+        report["status"] = "ok"
+    except Exception as e:
+        report["status"] = "failed"
+        report["error"] = repr(e)
+        raise
+    finally:
+        report["wall_seconds"] = time.perf_counter() - start
+        report["peak_rss_kb"] = max(
+            [stage.get("peak_rss_kb", 0) for stage in report["stages"].values()]
+            + [peak_rss_kb()])
+        for stage in report["stages"].values():
+            report["tables"] += stage.get("tables", [])
+    return report
+
+
+def write_report(report, path=None):
+    '''
+    Writes a run report as JSON
+
+    Inputs:
+        report (dict): run report from run_update
+        path (str): file to write, defaults to a timestamped file in
+            REPORT_DIR
+    Returns: (str) path of the report
+    '''
+    if path is None:
+        os.makedirs(REPORT_DIR, exist_ok=True)
+        path = REPORT_DIR + "run_" + \
+            report["started"].replace(":", "").replace("-", "") + ".json"
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Run report written to {path}")
+    return path
+
+
+def go(restriction, force=False, force_stages=()):
+    '''
+    Updates data. Stages whose input files are unchanged since their last
+    successful run are skipped, so when only the covid files have changed
+    this does the same work as option 3.
+
     Inputs: restriction (int) depending on what user inputs, restricts what
         is updated
-    Returns: Nothing, updates data structures
-    '''
-    if restriction < 3:
-        clean_chicago_data()
-        runpy.run_path('scrape_ny_schools.py')
-        if restriction < 2:
-            print("Scraping LA schools and broadband data...")
-            scrape_la_schools.go()
-            print("Converting LA data into CSV files...")
-            convert_la_data.go()
-            print("Scraping and cleaning LA Covid data...")
-            clean_la_covid_data.go()
-        build_db(FILENAMES)
-    print("Updating reopening guidelines...")
-    reopening_guide.go()
-    build_db(["categorized_schools.csv"])
+        force (bool): rerun every stage and rebuild every table even if its
+            source is unchanged
+        force_stages (collection): names of stages to rerun even if their
+            inputs are unchanged
+    Returns: (dict) run report, updates data structures
+    '''
+    return run_update(OPTION_CITIES[restriction], force, force_stages)
 
 
 def retrieve_task():
@@ -122,17 +510,71 @@ def retrieve_task():
     return option
 
 
+def parse_args(args):
+    '''
+    Parses the command line
+
+    Inputs: args (lst): command line arguments, without the program name
+    Returns: argparse Namespace
+    '''
+    stage_names = [stage.name for stage in update_stages(CITIES)]
+    parser = argparse.ArgumentParser(
+        description="Update the school reopening data. With no --option, "
+                    "--cities, --stages or --report a menu is shown.")
+    parser.add_argument("delete", nargs="?", default="True",
+                        help=argparse.SUPPRESS)
+    parser.add_argument("--option", type=int, choices=list(OPTION_CITIES),
+                        help="run a menu option without prompting")
+    parser.add_argument("--cities", nargs="*", choices=CITIES,
+                        help="cities to update; none updates only the "
+                             "categorization")
+    parser.add_argument("--stages", nargs="+", choices=stage_names,
+                        metavar="STAGE", help="run only these stages")
+    parser.add_argument("--force", nargs="?", const=True, action="append",
+                        choices=stage_names, metavar="STAGE",
+                        help="rerun STAGE even if its inputs are unchanged, "
+                             "or everything if no stage is given")
+    parser.add_argument("--engine", choices=list(CATEGORIZE_ENGINES),
+                        default="python",
+                        help="categorize in pandas, inside SQLite, or "
+                             "incrementally (only changed school/months)")
+    parser.add_argument("--sketch-error", type=float, metavar="ERROR",
+                        help="take attendance cut points from quantile "
+                             "sketches with this rank error (e.g. 0.005)")
+    parser.add_argument("--report", metavar="PATH",
+                        help="where to write the JSON run report")
+    parsed = parser.parse_args(args)
+    if parsed.sketch_error is not None and parsed.engine == "sql":
+        parser.error("--sketch-error is not supported by the sql engine")
+    return parsed
+
+
 def main():
     '''
-    Launches selection on terminal
+    Launches selection on terminal, or runs the update straight away if
+    cities, stages or an option are given on the command line
     '''
-    delete = True
-    print(sys.argv)
-    if len(sys.argv) == 2:
-        if sys.argv[1] == "False":
-            delete = False
+    args = parse_args(sys.argv[1:])
+    delete = args.delete != "False"
+    force_args = args.force or []
+    force = True in force_args
+    force_stages = [stage for stage in force_args if stage is not True]
+
+    if args.option is not None or args.cities is not None or \
+            args.stages is not None or args.report is not None:
+        if args.cities is not None:
+            cities = args.cities
+        else:
+            cities = OPTION_CITIES[args.option or START]
+        report = {}
+        try:
+            run_update(cities, force, force_stages, args.stages, report,
+                       args.engine, args.sketch_error)
+        finally:
+            write_report(report, args.report)
+        return
 
-    cxt = DataUpdate(delete)
+    cxt = DataUpdate(delete, force=force, force_stages=force_stages)
     while True:
         option = retrieve_task()
         if option == 4:
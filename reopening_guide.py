@@ -6,6 +6,9 @@ import sqlite3
 import pandas as pd
 import numpy as np
 from statistics import mode
+from create_table import chunk_rows, create_indexes, register_functions, \
+    CHUNK_SIZE
+from quantile_sketch import KLLSketch
 
 ALL_COLS = ["Name", "Grade_Level", "Community", "Percent_Broadband",
             "Covid_Rates", "Attendance", "Year", "Month"]
@@ -28,6 +31,16 @@ COVID_DICT = {"LOW": "IN-PERSON", "MODERATE": {"ELEMENTARY SCHOOL": "IN-PERSON",
 ATTENDANCE_SUG = {"HIGH": "VIRTUAL", "MEDIUM": "HYBRID", "LOW": 
                  {"ELEMENTARY SCHOOL": "IN-PERSON", "MIDDLE SCHOOL": "HYBRID", 
                   "HIGH SCHOOL": "HYBRID", "UNKNOWN": "HYBRID"}}
+BROADBAND_SUG = {"LOW": {"ELEMENTARY SCHOOL": "IN-PERSON", "MIDDLE SCHOOL":
+                 "HYBRID", "HIGH SCHOOL": "HYBRID"}, "MEDIUM": "HYBRID",
+                 "HIGH": "VIRTUAL"}
+
+# Integer codes used by the vectorized engine; each list gives the label for
+# each code
+ACTIONS = ["IN-PERSON", "HYBRID", "VIRTUAL"]
+GRADES = ["ELEMENTARY SCHOOL", "MIDDLE SCHOOL", "HIGH SCHOOL"]
+COVID_CATS = ["LOW", "MODERATE", "SUBSTANTIAL", "HIGH"]
+LEVEL_CATS = ["LOW", "MEDIUM", "HIGH"]
 
 LA_Q = '''SELECT s.MPD_NAME as Name, s.MPD_DESC as Grade_Level,
           s.Neighborhood as Community, 
@@ -68,6 +81,45 @@ NY_Q = '''SELECT s.location_n as Name,
           AND s.modzcta=c.modzcta AND s.system_cod=a.dbn
           GROUP BY Name, month;'''
 
+CITY_QUERIES = {"LOS ANGELES": LA_Q, "CHICAGO": CHI_Q, "NEW YORK CITY": NY_Q}
+
+CATEGORIZED_TABLE = "categorized_schools"
+CATEGORIZED_COLS = {"Name": "nvarchar", "Grade_Level": "nvarchar",
+                    "Community": "nvarchar", "Percent_Broadband": "REAL",
+                    "Covid_Rates": "REAL", "Attendance": "REAL",
+                    "Year": "INTEGER", "Month": "INTEGER", "City": "nvarchar",
+                    "Grade_Level_Cat": "nvarchar",
+                    "Covid_Rates_Cat": "nvarchar",
+                    "Attendance_Cat": "nvarchar",
+                    "Suggested_Action": "nvarchar"}
+# Identifies a school/month in categorized_schools, and the columns whose
+# change means the row has to be categorized again
+CATEGORIZED_KEY = ["City", "Name", "Grade_Level", "Community", "Year",
+                   "Month"]
+CATEGORIZED_INPUTS = ["Percent_Broadband", "Covid_Rates", "Attendance"]
+# Columns the search form filters categorized_schools on, and the other
+# columns its results show. Each index starts with a rotation of the filters,
+# so any combination of them is a prefix of one index, and then holds the
+# results columns, so the search never reads the table itself.
+SEARCH_FILTERS = ["City", "Month", "Grade_Level_Cat"]
+SEARCH_RESULTS = ["Name", "Community", "Percent_Broadband", "Attendance",
+                  "Covid_Rates", "Year", "Suggested_Action"]
+CATEGORIZED_INDEXES = [tuple(SEARCH_FILTERS[i:] + SEARCH_FILTERS[:i] +
+                             SEARCH_RESULTS)
+                       for i in range(len(SEARCH_FILTERS))]
+# Attendance cut points, scale and limits each city was last categorized
+# with, and the static features of its schools they were computed from:
+# each distinct school, broadband and attendance with its number of months
+STATE_TABLE = "categorized_state"
+FEATURES_TABLE = "categorized_features"
+FEATURE_COLS = ["Name", "Grade_Level", "Community", "Percent_Broadband",
+                "Attendance"]
+# Temporary table an incremental run stages each city's rows in
+STAGED_TABLE = "staged_city"
+# Attendance quantile sketch of each city, when cut points come from sketches
+SKETCH_TABLE = "attendance_sketch"
+ATTENDANCE_SKETCH_ERROR = .005
+
 def collect_requests():
     '''
     Collects the data of the three cities from the SQL database
@@ -77,40 +129,85 @@ def collect_requests():
     '''
     connection = sqlite3.connect("school_access.sqlite3")
 
-    la_data = pd.read_sql_query(LA_Q, connection)
-    chi_data = pd.read_sql_query(CHI_Q, connection)
-    ny_data = pd.read_sql_query(NY_Q, connection)
+    la_data = collect_city(connection, "LOS ANGELES")
+    chi_data = collect_city(connection, "CHICAGO")
+    ny_data = collect_city(connection, "NEW YORK CITY")
     connection.close()
 
-    la_data["City"] = "LOS ANGELES"
-    chi_data["City"] = "CHICAGO"
-    ny_data["City"] = "NEW YORK CITY"
-
     return la_data, chi_data, ny_data
 
 
-def clean_data(data):
+def collect_city(connection, city):
+    '''
+    Collects the data of one city from the SQL database
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+    Returns: pandas dataframe with a City column
+    '''
+    data = pd.read_sql_query(CITY_QUERIES[city], connection)
+    data["City"] = city
+    return data
+
+
+def clean_data(data, limits=None):
     '''
     Cleans data to create uniformity between all three cities and prepare
-    for analysis
+    for analysis, in one pass over the columns with each column's statistics
+    computed once
     Inputs:
         data: Pandas dataframe
+        limits (tuple): lowest and highest uncleaned attendance of the whole
+            city, when data only holds some of its rows. Defaults to those
+            of data.
     Returns None, updates dataframe
     '''
     for col in ALL_COLS:
-        if col not in data.columns and col == "Year":
-            data["Year"] = 2020
-            data.loc[data["Month"] < 4, "Year"] = 2021
-        if data[col].dtype == "object":
-            data[col] = data[col].str.upper()
-        if col in NUMERIC_COLS and data[col].dtype not in ["int64", "float64"]:
-            data[col] = data[col].astype(float)
+        if col == "Year" and col not in data.columns:
+            data["Year"] = np.where(data["Month"] < 4, 2021, 2020)
+        values = data[col]
+        if values.dtype == "object":
+            values = values.str.upper()
+        if col in NUMERIC_COLS and values.dtype not in ["int64", "float64"]:
+            values = values.astype(float)
+        if col == "Attendance":
+            values = rescale_attendance(
+                values, limits if limits is not None else
+                attendance_limits(values))
+        if values is not data[col]:
+            data[col] = values
         if col == "Grade_Level":
-            data["Grade_Level_Cat"] = data["Grade_Level"].map(GL_DICT)
-        if col == "Attendance" and min(data[col]) < 0:
-            data[col] = data[col].apply(lambda x: .5 * (x - 
-                                        data[col].min()) / (data[col] \
-                                        .max() - data[col].min()) + .5)
+            data["Grade_Level_Cat"] = values.map(GL_DICT)
+
+
+def attendance_limits(values):
+    '''
+    Finds the lowest and highest uncleaned attendance, which clean_data
+    rescales attendance with when some of it is negative
+
+    Inputs: values (Pandas Series): uncleaned attendance
+    Returns: (tuple) of the lowest and highest value, NaN if there are none
+    '''
+    values = values.astype(float)
+    return values.min(), values.max()
+
+
+def rescale_attendance(values, limits):
+    '''
+    Puts attendance reported as a difference of rates, with negative values,
+    on a .5 to 1 scale
+
+    Inputs:
+        values (Pandas Series): uncleaned attendance
+        limits (tuple): lowest and highest uncleaned attendance of the city
+    Returns: (Pandas Series) rescaled attendance, or values if none of the
+        city's attendance is negative
+    '''
+    low, high = limits
+    if low < 0:
+        return .5 * (values - low) / (high - low) + .5
+    return values
 
 
 def categorize_covid(rate):
@@ -203,39 +300,752 @@ def create_tuple(row):
     return (covid_val, covid_val, broadband_val, grade_level_val, attend_val)
 
 
-def categorize_all(data):
+def rule_table(rules, categories):
+    '''
+    Turns one of the suggestion dictionaries into a lookup array
+
+    Inputs:
+        rules (dict): suggestion for each category, either an action or a
+            dictionary of actions by grade level
+        categories (lst): category labels, in code order
+    Returns:
+        (numpy array) action code for each [category code, grade code]
+    '''
+    table = np.empty((len(categories), len(GRADES)), dtype=np.int8)
+    for i, category in enumerate(categories):
+        for j, grade in enumerate(GRADES):
+            suggestion = rules[category]
+            if isinstance(suggestion, dict):
+                suggestion = suggestion[grade]
+            table[i, j] = ACTIONS.index(suggestion)
+    return table
+
+
+COVID_TABLE = rule_table(COVID_DICT, COVID_CATS)
+ATTENDANCE_TABLE = rule_table(ATTENDANCE_SUG, LEVEL_CATS)
+BROADBAND_TABLE = rule_table(BROADBAND_SUG, LEVEL_CATS)
+GRADE_TABLE = np.array([ACTIONS.index(GRADE_CV_SUG[grade])
+                        for grade in GRADES], dtype=np.int8)
+
+
+def covid_codes(rates):
+    '''
+    Vectorized categorize_covid, including its gaps: rates between 9 and 10,
+    negative rates and missing rates are all HIGH
+
+    Inputs: rates (numpy array): covid rates
+    Returns: (numpy array) COVID_CATS codes
+    '''
+    with np.errstate(invalid="ignore"):
+        return np.select([(rates >= 0) & (rates <= 9),
+                          (rates > 10) & (rates <= 49),
+                          (rates > 49) & (rates <= 99)], [0, 1, 2], 3)
+
+
+def quartile_codes(values, low, high):
+    '''
+    Vectorized categorize_column: LOW below the low cut point, MEDIUM up to
+    and including the high cut point, HIGH otherwise (including missing)
+
+    Inputs:
+        values (numpy array): values to categorize
+        low (float): 25th percentile cut point
+        high (float): 75th percentile cut point
+    Returns: (numpy array) LEVEL_CATS codes
+    '''
+    with np.errstate(invalid="ignore"):
+        return np.select([values < low, values <= high], [0, 1], 2)
+
+
+def broadband_codes(values):
+    '''
+    Vectorized suggest_broadband thresholds: LOW up to .8, MEDIUM between .8
+    and .9, HIGH otherwise (including missing)
+
+    Inputs: values (numpy array): broadband shares
+    Returns: (numpy array) LEVEL_CATS codes
+    '''
+    with np.errstate(invalid="ignore"):
+        return np.select([values <= .8, (values > .8) & (values < .9)],
+                         [0, 1], 2)
+
+
+def grade_codes(grade_levels):
+    '''
+    Codes the Grade_Level_Cat column
+
+    Inputs: grade_levels (Pandas Series): Grade_Level_Cat column
+    Returns: (numpy array) GRADES codes
+    '''
+    codes = pd.Categorical(grade_levels, categories=GRADES).codes
+    if (codes < 0).any():
+        unknown = grade_levels[codes < 0].astype(str).unique()
+        raise KeyError(f"No suggestion rules for grade level(s) {unknown}")
+    return codes
+
+
+def vote(votes):
+    '''
+    Picks the most common action in each row, breaking ties in favor of the
+    action that appears first in the row, as statistics.mode does
+
+    Inputs: votes (numpy array): action codes, one row per school/month
+    Returns: (numpy array) winning action code for each row
+    '''
+    n_votes = votes.shape[1]
+    scores = np.empty((votes.shape[0], len(ACTIONS)), dtype=np.int64)
+    for action in range(len(ACTIONS)):
+        matches = votes == action
+        first = np.where(matches.any(axis=1), matches.argmax(axis=1), n_votes)
+        scores[:, action] = matches.sum(axis=1) * (n_votes + 1) - first
+    return scores.argmax(axis=1)
+
+
+def suggestion_votes(covid, broadband, grade, attendance):
+    '''
+    Looks up each suggestion for every row, in the same order as
+    create_tuple: covid (twice), broadband, grade level and attendance
+
+    Inputs:
+        covid (numpy array): COVID_CATS codes
+        broadband (numpy array): LEVEL_CATS codes for broadband
+        grade (numpy array): GRADES codes
+        attendance (numpy array): LEVEL_CATS codes for attendance
+    Returns: (numpy array) of action codes with one column per vote
+    '''
+    covid_val = COVID_TABLE[covid, grade]
+    return np.column_stack([covid_val, covid_val,
+                            BROADBAND_TABLE[broadband, grade],
+                            GRADE_TABLE[grade],
+                            ATTENDANCE_TABLE[attendance, grade]])
+
+
+def categorize_rows(df):
+    '''
+    Original row-by-row categorization: builds a suggestion tuple per row
+    and takes its mode. Kept to check the vectorized engine against.
+
+    Inputs: df (Pandas Dataframe): cleaned data
+    Returns: None, adds the category and Suggested_Action columns
+    '''
+    df["Covid_Rates_Cat"] = df["Covid_Rates"].map(categorize_covid)
+    categorize_column(df, "Attendance")
+    suggestions = df.apply(create_tuple, axis=1)
+    df["Suggested_Action"] = suggestions.map(mode)
+
+
+def attendance_cuts(df):
+    '''
+    Finds the attendance cut points categorize_column uses
+
+    Inputs: df (Pandas Dataframe): cleaned data
+    Returns: (tuple) 25th and 75th percentiles of attendance
+    '''
+    info = df["Attendance"].describe()
+    return info["25%"], info["75%"]
+
+
+def sketch_cuts(sketch):
+    '''
+    Finds the attendance cut points from a quantile sketch of a city's
+    uncleaned attendance, rescaling them the way clean_data rescales
+    attendance with negative values
+
+    Inputs: sketch (KLLSketch): sketch of the uncleaned attendance
+    Returns: (tuple) 25th and 75th percentiles of the cleaned attendance,
+        within the sketch's rank error
+    '''
+    cuts = (sketch.quantile(.25), sketch.quantile(.75))
+    if sketch.n and sketch.min < 0:
+        cuts = tuple(.5 * (cut - sketch.min) / (sketch.max - sketch.min) + .5
+                     for cut in cuts)
+    return cuts
+
+
+def sketch_city(connection, city, error=ATTENDANCE_SKETCH_ERROR,
+                chunksize=CHUNK_SIZE):
+    '''
+    Sketches a city's uncleaned attendance, streaming it from the city
+    query in chunks so the whole column is never in memory
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+        error (float): normalized rank error of the sketch
+        chunksize (int): rows read at a time
+    Returns: (KLLSketch) the sketch
+    '''
+    sketch = KLLSketch.for_error(error)
+    query = CITY_QUERIES[city].strip().rstrip(";")
+    for chunk in pd.read_sql_query("SELECT Attendance FROM (" + query + ")",
+                                   connection, chunksize=chunksize):
+        sketch.update(chunk["Attendance"].astype(float))
+    return sketch
+
+
+def save_sketch(connection, city, sketch):
+    '''
+    Stores a city's attendance sketch alongside categorized_schools
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+        sketch (KLLSketch): sketch of the city's uncleaned attendance
+    '''
+    connection.execute("INSERT OR REPLACE INTO " + SKETCH_TABLE +
+                       " VALUES (?, ?, ?)",
+                       (city, sketch.rank_error(), sketch.to_json()))
+
+
+def load_sketch(connection, city):
+    '''
+    Loads a city's stored attendance sketch
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+    Returns: (KLLSketch) the sketch, or None if none is stored
+    '''
+    row = connection.execute("SELECT Sketch FROM " + SKETCH_TABLE +
+                             " WHERE City = ?", (city,)).fetchone()
+    return None if row is None else KLLSketch.from_json(row[0])
+
+
+def prepare_city(connection, df, sketch_error=None):
+    '''
+    Cleans one city's data and finds the attendance cut points and scale to
+    categorize it with
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection, where
+            the city's sketch is stored if one is built
+        df (Pandas Dataframe): uncleaned data of one city
+        sketch_error (float): if given, the cut points come from a quantile
+            sketch with this normalized rank error, streamed from the
+            database by sketch_city, instead of the exact percentiles of
+            the column
+    Returns: (tuple) attendance cut points, (int) attendance scale and
+        (tuple) attendance limits, see clean_data
+    '''
+    limits = attendance_limits(df["Attendance"])
+    if sketch_error is None:
+        clean_data(df, limits)
+        return attendance_cuts(df), attendance_scale(df), limits
+    sketch = sketch_city(connection, df["City"].iloc[0], sketch_error)
+    save_sketch(connection, df["City"].iloc[0], sketch)
+    clean_data(df, limits)
+    return sketch_cuts(sketch), attendance_scale(df), limits
+
+
+def categorize_vectorized(df, cuts=None):
+    '''
+    Columnar categorization: codes the categories and grade levels as
+    integers, looks the suggestions up in the rule tables and takes a
+    vectorized vote, giving the same result as categorize_rows
+
+    Inputs:
+        df (Pandas Dataframe): cleaned data
+        cuts (tuple): attendance cut points to use, defaults to the
+            attendance_cuts of df
+    Returns: None, adds the category and Suggested_Action columns
+    '''
+    if cuts is None:
+        cuts = attendance_cuts(df)
+    covid = covid_codes(df["Covid_Rates"].to_numpy(dtype=float))
+    attendance = quartile_codes(df["Attendance"].to_numpy(dtype=float),
+                                *cuts)
+    broadband = broadband_codes(df["Percent_Broadband"].to_numpy(dtype=float))
+    grade = grade_codes(df["Grade_Level_Cat"])
+    action = vote(suggestion_votes(covid, broadband, grade, attendance))
+
+    df["Covid_Rates_Cat"] = np.array(COVID_CATS, dtype=object)[covid]
+    df["Attendance_Cat"] = np.array(LEVEL_CATS, dtype=object)[attendance]
+    df["Suggested_Action"] = np.array(ACTIONS, dtype=object)[action]
+
+
+def attendance_scale(df):
+    '''
+    Some cities report attendance as a percentage and others as a share, so
+    attendance whose mean is 1 or more is taken to be a percentage
+
+    Inputs: df (Pandas Dataframe): cleaned data
+    Returns: (int) 100 if attendance is a percentage, 1 if a share
+    '''
+    return 100 if df.loc[:, "Attendance"].mean() >= 1 else 1
+
+
+def scale_percentages(df, scale=None):
+    '''
+    Puts Attendance on the same 0-1 scale as Percent_Broadband
+
+    Inputs:
+        df (Pandas Dataframe): categorized data
+        scale (int): 100 or 1, defaults to the attendance_scale of df
+    Returns: None, updates the dataframe
+    '''
+    if scale is None:
+        scale = attendance_scale(df)
+    if scale != 1:
+        df["Attendance"] = df["Attendance"] / scale
+
+
+def categorize_all(data, engine=categorize_vectorized):
     '''
     Categorizes all rows in each dataframe to create a suggested action based
-    off what is suggested in each suggestion tuple. Also cleans and categorizes
-    the data.
+    off what is suggested for covid, broadband, grade level and attendance.
+    Also cleans and categorizes the data.
 
     Inputs:
         data (tuple): tuple of dataframes
+        engine (function): categorize_vectorized, or categorize_rows for the
+            original row-by-row categorization
     
     Returns
         None, updates the dataframe
     '''
-    mode_np = np.vectorize(mode)
     for df in data:
-        clean_data(df)    
-        df["Covid_Rates_Cat"] = df["Covid_Rates"].map(categorize_covid)
-        categorize_column(df, "Attendance")
-        df["Suggestion_Tuple"] = df.apply(create_tuple, axis=1)
-        df["Suggested_Action"] = mode_np(df["Suggestion_Tuple"])
-        df.drop("Suggestion_Tuple", axis=1, inplace=True)
-        if df.loc[:, "Attendance"].mean() < 1:
-            df["Attendance"] = df["Attendance"].apply('{:,.2%}'.format)
+        clean_data(df)
+        engine(df)
+        scale_percentages(df)
+
+
+def create_categorized_table(connection):
+    '''
+    Drops and recreates the empty, typed categorized_schools table, along
+    with the empty tables of the state each city was categorized with, the
+    static features of its schools and its attendance sketch
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+    '''
+    connection.execute("DROP TABLE IF EXISTS " + CATEGORIZED_TABLE)
+    connection.execute("CREATE TABLE " + CATEGORIZED_TABLE + " (" +
+                       ", ".join(col + " " + coltype for col, coltype in
+                                 CATEGORIZED_COLS.items()) + ")")
+    for table in (STATE_TABLE, FEATURES_TABLE, SKETCH_TABLE):
+        connection.execute("DROP TABLE IF EXISTS " + table)
+    connection.execute("CREATE TABLE " + STATE_TABLE + " (City nvarchar "
+                       "PRIMARY KEY, Attendance_Low REAL, Attendance_High "
+                       "REAL, Attendance_Scale INTEGER, Attendance_Min REAL, "
+                       "Attendance_Max REAL, Sketch_Error REAL)")
+    # Untyped, so the features are stored exactly as the city queries
+    # return them and compare equal to them
+    connection.execute("CREATE TABLE " + FEATURES_TABLE + " (City, " +
+                       ", ".join(FEATURE_COLS) + ", Months)")
+    connection.execute("CREATE INDEX " + FEATURES_TABLE + "_name ON " +
+                       FEATURES_TABLE + " (City, Name)")
+    connection.execute("CREATE TABLE " + SKETCH_TABLE + " (City nvarchar "
+                       "PRIMARY KEY, Rank_Error REAL, Sketch nvarchar)")
+
+
+def read_state(connection):
+    '''
+    Reads the attendance cut points, scale and limits each city was last
+    categorized with
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+    Returns: (dict) mapping each city to a tuple of its cut points, its
+        scale, its limits and the rank error of its sketch (None if it has
+        none); empty if categorized_schools was not built by this module
+    '''
+    try:
+        rows = connection.execute(
+            "SELECT City, Attendance_Low, Attendance_High, Attendance_Scale, "
+            "Attendance_Min, Attendance_Max, Sketch_Error FROM " +
+            STATE_TABLE).fetchall()
+        for table in (FEATURES_TABLE, SKETCH_TABLE):
+            connection.execute("SELECT 1 FROM " + table + " LIMIT 0")
+    except sqlite3.OperationalError:
+        return {}
+    state = {}
+    for city, low, high, scale, low_limit, high_limit, error in rows:
+        # SQLite stores NaN as NULL
+        low, high, low_limit, high_limit = (
+            np.nan if value is None else value
+            for value in (low, high, low_limit, high_limit))
+        state[city] = ((low, high), scale, (low_limit, high_limit), error)
+    return state
+
+
+def record_state(connection, city, cuts, scale, limits, sketch_error=None):
+    '''
+    Records the attendance cut points, scale and limits a city was
+    categorized with
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+        cuts (tuple): attendance cut points
+        scale (int): attendance scale
+        limits (tuple): attendance limits, see clean_data
+        sketch_error (float): rank error of the sketch the cut points come
+            from, None if they are exact
+    '''
+    connection.execute("INSERT OR REPLACE INTO " + STATE_TABLE +
+                       " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                       (city, float(cuts[0]), float(cuts[1]), scale,
+                        float(limits[0]), float(limits[1]), sketch_error))
+
+
+def record_features(connection, city, source):
+    '''
+    Replaces the stored static features of a city's schools
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+        source (str): table or subquery holding the city's uncleaned rows
+    '''
+    cols = ", ".join(FEATURE_COLS)
+    connection.execute("DELETE FROM " + FEATURES_TABLE + " WHERE City = ?",
+                       (city,))
+    connection.execute("INSERT INTO " + FEATURES_TABLE + " SELECT ?, " +
+                       cols + ", COUNT(*) FROM " + source + " GROUP BY " +
+                       cols, (city,))
+
+
+def features_changed(connection, city, source):
+    '''
+    Compares the static features of a city's schools with the stored ones
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+        source (str): table or subquery holding the city's uncleaned rows
+    Returns: (bool) True if any school, broadband or attendance value, or
+        number of months, differs
+    '''
+    cols = ", ".join(FEATURE_COLS)
+    current = ("SELECT " + cols + ", COUNT(*) FROM " + source +
+               " GROUP BY " + cols)
+    stored = ("SELECT " + cols + ", Months FROM " + FEATURES_TABLE +
+              " WHERE City = ?")
+    return connection.execute(
+        "SELECT 1 FROM (" + current + " EXCEPT " + stored + ") UNION ALL "
+        "SELECT 1 FROM (" + stored + " EXCEPT " + current + ") LIMIT 1",
+        (city, city)).fetchone() is not None
+
+
+def merged_sketch(connection, city, source):
+    '''
+    Updates a city's stored attendance sketch with the rows added since the
+    static features of its schools were stored, merging in a sketch of the
+    added attendance
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+        source (str): table or subquery holding the city's uncleaned rows
+    Returns: (KLLSketch) the merged sketch, or None if the city has no
+        stored sketch or rows were removed or changed, so that it has to be
+        sketched again
+    '''
+    sketch = load_sketch(connection, city)
+    if sketch is None:
+        return None
+    cols = ", ".join(FEATURE_COLS)
+    same = " AND ".join(f"c.{col} IS f.{col}" for col in FEATURE_COLS)
+    connection.execute("DROP TABLE IF EXISTS temp.staged_features")
+    connection.execute("CREATE TEMP TABLE staged_features AS SELECT " + cols +
+                       ", COUNT(*) AS Months FROM " + source + " GROUP BY " +
+                       cols)
+    connection.execute("CREATE INDEX temp.staged_features_name ON "
+                       "staged_features (Name)")
+    removed = connection.execute(
+        "SELECT 1 FROM " + FEATURES_TABLE + " AS f WHERE f.City = ? AND NOT "
+        "EXISTS (SELECT 1 FROM temp.staged_features AS c WHERE " + same +
+        " AND c.Months >= f.Months) LIMIT 1", (city,)).fetchone()
+    added = None
+    if removed is None:
+        added = pd.read_sql_query(
+            "SELECT c.Attendance, c.Months - COALESCE((SELECT f.Months FROM " +
+            FEATURES_TABLE + " AS f WHERE f.City = ? AND " + same + "), 0) "
+            "AS Added FROM temp.staged_features AS c", connection,
+            params=(city,))
+    connection.execute("DROP TABLE temp.staged_features")
+    if added is None:
+        return None
+    new = KLLSketch(sketch.k)
+    new.update(np.repeat(added["Attendance"].astype(float).to_numpy(),
+                         added["Added"].to_numpy()))
+    return sketch.merge(new)
+
+
+def features_state(connection, city, sketch_error=None, sketch=None):
+    '''
+    Finds a city's attendance cut points, scale and limits from the stored
+    static features of its schools, without reading its rows
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+        sketch_error (float): if given, the cut points come from a quantile
+            sketch with this normalized rank error, which is stored
+        sketch (KLLSketch): the city's sketch, if it is already up to date;
+            otherwise the city is sketched again with sketch_city
+    Returns: (tuple) attendance cut points, (int) attendance scale and
+        (tuple) attendance limits, as prepare_city finds them
+    '''
+    features = pd.read_sql_query("SELECT Attendance, Months FROM " +
+                                 FEATURES_TABLE + " WHERE City = ?",
+                                 connection, params=(city,))
+    values = pd.Series(np.repeat(features["Attendance"].astype(float)
+                                 .to_numpy(), features["Months"].to_numpy()))
+    limits = attendance_limits(values)
+    df = pd.DataFrame({"Attendance": rescale_attendance(values, limits)})
+    if sketch_error is None:
+        cuts = attendance_cuts(df)
+    else:
+        if sketch is None:
+            sketch = sketch_city(connection, city, sketch_error)
+        save_sketch(connection, city, sketch)
+        cuts = sketch_cuts(sketch)
+    return tuple(float(cut) for cut in cuts), attendance_scale(df), limits
+
+
+def insert_categorized(connection, df):
+    '''
+    Inserts categorized rows into categorized_schools in chunks
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        df (Pandas Dataframe): categorized and scaled data
+    Returns: (int) number of rows inserted
+    '''
+    add_row_str = "INSERT INTO " + CATEGORIZED_TABLE + " (" + \
+                  ", ".join(CATEGORIZED_COLS) + ") VALUES (" + \
+                  ", ".join(["?"] * len(CATEGORIZED_COLS)) + ")"
+    rows = 0
+    for chunk in chunk_rows(df.loc[:, list(CATEGORIZED_COLS)]):
+        connection.executemany(add_row_str, chunk)
+        rows += len(chunk)
+    return rows
+
+
+def categorize_city(connection, df, cuts, scale):
+    '''
+    Categorizes cleaned rows of a city with the given cut points and scale
+    and inserts them
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        df (Pandas Dataframe): cleaned data of one city
+        cuts (tuple): attendance cut points of the whole city
+        scale (int): attendance scale of the whole city
+    Returns: (int) number of rows inserted
+    '''
+    categorize_vectorized(df, cuts)
+    scale_percentages(df, scale)
+    return insert_categorized(connection, df)
+
+
+def write_categorized(connection, sketch_error=None):
+    '''
+    Categorizes each city in turn and inserts it straight into a freshly
+    created categorized_schools table, so only one city is in memory at a
+    time and the numeric columns stay numeric. The search indexes are
+    created once the table is loaded.
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection, inside a
+            transaction managed by the caller
+        sketch_error (float): if given, attendance cut points come from
+            quantile sketches with this rank error, see prepare_city
+    Returns: (dict) number of rows read from the database and written out
+    '''
+    create_categorized_table(connection)
+    rows_read = 0
+    rows_written = 0
+    for city in CITY_QUERIES:
+        df = collect_city(connection, city)
+        rows_read += len(df)
+        if df.empty:
+            continue
+        cuts, scale, limits = prepare_city(connection, df, sketch_error)
+        rows_written += categorize_city(connection, df, cuts, scale)
+        record_state(connection, city, cuts, scale, limits, sketch_error)
+        record_features(connection, city, "(" +
+                        CITY_QUERIES[city].strip().rstrip(";") + ")")
+    create_indexes(connection, CATEGORIZED_TABLE, CATEGORIZED_INDEXES)
+    return {"rows_read": rows_read, "rows_written": rows_written}
+
+
+def stage_city(connection, city):
+    '''
+    Runs a city query into a temporary table, along with the key
+    categorized_schools stores each row under, indexed on that key
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection
+        city (str): key of CITY_QUERIES
+    Returns: (lst) the columns the city query returns
+    '''
+    register_functions(connection)
+    query = CITY_QUERIES[city].strip().rstrip(";")
+    columns = [col[0] for col in connection.execute(
+        "SELECT * FROM (" + query + ") LIMIT 0").description]
+    if "Year" in columns:
+        year = "Year"
+    else:
+        year = "CASE WHEN Month < 4 THEN 2021 ELSE 2020 END"
+    connection.execute("DROP TABLE IF EXISTS temp." + STAGED_TABLE)
+    connection.execute("CREATE TEMP TABLE " + STAGED_TABLE + " AS SELECT *, "
+                       "py_upper(Name) AS Key_Name, py_upper(Grade_Level) "
+                       "AS Key_Grade_Level, py_upper(Community) AS "
+                       "Key_Community, " + year + " AS Key_Year FROM (" +
+                       query + ")")
+    connection.execute("CREATE INDEX temp." + STAGED_TABLE + "_key ON " +
+                       STAGED_TABLE + " (Key_Name, Key_Grade_Level, "
+                       "Key_Community, Key_Year, Month)")
+    return columns
+
+
+def update_categorized(connection, sketch_error=None):
+    '''
+    Incrementally updates categorized_schools. Attendance and broadband are
+    static for the year, so a city whose schools have the same static
+    features as when it was last categorized keeps its stored cut points,
+    scale and limits, and only the rows whose covid rates (or other inputs)
+    changed, and the new school/months, are read, categorized and inserted;
+    the rows they replace and the school/months that no longer exist are
+    deleted. A city whose features changed has its cut points found from
+    them again, and is categorized again in full if they moved; with
+    sketches, a city that only gained rows merges a sketch of them into its
+    stored one rather than being sketched again.
+
+    Inputs:
+        connection (sqlite3 Connection): open database connection, inside a
+            transaction managed by the caller
+        sketch_error (float): if given, attendance cut points come from
+            quantile sketches with this rank error, see prepare_city
+    Returns: (dict) number of rows read from the database and written out
+    '''
+    state = read_state(connection)
+    if not state:
+        return write_categorized(connection, sketch_error)
+    staged = "temp." + STAGED_TABLE
+    key = ["Name", "Grade_Level", "Community", "Year"]
+    # A stored row is still current if a staged row has its key and,
+    # cleaned the way clean_data cleans it, its inputs
+    same_row = " AND ".join(
+        [f"o.{col} IS s.Key_{col}" for col in key] + [
+            "o.Month IS s.Month",
+            "o.Percent_Broadband IS CAST(s.Percent_Broadband AS REAL)",
+            "o.Covid_Rates IS CAST(s.Covid_Rates AS REAL)",
+            "o.Attendance IS (CASE WHEN :low < 0 THEN .5 * "
+            "(CAST(s.Attendance AS REAL) - :low) / (:high - :low) + .5 "
+            "ELSE CAST(s.Attendance AS REAL) END) / :scale"])
+    rows_read = 0
+    rows_written = 0
+    for city in CITY_QUERIES:
+        columns = stage_city(connection, city)
+        if connection.execute("SELECT 1 FROM " + staged +
+                              " LIMIT 1").fetchone() is None:
+            for table in (CATEGORIZED_TABLE, STATE_TABLE, FEATURES_TABLE,
+                          SKETCH_TABLE):
+                connection.execute("DELETE FROM " + table + " WHERE City = ?",
+                                   (city,))
+            continue
+
+        old = state.get(city)
+        if old is None or old[3] != sketch_error or \
+                features_changed(connection, city, staged):
+            sketch = None
+            if old is not None and sketch_error is not None and \
+                    old[3] == sketch_error:
+                sketch = merged_sketch(connection, city, staged)
+            record_features(connection, city, staged)
+            cuts, scale, limits = features_state(connection, city,
+                                                 sketch_error, sketch)
+            if sketch_error is None:
+                connection.execute("DELETE FROM " + SKETCH_TABLE +
+                                   " WHERE City = ?", (city,))
+            categorize_all_rows = old is None or (cuts, scale) != old[:2]
         else:
-            df["Attendance"] = df["Attendance"].apply('{}%'.format)
-        df["Percent_Broadband"] = df["Percent_Broadband"].apply('{:,.2%}'.format)
+            cuts, scale, limits = old[:3]
+            categorize_all_rows = False
+        record_state(connection, city, cuts, scale, limits, sketch_error)
+        categorize_all_rows = categorize_all_rows or any(
+            connection.execute(
+                "SELECT 1 FROM " + table + " WHERE " + where + " GROUP BY " +
+                cols + " HAVING COUNT(*) > 1 LIMIT 1", params).fetchone()
+            for table, where, cols, params in [
+                (staged, "1", "Key_Name, Key_Grade_Level, Key_Community, "
+                 "Key_Year, Month", ()),
+                (CATEGORIZED_TABLE, "City = ?",
+                 ", ".join(CATEGORIZED_KEY), (city,))])
 
+        if categorize_all_rows:
+            connection.execute("DELETE FROM " + CATEGORIZED_TABLE +
+                               " WHERE City = ?", (city,))
+            df = pd.read_sql_query("SELECT " + ", ".join(columns) +
+                                   " FROM " + staged, connection)
+            df["City"] = city
+            rows_read += len(df)
+            clean_data(df, limits)
+            rows_written += categorize_city(connection, df, cuts, scale)
+            print(f"{city}: categorized all {len(df)} rows")
+            continue
 
-def go():
+        params = {"low": limits[0], "high": limits[1], "scale": scale}
+        connection.execute("DROP TABLE IF EXISTS temp.stored_city")
+        connection.execute("CREATE TEMP TABLE stored_city AS SELECT rowid AS "
+                           "Row_Id, " + ", ".join(CATEGORIZED_KEY +
+                                                  CATEGORIZED_INPUTS) +
+                           " FROM " + CATEGORIZED_TABLE + " WHERE City = ?",
+                           (city,))
+        connection.execute("CREATE INDEX temp.stored_city_key ON "
+                           "stored_city (" + ", ".join(key) + ", Month)")
+        removed = connection.execute(
+            "DELETE FROM " + CATEGORIZED_TABLE + " WHERE rowid IN (SELECT "
+            "o.Row_Id FROM temp.stored_city AS o WHERE NOT EXISTS (SELECT 1 "
+            "FROM " + staged + " AS s WHERE " + same_row + "))",
+            params).rowcount
+        changed = pd.read_sql_query(
+            "SELECT " + ", ".join("s." + col for col in columns) + " FROM " +
+            staged + " AS s WHERE NOT EXISTS (SELECT 1 FROM temp.stored_city "
+            "AS o WHERE " + same_row + ")", connection, params=params)
+        connection.execute("DROP TABLE temp.stored_city")
+        rows_read += len(changed)
+        if len(changed):
+            changed["City"] = city
+            clean_data(changed, limits)
+            rows_written += categorize_city(connection, changed, cuts, scale)
+        print(f"{city}: categorized {len(changed)} changed rows, removed "
+              f"{removed} outdated rows")
+    connection.execute("DROP TABLE IF EXISTS " + staged)
+    create_indexes(connection, CATEGORIZED_TABLE, CATEGORIZED_INDEXES)
+    return {"rows_read": rows_read, "rows_written": rows_written}
+
+
+def go(connection=None, incremental=False, sketch_error=None):
     '''
-    Creates one large CSV file of the three cities containing necessary columns
-    and the final suggested action.
+    Creates the categorized_schools table of the three cities containing
+    necessary columns and the final suggested action.
+
+    Inputs:
+        connection (sqlite3 Connection): open connection inside a
+            transaction managed by the caller. If None, school_access.sqlite3
+            is updated in a transaction of its own.
+        incremental (bool): True to only categorize the rows that changed
+            since the last run, see update_categorized
+        sketch_error (float): if given, attendance cut points come from
+            quantile sketches with this rank error, see prepare_city
+    Returns: (dict) number of rows read from the database and written out
     '''
-    (la, chi, ny) = collect_requests()
-    categorize_all((la, chi, ny))
-    categories = la.append(chi, ignore_index=True).append(ny, ignore_index=True)
-    categories.to_csv("data/categorized_schools.csv", index=False)
\ No newline at end of file
+    write = update_categorized if incremental else write_categorized
+    if connection is not None:
+        return write(connection, sketch_error)
+    connection = sqlite3.connect("school_access.sqlite3")
+    try:
+        connection.execute("BEGIN")
+        result = write(connection, sketch_error)
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+    return result
+
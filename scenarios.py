@@ -0,0 +1,253 @@
+'''
+What-if scenario sweeps over the reopening guide thresholds
+
+A scenario changes any of the thresholds and vote weights in
+DEFAULT_SCENARIO, which reproduces reopening_guide exactly. Every scenario
+in a batch is evaluated against every school/month of each city in one
+NumPy pass:
+
+  - rows are grouped by their (covid rate, broadband, grade level), which
+    fix every suggestion but the attendance one
+  - for every scenario and group, the rows falling in each attendance
+    category are counted by binary search against the scenario's cut points
+  - each scenario's categories, suggestions and vote are computed once per
+    group and attendance category, for all scenarios at once, and the row
+    counts are summed by suggested action
+'''
+import numpy as np
+import pandas as pd
+import reopening_guide as rg
+
+DEFAULT_SCENARIO = {
+    # covid rates from 0 up to covid_low are LOW, above covid_moderate_from
+    # up to covid_moderate MODERATE, above that up to covid_substantial
+    # SUBSTANTIAL, anything else HIGH (categorize_covid's rates between 9
+    # and 10 fall through to HIGH)
+    "covid_low": 9, "covid_moderate_from": 10, "covid_moderate": 49,
+    "covid_substantial": 99,
+    # broadband up to broadband_low is LOW, below broadband_high MEDIUM
+    "broadband_low": .8, "broadband_high": .9,
+    # attendance below this quantile of the city is LOW, up to the high
+    # quantile MEDIUM
+    "attendance_low": .25, "attendance_high": .75,
+    # votes for each suggestion; the covid suggestion counts twice
+    "covid_weight": 2, "broadband_weight": 1, "grade_weight": 1,
+    "attendance_weight": 1}
+CHUNK_SIZE = 2000
+
+
+def scenario_arrays(scenarios):
+    '''
+    Fills in each scenario from DEFAULT_SCENARIO and lays the parameters out
+    as arrays
+
+    Inputs: scenarios (lst): list of dicts of parameters to change
+    Returns: (dict) mapping each parameter to an array with one value per
+        scenario
+    '''
+    for scenario in scenarios:
+        unknown = set(scenario) - set(DEFAULT_SCENARIO)
+        if unknown:
+            raise KeyError(f"Unknown scenario parameter(s) {sorted(unknown)}")
+    return {key: np.array([scenario.get(key, default)
+                           for scenario in scenarios], dtype=float)
+            for key, default in DEFAULT_SCENARIO.items()}
+
+
+def covid_categories(rates, params):
+    '''
+    Vectorized categorize_covid for every scenario
+
+    Inputs:
+        rates (numpy array): covid rates, shape (groups,)
+        params (dict): scenario parameter arrays, shape (scenarios,)
+    Returns: (numpy array) COVID_CATS codes, shape (scenarios, groups)
+    '''
+    rate = rates[None, :]
+    low = params["covid_low"][:, None]
+    moderate_from = params["covid_moderate_from"][:, None]
+    moderate = params["covid_moderate"][:, None]
+    substantial = params["covid_substantial"][:, None]
+    with np.errstate(invalid="ignore"):
+        return np.select([(rate >= 0) & (rate <= low),
+                          (rate > moderate_from) & (rate <= moderate),
+                          (rate > moderate) & (rate <= substantial)],
+                         [0, 1, 2], 3)
+
+
+def broadband_categories(values, low, high):
+    '''
+    Vectorized suggest_broadband thresholds for every scenario: LOW up to the
+    low cut point, MEDIUM below the high cut point, HIGH otherwise
+    (including missing)
+
+    Inputs:
+        values (numpy array): broadband shares, shape (groups,)
+        low (numpy array): low cut point per scenario
+        high (numpy array): high cut point per scenario
+    Returns: (numpy array) LEVEL_CATS codes, shape (scenarios, groups)
+    '''
+    value = values[None, :]
+    low = low[:, None]
+    high = high[:, None]
+    with np.errstate(invalid="ignore"):
+        return np.select([value <= low, (value > low) & (value < high)],
+                         [0, 1], 2)
+
+
+def weighted_vote(votes, weights):
+    '''
+    Picks the action with the most weight for each scenario and group,
+    breaking ties in favor of the suggestion listed first (covid, broadband,
+    grade level, attendance), as statistics.mode does
+
+    Inputs:
+        votes (lst): action codes for each suggestion, shape
+            (scenarios, groups)
+        weights (lst): weight of each suggestion per scenario, shape
+            (scenarios,)
+    Returns: (numpy array) winning action codes, shape (scenarios, groups)
+    '''
+    totals = []
+    firsts = []
+    for action in range(len(rg.ACTIONS)):
+        total = np.zeros(votes[0].shape)
+        first = np.full(votes[0].shape, len(votes))
+        for position in reversed(range(len(votes))):
+            matches = votes[position] == action
+            total += matches * weights[position][:, None]
+            first[matches] = position
+        totals.append(total)
+        firsts.append(first)
+    totals = np.stack(totals)
+    firsts = np.stack(firsts)
+    firsts[totals < totals.max(axis=0)] = len(votes) + 1
+    return firsts.argmin(axis=0)
+
+
+def attendance_counts(attendance, group, n_groups, low, high):
+    '''
+    Counts the rows of each group below each scenario's low attendance cut
+    point and up to its high cut point, by binary search over the
+    attendance values sorted within each group
+
+    Inputs:
+        attendance (numpy array): attendance of each row
+        group (numpy array): group of each row
+        n_groups (int): number of groups
+        low (numpy array): low cut point per scenario
+        high (numpy array): high cut point per scenario
+    Returns:
+        (numpy array) rows below the low cut point and (numpy array) rows up
+        to the high cut point, each of shape (scenarios, groups)
+    '''
+    # Rank the attendance values so that the group and rank fit one sort key;
+    # missing attendance ranks above everything, so it is always HIGH
+    values = np.unique(attendance[~np.isnan(attendance)])
+    ranks = np.searchsorted(values, attendance)
+    ranks[np.isnan(attendance)] = len(values)
+    stride = len(values) + 1
+    keys = np.sort(group * stride + ranks)
+    starts = np.searchsorted(keys, np.arange(n_groups) * stride)
+
+    groups = np.arange(n_groups)[None, :] * stride
+    with np.errstate(invalid="ignore"):
+        low_rank = np.searchsorted(values, low, side="left")
+        high_rank = np.searchsorted(values, high, side="right")
+    # A missing cut point (a city without attendance) matches no rows
+    low_rank[np.isnan(low)] = 0
+    high_rank[np.isnan(high)] = 0
+    below = np.searchsorted(keys, groups + low_rank[:, None]) - starts
+    up_to = np.searchsorted(keys, groups + high_rank[:, None]) - starts
+    return below, up_to
+
+
+def city_distribution(df, params):
+    '''
+    Counts the suggested actions of one city under every scenario
+
+    Inputs:
+        df (Pandas DataFrame): cleaned city data
+        params (dict): scenario parameter arrays
+    Returns: (numpy array) number of school/months suggested each action,
+        shape (scenarios, actions)
+    '''
+    attendance = df["Attendance"].to_numpy(dtype=float)
+    features = pd.DataFrame({"covid": df["Covid_Rates"].to_numpy(dtype=float),
+                             "broadband": df["Percent_Broadband"]
+                                          .to_numpy(dtype=float),
+                             "grade": rg.grade_codes(df["Grade_Level_Cat"])})
+    groups = features.groupby(["covid", "broadband", "grade"], dropna=False,
+                              sort=False)
+    group = groups.ngroup().to_numpy()
+    keys = groups.size().index.to_frame(index=False)
+    sizes = groups.size().to_numpy()
+    grade = keys["grade"].to_numpy()
+
+    # Attendance cut points are quantiles of the city's attendance, computed
+    # the way pandas' describe() does
+    present = attendance[~np.isnan(attendance)]
+    if len(present):
+        low = np.quantile(present, params["attendance_low"])
+        high = np.quantile(present, params["attendance_high"])
+    else:
+        low = high = np.full(len(params["attendance_low"]), np.nan)
+    below, up_to = attendance_counts(attendance, group, len(sizes), low, high)
+    level_counts = [below, up_to - below, sizes[None, :] - up_to]
+
+    covid_cat = covid_categories(keys["covid"].to_numpy(), params)
+    broadband_cat = broadband_categories(keys["broadband"].to_numpy(),
+                                         params["broadband_low"],
+                                         params["broadband_high"])
+    shape = covid_cat.shape
+    weights = [params["covid_weight"], params["broadband_weight"],
+               params["grade_weight"], params["attendance_weight"]]
+    fixed_votes = [rg.COVID_TABLE[covid_cat, grade],
+                   rg.BROADBAND_TABLE[broadband_cat, grade],
+                   np.broadcast_to(rg.GRADE_TABLE[grade], shape)]
+
+    totals = np.zeros((len(params["covid_weight"]), len(rg.ACTIONS)),
+                      dtype=np.int64)
+    for level, counts in enumerate(level_counts):
+        attendance_vote = np.broadcast_to(rg.ATTENDANCE_TABLE[level, grade],
+                                          shape)
+        action = weighted_vote(fixed_votes + [attendance_vote], weights)
+        for code in range(len(rg.ACTIONS)):
+            totals[:, code] += np.where(action == code, counts, 0).sum(axis=1)
+    return totals
+
+
+def evaluate_scenarios(scenarios, data=None, chunk_size=CHUNK_SIZE):
+    '''
+    Evaluates a batch of threshold and weight scenarios against every
+    school/month of each city
+
+    Inputs:
+        scenarios (lst): list of dicts of DEFAULT_SCENARIO parameters to
+            change, {} for the current rules
+        data (tuple): tuple of dataframes, defaults to the three cities in
+            the database; cleaned with clean_data if not already
+        chunk_size (int): number of scenarios evaluated per pass, which
+            bounds memory use
+    Returns: (Pandas DataFrame) one row per scenario and city with the number
+        of school/months suggested each action
+    '''
+    if data is None:
+        data = rg.collect_requests()
+    for df in data:
+        if "Grade_Level_Cat" not in df.columns:
+            rg.clean_data(df)
+
+    results = []
+    for df in data:
+        city = df["City"].iloc[0]
+        counts = np.concatenate([
+            city_distribution(df, scenario_arrays(
+                scenarios[start:start + chunk_size]))
+            for start in range(0, len(scenarios), chunk_size)])
+        result = pd.DataFrame(counts, columns=rg.ACTIONS)
+        result.insert(0, "City", city)
+        result.insert(0, "Scenario", range(len(scenarios)))
+        results.append(result)
+    return pd.concat(results, ignore_index=True) \
+             .sort_values(["Scenario", "City"], ignore_index=True)
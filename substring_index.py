@@ -0,0 +1,184 @@
+'''
+Substring search over the school and community names of the categorized
+schools, shared by the map (create_map) and the results table
+(ui/query_schools) so that both match the same schools
+
+The build stores the distinct names in an FTS5 table with the trigram
+tokenizer, next to categorized_schools. A search of three or more characters
+is a phrase query on that table, which finds the names containing the text
+through the index; shorter searches check the few thousand names directly.
+Names starting with the search come first, then the rest by bm25 rank. For a
+database built without the table, the names are indexed by their trigrams in
+memory instead. Either way user input is only compared as plain text: no
+regex or LIKE pattern is built from it.
+'''
+import sqlite3
+from functools import lru_cache
+from create_table import register_functions
+
+NGRAM = 3
+CATEGORIZED_TABLE = "categorized_schools"
+SEARCH_TABLE = "categorized_search"
+# Columns of categorized_schools the text filters search
+TEXT_COLS = ("Name", "Community")
+
+
+def normalize(text):
+    '''
+    Normalizes a name or search text the way both are compared
+
+    Inputs: text (str): the text
+    Returns: (str) upper-cased text without surrounding whitespace
+    '''
+    return str(text).strip().upper()
+
+
+def ngrams(text, n=NGRAM):
+    '''
+    Returns: (set) of the n-character substrings of a normalized text
+    '''
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+class SubstringIndex:
+    '''
+    Class describing an n-gram inverted index over a set of names
+    '''
+    def __init__(self, values, n=NGRAM):
+        '''
+        Inputs:
+            values (iterable): names to index; None values are skipped
+            n (int): length of the indexed substrings
+        '''
+        self.n = n
+        self.values = sorted({value for value in values if value is not None})
+        self.normalized = [normalize(value) for value in self.values]
+        self.postings = {}
+        for i, name in enumerate(self.normalized):
+            for gram in ngrams(name, n):
+                self.postings.setdefault(gram, set()).add(i)
+
+    def search(self, text):
+        '''
+        Finds the names containing a text, ignoring case
+
+        Inputs: text (str): text to search for
+        Returns: (lst) of the matching names, as given to the index
+        '''
+        text = normalize(text)
+        if len(text) < self.n:
+            candidates = range(len(self.values))
+        else:
+            postings = sorted((self.postings.get(gram, set())
+                               for gram in ngrams(text, self.n)), key=len)
+            candidates = sorted(set.intersection(*postings))
+        return [self.values[i] for i in candidates
+                if text in self.normalized[i]]
+
+
+def create_search_table(connection):
+    '''
+    Builds the FTS5 search table of the distinct values of each of TEXT_COLS
+    in categorized_schools, replacing any earlier one
+
+    Inputs:
+        connection (sqlite3 Connection): connection to the database being
+            built
+    Returns: (bool) True if the table was built, False if this SQLite has
+        no FTS5 trigram tokenizer (3.34 or later is needed)
+    '''
+    connection.execute("DROP TABLE IF EXISTS " + SEARCH_TABLE)
+    try:
+        connection.execute("CREATE VIRTUAL TABLE " + SEARCH_TABLE +
+                           " USING fts5(value, col UNINDEXED,"
+                           " tokenize='trigram')")
+    except sqlite3.OperationalError as e:
+        print(f"No {SEARCH_TABLE} table, searches will be indexed in "
+              f"memory: {e}")
+        return False
+    for col in TEXT_COLS:
+        connection.execute("INSERT INTO " + SEARCH_TABLE + " (value, col) "
+                           "SELECT DISTINCT " + col + ", ? FROM " +
+                           CATEGORIZED_TABLE + " WHERE " + col +
+                           " IS NOT NULL", (col,))
+    return True
+
+
+class NameSearch:
+    '''
+    Class describing the school and community search of a database build
+    '''
+    def __init__(self, database, use_fts=True):
+        '''
+        Inputs:
+            database (str): path of the database
+            use_fts (bool): search the FTS5 table if the database has one,
+                rather than indexing the names in memory
+        '''
+        self.database = database
+        self.indexes = None
+        connection = sqlite3.connect(database)
+        self.fts = use_fts and connection.execute(
+            "SELECT 1 FROM sqlite_master WHERE name = ?",
+            (SEARCH_TABLE,)).fetchone() is not None
+        if not self.fts:
+            self.indexes = {}
+            for col in TEXT_COLS:
+                rows = connection.execute("SELECT DISTINCT " + col +
+                                          " FROM " + CATEGORIZED_TABLE)
+                self.indexes[col] = SubstringIndex(row[0] for row in rows)
+        connection.close()
+
+    def search(self, col, text, connection=None):
+        '''
+        Finds the values of a column containing a text, ignoring case
+
+        Inputs:
+            col (str): one of TEXT_COLS
+            text (str): text to search for
+            connection (sqlite3 Connection): connection to the database to
+                use, if one is open
+        Returns: (lst) of the matching values, best first
+        '''
+        text = normalize(text)
+        if not self.fts:
+            matches = self.indexes[col].search(text)
+            return sorted(matches,
+                          key=lambda value: not normalize(value)
+                          .startswith(text))
+
+        close = connection is None
+        if close:
+            connection = sqlite3.connect(self.database)
+        register_functions(connection)
+        if len(text) >= NGRAM:
+            rows = connection.execute(
+                "SELECT value FROM " + SEARCH_TABLE + " WHERE " +
+                SEARCH_TABLE + " MATCH ? AND col = ? "
+                "ORDER BY instr(py_upper(value), ?) = 1 DESC, rank, value",
+                ('"' + text.replace('"', '""') + '"', col, text))
+        else:
+            rows = connection.execute(
+                "SELECT value FROM " + SEARCH_TABLE + " WHERE col = ? "
+                "AND instr(py_upper(value), ?) > 0 "
+                "ORDER BY instr(py_upper(value), ?) = 1 DESC, value",
+                (col, text, text))
+        matches = [row[0] for row in rows]
+        if close:
+            connection.close()
+        return matches
+
+
+@lru_cache(maxsize=1)
+def load_search(database, version):
+    '''
+    Sets up the search of a database build. Only the latest build is kept,
+    for the life of the process.
+
+    Inputs:
+        database (str): path of the database
+        version (str): identifies the build, so that a rebuilt database is
+            searched afresh
+    Returns: (NameSearch) the search
+    '''
+    return NameSearch(database)
@@ -0,0 +1,138 @@
+'''
+Fixtures shared by the pipeline tests: a small, deterministic set of source
+files for the three cities, laid out the way the pipeline expects them, and
+databases built from it
+'''
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(1, os.path.join(ROOT, "ui"))
+
+SCHOOLS = 40
+AREAS = 8
+MONTHS = [(2020, month) for month in range(4, 13)] + \
+         [(2021, month) for month in range(1, 4)]
+
+
+def write_sources(data_dir, seed=0):
+    '''
+    Writes the source files build_db loads, for SCHOOLS schools per city
+    spread over AREAS neighborhoods
+
+    Inputs:
+        data_dir (str): directory to write the files to
+        seed (int): seed of the random values
+    '''
+    rng = np.random.default_rng(seed)
+    os.makedirs(data_dir, exist_ok=True)
+    schools = range(SCHOOLS)
+    areas = range(AREAS)
+    covid = [5, 9.5, 10, 30, 49, 70, 99, 150]
+
+    def write(filename, df):
+        df.to_csv(os.path.join(data_dir, filename), index=False)
+
+    def point():
+        return f"POINT ({rng.uniform(0, 10):.4f} {rng.uniform(0, 10):.4f})"
+
+    hoods = [f"Hood {i}" for i in areas]
+    write("la_schools.csv", pd.DataFrame({
+        "Unnamed: 0": schools,
+        "MPD_NAME": [f"La School (#{i}) St. + {i}" for i in schools],
+        "MPD_DESC": [["ELEMENTARY", "MIDDLE SCHOOL", "HIGH SCHOOL",
+                      "K-8"][i % 4] for i in schools],
+        "Neighborhood": [hoods[i % AREAS] for i in schools],
+        "CDSCODE": [1000 + i for i in schools],
+        "geometry": [point() for _ in schools]}))
+    write("la_broadband.csv", pd.DataFrame({
+        "Unnamed: 0": areas, "Name": hoods,
+        "Has_PC_and_Broadband": rng.uniform(.6, 1, AREAS).round(3),
+        "geometry": ["POINT (0 0)"] * AREAS}))
+    write("la_covid.csv", pd.DataFrame(
+        [{"Community": hood, "Covid_Rates": float(rng.choice(covid)),
+          "year": year, "month": month}
+         for hood in hoods for year, month in MONTHS + [(2020, 3)]]))
+    write("LA_Chronic_Absence_Rates.csv", pd.DataFrame({
+        "CDSCode": [1000 + i for i in schools],
+        "ChronicAbsenceRate": rng.uniform(0, 60, SCHOOLS).round(1)}))
+    write("LA_Excellent_Attendance.csv", pd.DataFrame({
+        "CDSCode": [1000 + i for i in schools],
+        "PercentExcellentAttendance": rng.uniform(0, 60, SCHOOLS).round(1)}))
+
+    zips = [60600 + i for i in areas]
+    write("chicago_schools_with_community.csv", pd.DataFrame({
+        "Unnamed: 0": schools,
+        "long_name": [f"Chi School {i}" for i in schools],
+        "is_high_school": [i % 3 == 0 for i in schools],
+        "is_elementary_school": [i % 3 == 1 for i in schools],
+        "is_middle_school": [False] * SCHOOLS,
+        "community": [f"COMM {i % AREAS}" for i in schools],
+        "zip": [zips[i % AREAS] for i in schools],
+        "school_id": [5000 + i for i in schools]}))
+    write("chicago_broadband.csv", pd.DataFrame({
+        "community_area": [f"COMM {i}" for i in areas],
+        "percent_children_no_broadband": rng.uniform(0, .4, AREAS).round(3)}))
+    write("chicago_covid_grouped.csv", pd.DataFrame(
+        [{"month": month, "ZIP": zip_code,
+          "Avg_Monthly_Case_Rate": float(rng.choice(covid))}
+         for month in range(1, 13) for zip_code in zips]))
+    write("chicago_attendance_clean.csv", pd.DataFrame({
+        "Unnamed: 0": schools, "school_id": [5000 + i for i in schools],
+        "attendance_2019": rng.uniform(85, 98, SCHOOLS).round(2)}))
+
+    modzctas = [10001 + i for i in areas]
+    write("nyc_schools.csv", pd.DataFrame({
+        "Unnamed: 0": schools, "location_n": [f"Ps {i}" for i in schools],
+        "location_1": [["Elementary", "High school", "K-8",
+                        "Secondary School"][i % 4] for i in schools],
+        "nta_name": [f"NTA {i % AREAS}" for i in schools],
+        "modzcta": [modzctas[i % AREAS] for i in schools],
+        "system_cod": [f"D{i}" for i in schools]}))
+    write("nyc_broadband.csv", pd.DataFrame({
+        "MODZCTA": modzctas,
+        "home_broadband_adoption": rng.uniform(.6, 1, AREAS).round(3)}))
+    write("nyc_covid.csv", pd.DataFrame(
+        [{"modzcta": modzcta, "case_rate_100k": float(rng.choice(covid)),
+          "year": year, "month": month}
+         for modzcta in modzctas for year, month in MONTHS]))
+    write("nyc_attendance.csv", pd.DataFrame({
+        "dbn": [f"D{i}" for i in schools],
+        "attendance": rng.uniform(.8, .98, SCHOOLS).round(3)}))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    '''
+    A directory holding the fixture source files in data/, made the working
+    directory so that the pipeline reads and writes there
+    '''
+    write_sources(str(tmp_path / "data"))
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def built_db(workdir):
+    '''
+    Path of a school_access.sqlite3 built from the fixture source files
+    '''
+    import reopening
+    reopening.build_db(list(reopening.FILENAMES), force=True)
+    return str(workdir / reopening.DATABASE)
+
+
+
+@pytest.fixture
+def categorized_db(built_db):
+    '''
+    Path of a fixture database that has been built and categorized
+    '''
+    import reopening
+    reopening.build_categorized()
+    return built_db
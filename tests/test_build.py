@@ -0,0 +1,89 @@
+'''
+Tests of the staged database build in reopening
+'''
+import os
+import sqlite3
+
+import pytest
+
+import reopening
+
+
+def table_names(database):
+    connection = sqlite3.connect(database)
+    names = {row[0] for row in connection.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table'")}
+    connection.close()
+    return names
+
+
+def test_build_db_replaces_live_database(workdir):
+    connection = sqlite3.connect(reopening.DATABASE)
+    connection.execute("CREATE TABLE old_build (x INTEGER)")
+    connection.commit()
+    connection.close()
+
+    result = reopening.build_db(list(reopening.FILENAMES), force=True)
+
+    assert not os.path.exists(reopening.STAGING_DATABASE)
+    names = table_names(reopening.DATABASE)
+    for filename in reopening.FILENAMES:
+        assert filename[:-len(".csv")] in names
+    # Tables that were not rebuilt carry over from the previous build
+    assert "old_build" in names
+    assert result["rows_written"] > 0
+    connection = sqlite3.connect(reopening.DATABASE)
+    for city, query in reopening.reopening_guide.CITY_QUERIES.items():
+        assert connection.execute(query).fetchall(), city
+    connection.close()
+
+
+def test_build_db_skips_unchanged_tables(built_db):
+    before = os.stat(built_db).st_mtime_ns
+
+    result = reopening.build_db(list(reopening.FILENAMES))
+
+    assert result["tables"] == []
+    assert os.stat(built_db).st_mtime_ns == before
+
+
+def test_failed_build_keeps_live_database(built_db):
+    with open(os.path.join("data", "la_covid.csv"), "w") as f:
+        f.write("Community,Covid_Rates,year,month\n")
+    before = os.stat(built_db).st_mtime_ns
+
+    with pytest.raises(Exception, match="la_covid is empty"):
+        reopening.build_db(list(reopening.FILENAMES))
+
+    assert not os.path.exists(reopening.STAGING_DATABASE)
+    assert os.stat(built_db).st_mtime_ns == before
+
+
+def test_update_pipeline_builds_and_categorizes(workdir):
+    report = reopening.run_update(reopening.CITIES,
+                                  only_stages=["build_db", "categorize"])
+
+    assert report["status"] == "ok"
+    assert not os.path.exists(reopening.STAGING_DATABASE)
+    connection = sqlite3.connect(reopening.DATABASE)
+    count = connection.execute(
+        "SELECT COUNT(*) FROM " +
+        reopening.reopening_guide.CATEGORIZED_TABLE).fetchone()[0]
+    connection.close()
+    assert count > 0
+
+
+def test_query_plans_need_join_key_indexes(built_db):
+    connection = sqlite3.connect(built_db)
+    reopening.check_query_plans(connection)
+    for (index,) in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' "
+            "AND sql IS NOT NULL AND tbl_name LIKE 'la%'").fetchall():
+        connection.execute("DROP INDEX " + index)
+    connection.commit()
+    connection.close()
+
+    connection = sqlite3.connect(built_db)
+    with pytest.raises(Exception, match="LOS ANGELES"):
+        reopening.check_query_plans(connection)
+    connection.close()
@@ -0,0 +1,323 @@
+'''
+Tests of the categorization engines: the vectorized, SQL, incremental and
+sketched categorizations and the scenario sweep all have to agree with the
+original row-by-row rules
+'''
+import os
+import sqlite3
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import categorize_sql
+import quantile_sketch
+import reopening
+import reopening_guide as rg
+import scenarios
+
+COLS = list(rg.CATEGORIZED_COLS)
+
+
+def city_frames(database):
+    '''
+    Returns: (lst) of the uncleaned data of each city in a database
+    '''
+    connection = sqlite3.connect(database)
+    frames = [rg.collect_city(connection, city) for city in rg.CITY_QUERIES]
+    connection.close()
+    return frames
+
+
+def edge_frames(rows=2000):
+    '''
+    Uncleaned city data made of the values the rules have to get right:
+    every covid threshold and the gaps between them, missing values,
+    negative attendance and grade levels of every kind
+
+    Returns: (lst) of one dataframe per city
+    '''
+    frames = []
+    for seed, city in enumerate(rg.CITY_QUERIES):
+        rng = np.random.default_rng(seed)
+        frames.append(pd.DataFrame({
+            "Name": [f"S{i % 500}" for i in range(rows)],
+            "Grade_Level": rng.choice(["ELEMENTARY", "High School", "K-8",
+                                       "MIDDLE SCHOOL", "UNKNOWN"], rows),
+            "Community": rng.choice(["a", "b", "c"], rows),
+            "Percent_Broadband": rng.choice([.7, .8, .85, .9, .95, np.nan],
+                                            rows),
+            "Covid_Rates": rng.choice([-1, 0, 5, 9, 9.5, 10, 30, 49, 50, 70,
+                                       99, 100, 150, np.nan], rows),
+            "Attendance": np.round(rng.uniform(-20 if seed == 0 else 80,
+                                               100, rows), 1),
+            "Month": rng.integers(1, 13, rows), "City": city}))
+    return frames
+
+
+def sorted_rows(df):
+    return df.loc[:, COLS].sort_values(COLS).reset_index(drop=True)
+
+
+def categorized_table(connection):
+    return sorted_rows(pd.read_sql_query(
+        "SELECT * FROM " + rg.CATEGORIZED_TABLE, connection))
+
+
+def change_covid_sources():
+    '''
+    Changes the fixture covid files the way a covid update does: some rates
+    change, a month is added and a neighborhood's rows are dropped
+    '''
+    path = os.path.join("data", "la_covid.csv")
+    covid = pd.read_csv(path)
+    covid.loc[covid.index[:20], "Covid_Rates"] = 150.0
+    covid = covid[covid["Community"] != "Hood 3"]
+    extra = covid[(covid["year"] == 2021) & (covid["month"] == 3)].copy()
+    extra["month"] = 4
+    pd.concat([covid, extra]).to_csv(path, index=False)
+
+    path = os.path.join("data", "chicago_covid_grouped.csv")
+    covid = pd.read_csv(path)
+    covid.loc[covid.index[::7], "Avg_Monthly_Case_Rate"] = 5.0
+    covid.to_csv(path, index=False)
+
+
+def test_vectorized_matches_rows(built_db):
+    for df in city_frames(built_db) + edge_frames():
+        rows = df.copy()
+        vectorized = df.copy()
+        rg.categorize_all([rows], rg.categorize_rows)
+        rg.categorize_all([vectorized], rg.categorize_vectorized)
+        pd.testing.assert_frame_equal(rows, vectorized)
+
+
+def assert_sql_matches_python(connection):
+    for city in rg.CITY_QUERIES:
+        expected = rg.collect_city(connection, city)
+        rg.categorize_all([expected])
+        actual = pd.read_sql_query(categorize_sql.city_sql(connection, city),
+                                   connection)
+        assert len(actual), city
+        pd.testing.assert_frame_equal(sorted_rows(expected),
+                                      sorted_rows(actual), check_dtype=False)
+
+
+def test_sql_engine_matches_python(built_db):
+    connection = sqlite3.connect(built_db)
+    assert_sql_matches_python(connection)
+    connection.close()
+
+
+def test_sql_engine_upper_cases_accented_names(built_db):
+    connection = sqlite3.connect(built_db)
+    connection.execute("UPDATE la_schools SET MPD_NAME = 'école ñandú ' || "
+                       "MPD_NAME")
+    assert_sql_matches_python(connection)
+    name = connection.execute(
+        "SELECT Name FROM (" + categorize_sql.city_sql(
+            connection, "LOS ANGELES") + ") LIMIT 1").fetchone()[0]
+    assert name.startswith("ÉCOLE ÑANDÚ ")
+    connection.close()
+
+
+@pytest.mark.parametrize("source", ["database", "edge cases"])
+def test_default_scenario_matches_guide(built_db, source):
+    if source == "database":
+        data = city_frames(built_db)
+    else:
+        data = edge_frames()
+    for df in data:
+        rg.clean_data(df)
+    sweep = scenarios.evaluate_scenarios([{}], data)
+    for df in data:
+        categorized = df.copy()
+        rg.categorize_vectorized(categorized)
+        expected = categorized["Suggested_Action"].value_counts() \
+                                                  .reindex(rg.ACTIONS,
+                                                           fill_value=0)
+        actual = sweep.loc[sweep["City"] == df["City"].iloc[0], rg.ACTIONS]
+        assert list(actual.iloc[0]) == list(expected), df["City"].iloc[0]
+
+
+@pytest.mark.parametrize("sketch_error", [None, .05])
+def test_incremental_matches_full_rebuild(built_db, sketch_error):
+    reopening.build_categorized("python", sketch_error)
+    change_covid_sources()
+    reopening.build_db(list(reopening.FILENAMES))
+
+    connection = sqlite3.connect(built_db)
+    tables = []
+    for update in (rg.update_categorized, rg.write_categorized):
+        copy = sqlite3.connect(":memory:")
+        connection.backup(copy)
+        update(copy, sketch_error)
+        tables.append(categorized_table(copy))
+        copy.close()
+    connection.close()
+    pd.testing.assert_frame_equal(*tables)
+
+
+def test_incremental_stage_only_writes_changes(categorized_db):
+    total = reopening.build_categorized()["rows_written"]
+    assert reopening.build_categorized("incremental")["rows_written"] == 0
+
+    change_covid_sources()
+    reopening.build_db(list(reopening.FILENAMES))
+    written = reopening.build_categorized("incremental")["rows_written"]
+    assert 0 < written < total
+
+
+def test_incremental_only_reads_changed_rows(categorized_db):
+    path = os.path.join("data", "chicago_covid_grouped.csv")
+    covid = pd.read_csv(path)
+    covid.loc[covid.index[::7], "Avg_Monthly_Case_Rate"] += 1000
+    covid.to_csv(path, index=False)
+    reopening.build_db(list(reopening.FILENAMES))
+    connection = sqlite3.connect(categorized_db)
+    chicago = connection.execute("SELECT COUNT(*) FROM " +
+                                 rg.CATEGORIZED_TABLE + " WHERE City = ?",
+                                 ("CHICAGO",)).fetchone()[0]
+    state = rg.read_state(connection)
+    connection.close()
+
+    result = reopening.build_categorized("incremental")
+    assert 0 < result["rows_read"] == result["rows_written"] < chicago
+    connection = sqlite3.connect(categorized_db)
+    assert rg.read_state(connection) == state
+    connection.close()
+
+
+def assert_within_rank_error(values, cuts, quantiles, error):
+    values = np.sort(values[~np.isnan(values)])
+    for q, cut in zip(quantiles, cuts):
+        low = np.searchsorted(values, cut, side="left") / len(values)
+        high = np.searchsorted(values, cut, side="right") / len(values)
+        assert max(low - q, q - high, 0) <= error + 1 / len(values), q
+
+
+def assert_sketch_cuts_within_rank_error(connection, city, sketch):
+    df = rg.collect_city(connection, city)
+    rg.clean_data(df)
+    assert_within_rank_error(df["Attendance"].to_numpy(dtype=float),
+                             rg.sketch_cuts(sketch), (.25, .75),
+                             sketch.rank_error())
+
+
+def test_sketch_cut_points_within_rank_error(built_db):
+    connection = sqlite3.connect(built_db)
+    for city in rg.CITY_QUERIES:
+        sketch = rg.sketch_city(connection, city, .05)
+        assert not sketch.is_exact(), city
+        assert_sketch_cuts_within_rank_error(connection, city, sketch)
+    connection.close()
+
+
+def test_merged_sketches_within_rank_error():
+    values = np.random.default_rng(0).normal(size=20000)
+    sketch = quantile_sketch.KLLSketch.for_error(.02)
+    for start in range(0, len(values), 1500):
+        chunk = quantile_sketch.KLLSketch.for_error(.02, seed=start)
+        chunk.update(values[start:start + 1500])
+        sketch.merge(chunk)
+    quantiles = np.linspace(.05, .95, 19)
+
+    assert sketch.n == len(values) and not sketch.is_exact()
+    assert_within_rank_error(values, [sketch.quantile(q) for q in quantiles],
+                             quantiles, sketch.rank_error())
+
+
+def test_incremental_merges_sketch_of_added_rows(built_db, monkeypatch):
+    reopening.build_categorized("python", sketch_error=.05)
+    path = os.path.join("data", "la_covid.csv")
+    covid = pd.read_csv(path)
+    extra = covid[(covid["year"] == 2021) & (covid["month"] == 3)].copy()
+    extra["month"] = 4
+    pd.concat([covid, extra]).to_csv(path, index=False)
+    reopening.build_db(list(reopening.FILENAMES))
+
+    def sketch_city(*args, **kwargs):
+        raise AssertionError("sketched a city again")
+    monkeypatch.setattr(rg, "sketch_city", sketch_city)
+    reopening.build_categorized("incremental", sketch_error=.05)
+
+    connection = sqlite3.connect(built_db)
+    sketch = rg.load_sketch(connection, "LOS ANGELES")
+    rows = connection.execute("SELECT COUNT(Attendance) FROM " +
+                              rg.CATEGORIZED_TABLE + " WHERE City = ?",
+                              ("LOS ANGELES",)).fetchone()[0]
+    assert sketch.n == rows and not sketch.is_exact()
+    assert_sketch_cuts_within_rank_error(connection, "LOS ANGELES", sketch)
+    connection.close()
+
+
+@pytest.mark.parametrize("engine", list(reopening.CATEGORIZE_ENGINES))
+def test_categorize_stage_promotes_typed_table(built_db, engine):
+    result = reopening.build_categorized(engine)
+
+    assert not os.path.exists(reopening.STAGING_DATABASE)
+    connection = sqlite3.connect(built_db)
+    assert result["rows_written"] == connection.execute(
+        "SELECT COUNT(*) FROM " + rg.CATEGORIZED_TABLE).fetchone()[0] > 0
+    # Numbers are stored as numbers, with attendance on a 0-1 scale
+    types = connection.execute(
+        "SELECT DISTINCT typeof(Attendance), typeof(Percent_Broadband), "
+        "typeof(Month) FROM " + rg.CATEGORIZED_TABLE).fetchall()
+    assert set(types) <= {("real", "real", "integer"),
+                          ("null", "real", "integer"),
+                          ("real", "null", "integer")}
+    low, high = connection.execute(
+        "SELECT MIN(Attendance), MAX(Attendance) FROM " +
+        rg.CATEGORIZED_TABLE).fetchone()
+    assert 0 <= low <= high <= 1
+    indexes = connection.execute(
+        "SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND "
+        "tbl_name = ?", (rg.CATEGORIZED_TABLE,)).fetchone()[0]
+    assert indexes == len(rg.CATEGORIZED_INDEXES)
+    connection.close()
+
+
+def test_categorized_table_matches_categorize_all(built_db):
+    reopening.build_categorized()
+
+    frames = city_frames(built_db)
+    rg.categorize_all(frames)
+    expected = pd.concat(frames, ignore_index=True)
+    connection = sqlite3.connect(built_db)
+    actual = categorized_table(connection)
+    connection.close()
+    pd.testing.assert_frame_equal(sorted_rows(expected), actual,
+                                  check_dtype=False)
+
+
+def test_categorize_matches_python_engine(built_db):
+    tables = []
+    for engine in ("python", "sql"):
+        reopening.build_categorized(engine)
+        connection = sqlite3.connect(built_db)
+        tables.append(categorized_table(connection))
+        connection.close()
+    pd.testing.assert_frame_equal(*tables, check_dtype=False)
+
+
+def sketched_cities(database):
+    connection = sqlite3.connect(database)
+    cities = {row[0] for row in connection.execute(
+        "SELECT City FROM " + rg.SKETCH_TABLE)}
+    connection.close()
+    return cities
+
+
+@pytest.mark.parametrize("engine", ["python", "incremental"])
+def test_sketch_error_reaches_engine(built_db, engine):
+    result = reopening.build_categorized(engine, sketch_error=.01)
+
+    assert result["rows_written"] > 0
+    assert sketched_cities(built_db) == set(rg.CITY_QUERIES)
+
+
+def test_incremental_drops_stale_sketches(built_db):
+    reopening.build_categorized("python", sketch_error=.01)
+    reopening.build_categorized("incremental")
+
+    assert sketched_cities(built_db) == set()
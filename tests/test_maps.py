@@ -0,0 +1,189 @@
+'''
+Tests of the rendered map cache and the render pool of the web interface
+'''
+import os
+import time
+from concurrent.futures import Future
+from concurrent.futures.process import BrokenProcessPool
+
+import pytest
+
+import map_cache
+import prerender_maps
+import render_pool
+
+
+@pytest.fixture
+def cache(built_db, tmp_path, monkeypatch):
+    cache = map_cache.MapCache(directory=str(tmp_path / "maps"),
+                               prerender_dir=str(tmp_path / "prerendered"),
+                               database=built_db, max_bytes=250,
+                               geometry_store=str(tmp_path /
+                                                  "geometry.sqlite3"))
+    # Evict only when a test asks to, not in the background
+    monkeypatch.setattr(cache, "schedule_cleanup", lambda: None)
+    return cache
+
+
+def write_map(cache, args_to_ui, size=100, age=0):
+    '''
+    Adds a map of the given size to the cache, last used age seconds ago
+
+    Returns: (str) path of the cached map
+    '''
+    key = cache.key(args_to_ui)
+    render_path = cache.render_path(key)
+    with open(render_path, "wb") as f:
+        f.write(b"\0" * size)
+    path = cache.add(key, render_path)
+    used = time.time() - age
+    os.utime(path, (used, used))
+    return path
+
+
+def test_key_normalizes_filters(cache):
+    key = cache.key({"city": "CHICAGO", "month": "10",
+                     "grade_level": "HIGH SCHOOL"})
+
+    assert cache.key({"city": " chicago", "month": 10,
+                      "grade_level": "High School", "school": "  ",
+                      "sort_by": "City"}) == key
+    assert cache.key({"city": "CHICAGO", "month": "11",
+                      "grade_level": "HIGH SCHOOL"}) != key
+
+
+def test_key_changes_with_database_build(cache, built_db):
+    args_to_ui = {"city": "CHICAGO", "month": "10"}
+    key = cache.key(args_to_ui)
+    stat = os.stat(built_db)
+    os.utime(built_db, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+
+    assert cache.key(args_to_ui) != key
+
+
+def test_key_changes_with_geometry_store_build(cache):
+    args_to_ui = {"city": "CHICAGO", "month": "10"}
+    key = cache.key(args_to_ui)
+    with open(cache.geometry_store, "wb") as f:
+        f.write(b"store")
+
+    assert cache.key(args_to_ui) != key
+
+
+def test_get_counts_hits_and_misses(cache):
+    args_to_ui = {"city": "CHICAGO", "month": "10"}
+    assert cache.get(args_to_ui) is None
+    path = write_map(cache, args_to_ui)
+
+    assert cache.get(args_to_ui) == path
+    assert cache.stats() == {"hits": 1, "misses": 1, "hit_rate": .5}
+
+
+def test_evict_keeps_recent_maps_within_size(cache):
+    oldest = write_map(cache, {"city": "CHICAGO", "month": "1"}, age=3000)
+    old = write_map(cache, {"city": "CHICAGO", "month": "2"}, age=2000)
+    recent = write_map(cache, {"city": "CHICAGO", "month": "3"}, age=10)
+    young = write_map(cache, {"city": "CHICAGO", "month": "4"})
+
+    assert cache.evict() == 2
+    assert not os.path.exists(oldest) and not os.path.exists(old)
+    # Maps used within min_age are kept even over max_bytes
+    assert os.path.exists(recent) and os.path.exists(young)
+
+
+def test_remove_stale_renders_spares_live_claims(cache):
+    stale = cache.claim(cache.key({"city": "CHICAGO", "month": "1"}))
+    live = cache.claim(cache.key({"city": "CHICAGO", "month": "2"}))
+    abandoned = time.time() - map_cache.STALE_RENDER_SECONDS - 1
+    os.utime(stale, (abandoned, abandoned))
+
+    assert cache.remove_stale_renders() == 1
+    assert not os.path.exists(stale) and os.path.exists(live)
+    assert cache.claimed() == 1
+
+
+class FakeExecutor:
+    '''
+    Stands in for a process pool, handing out futures the test completes
+    '''
+    def __init__(self, *args, **kwargs):
+        self.futures = []
+        self.closed = False
+
+    def submit(self, fn, *args):
+        future = Future()
+        self.futures.append((args, future))
+        return future
+
+    def shutdown(self, wait=True):
+        self.closed = True
+
+
+class BrokenExecutor(FakeExecutor):
+    def submit(self, fn, *args):
+        raise BrokenProcessPool("a worker died")
+
+
+@pytest.fixture
+def executors(monkeypatch):
+    created = []
+
+    def executor(*args, **kwargs):
+        created.append(FakeExecutor())
+        return created[-1]
+    monkeypatch.setattr(render_pool, "ProcessPoolExecutor", executor)
+    return created
+
+
+def test_request_renders_each_map_once(cache, executors):
+    args_to_ui = {"city": "CHICAGO", "month": "10"}
+    pool = render_pool.RenderPool(cache)
+    other_worker = render_pool.RenderPool(cache)
+
+    status, key = pool.request(args_to_ui)
+    assert status == "pending"
+    assert pool.request({"city": "chicago", "month": 10}) == ("pending", key)
+    assert other_worker.request(args_to_ui) == ("pending", key)
+    assert other_worker.status(key) == "pending"
+    assert len(executors) == 1 and len(executors[0].futures) == 1
+
+    (_, render_path), future = executors[0].futures[0]
+    with open(render_path, "wb") as f:
+        f.write(b"png")
+    future.set_result(render_path)
+    assert pool.status(key) == other_worker.status(key) == "ready"
+    assert pool.request(args_to_ui) == ("ready", key)
+    assert cache.claimed() == 0
+
+
+def test_request_refuses_maps_past_max_pending(cache, executors):
+    pool = render_pool.RenderPool(cache, max_pending=1)
+    pool.request({"city": "CHICAGO", "month": "10"})
+
+    assert pool.request({"city": "CHICAGO", "month": "11"})[0] == "busy"
+
+
+def test_failed_render_releases_claim(cache, executors):
+    pool = render_pool.RenderPool(cache)
+    status, key = pool.request({"city": "CHICAGO", "month": "10"})
+    executors[0].futures[0][1].set_exception(ValueError("no data"))
+
+    assert cache.claimed() == 0
+    assert pool.status(key) == "missing"
+
+
+def test_broken_pool_is_replaced(cache, executors):
+    pool = render_pool.RenderPool(cache)
+    broken = BrokenExecutor()
+    pool.executor = broken
+
+    status, key = pool.request({"city": "CHICAGO", "month": "10"})
+    assert status == "pending"
+    assert broken.closed
+    assert pool.executor is executors[0]
+    assert len(executors[0].futures) == 1
+
+
+def test_prerender_dir_is_the_cache_prerender_dir():
+    assert prerender_maps.PRERENDER_DIR == os.path.join(
+        "ui", map_cache.PRERENDER_DIR)
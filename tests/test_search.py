@@ -0,0 +1,128 @@
+'''
+Tests of the school and community search shared by the results table and
+the map
+'''
+import re
+import sqlite3
+from itertools import combinations
+
+import pytest
+
+import substring_index
+
+SEARCHES = ["school", "(#1", "st. + 2", "3", "ps 1", "hood", "comm 7", "nta",
+            '"', "no such school"]
+
+
+@pytest.fixture
+def web(categorized_db, monkeypatch):
+    '''
+    The results table and map modules of the web interface, reading the
+    categorized fixture database
+    '''
+    import create_map
+    import query_schools
+    monkeypatch.setattr(query_schools, "DATABASE_FILENAME", categorized_db)
+    monkeypatch.setattr(create_map, "DATABASE_FILENAME", categorized_db)
+    return query_schools, create_map
+
+
+def distinct_values(database, col):
+    connection = sqlite3.connect(database)
+    values = [row[0] for row in connection.execute(
+        "SELECT DISTINCT " + col + " FROM " +
+        substring_index.CATEGORIZED_TABLE)]
+    connection.close()
+    return values
+
+
+def test_substring_index_matches_scan(categorized_db):
+    for col in substring_index.TEXT_COLS:
+        values = distinct_values(categorized_db, col)
+        index = substring_index.SubstringIndex(values)
+        for text in SEARCHES:
+            expected = sorted(value for value in values if value is not None
+                              and text.strip().upper() in value.upper())
+            assert index.search(text) == expected, (col, text)
+
+
+def table_rows(query_schools, args_from_ui):
+    connection = sqlite3.connect(query_schools.DATABASE_FILENAME)
+    cursor = connection.cursor()
+    s, args = query_schools.build_query(args_from_ui, cursor)
+    rows = sorted((row[0], row[1]) for row in cursor.execute(s, args))
+    connection.close()
+    return rows
+
+
+def map_rows(create_map, args_from_ui):
+    filters = {create_map.COL_DICT[col]: int(val) if col == "month"
+               else val.upper() for col, val in args_from_ui.items()}
+    cat_df = create_map.filter_categorized(filters)
+    return sorted(zip(cat_df["Name"].astype(str),
+                      cat_df["Community"].astype(str)))
+
+
+@pytest.mark.parametrize("city", ["LOS ANGELES", "CHICAGO", "NEW YORK CITY"])
+def test_map_points_match_table_rows(web, city):
+    query_schools, create_map = web
+    matched = 0
+    for text in SEARCHES:
+        for col in ("school", "neighborhood"):
+            args_from_ui = {"city": city, "month": "10", col: text}
+            rows = table_rows(query_schools, args_from_ui)
+            assert map_rows(create_map, args_from_ui) == rows, (col, text)
+            matched += len(rows)
+    assert matched
+
+
+def test_fts_search_matches_memory_search(categorized_db):
+    fts = substring_index.NameSearch(categorized_db)
+    memory = substring_index.NameSearch(categorized_db, use_fts=False)
+    assert fts.fts and not memory.fts
+    for col in substring_index.TEXT_COLS:
+        for text in SEARCHES:
+            matches = fts.search(col, text)
+            assert sorted(matches) == sorted(memory.search(col, text)), \
+                (col, text)
+            # Names starting with the search come first
+            starts = [value.upper().startswith(text.upper())
+                      for value in matches]
+            assert starts == sorted(starts, reverse=True), (col, text)
+
+
+def test_search_ignores_case_of_accented_names(categorized_db):
+    connection = sqlite3.connect(categorized_db)
+    connection.execute("UPDATE " + substring_index.CATEGORIZED_TABLE +
+                       " SET Community = 'Écoles ' || Community")
+    substring_index.create_search_table(connection)
+    connection.commit()
+    connection.close()
+
+    for use_fts in (True, False):
+        search = substring_index.NameSearch(categorized_db, use_fts)
+        assert search.search("Community", "écoles comm 1") == \
+            ["Écoles COMM 1"], use_fts
+        assert search.search("Community", "ÉC") and \
+            search.search("Community", "éco"), use_fts
+
+
+def test_form_filters_read_covering_indexes(web):
+    query_schools, _ = web
+    values = {"city": "CHICAGO", "month": "10", "grade_level": "HIGH SCHOOL"}
+    connection = sqlite3.connect(query_schools.DATABASE_FILENAME)
+    cursor = connection.cursor()
+    for n in range(1, len(query_schools.FORM_FILTERS) + 1):
+        for filters in combinations(query_schools.FORM_FILTERS, n):
+            for sort_by in [None] + list(query_schools.SORT_COLUMNS):
+                args_from_ui = {key: values[key] for key in filters}
+                if sort_by is not None:
+                    args_from_ui["sort_by"] = sort_by
+                s, args = query_schools.build_query(args_from_ui, cursor)
+                plan = [row[3] for row in
+                        cursor.execute("EXPLAIN QUERY PLAN " + s, args)]
+                assert any("USING COVERING INDEX" in step
+                           for step in plan), (filters, sort_by, plan)
+                assert not any(re.match(r"SCAN (?:TABLE )?s\b", step)
+                               for step in plan), (filters, sort_by, plan)
+    connection.close()
@@ -0,0 +1,378 @@
+'''
+On-disk LRU cache of rendered school maps
+
+Maps are keyed on the normalized map filters plus the build versions of the
+database and the geometry store, so a rebuild never serves a stale map. Each
+map is stored as <key>.png in the cache directory under static/, and that
+content-addressed path is what the view links to: a map is written once,
+atomically, and never overwritten with a different map, so any number of
+requests and workers can share the directory. Every hit bumps the map's
+modification time, and a background thread evicts the least recently used
+maps once the directory grows past its size limit, sparing maps young enough
+that a page may still be loading them. A hit costs a stat.
+
+Maps pre-rendered by the build (see prerender_maps.py) live in their own
+directory under static/, are looked up before the LRU cache and are never
+evicted; each build replaces the previous build's maps.
+'''
+
+import glob
+import hashlib
+import json
+import os
+import threading
+import time
+from create_map import file_version, GEOMETRY_STORE
+
+DATABASE_FILENAME = os.path.join('../school_access.sqlite3')
+STATIC_DIR = 'static'
+CACHE_DIR = os.path.join(STATIC_DIR, 'maps')
+PRERENDER_DIR = os.path.join(STATIC_DIR, 'prerendered')
+MAX_CACHE_BYTES = 500 * 2 ** 20
+# Maps used more recently than this are never evicted, so that a page
+# linking to one can still load it
+MIN_AGE_SECONDS = 300
+CLEANUP_INTERVAL_SECONDS = 60
+# Renders and claims left behind this long ago were abandoned by a failed
+# request or worker
+STALE_RENDER_SECONDS = 600
+# Suffix of the file a worker claims a map's render with, see claim
+CLAIM_SUFFIX = '.claim.tmp.png'
+# The args_to_ui keys that change the map; sort_by only reorders the table
+MAP_FILTERS = ('city', 'month', 'grade_level', 'school', 'neighborhood')
+
+
+def normalize_filters(args_to_ui):
+    '''
+    Normalizes the filters that change the map the same way create_map
+    applies them: upper-cased, stripped strings and an integer month
+
+    Inputs:
+        args_to_ui (dict): arguments passed into django interface
+    Returns: (tuple) of sorted (filter, value) pairs
+    '''
+    filters = []
+    for col in MAP_FILTERS:
+        val = args_to_ui.get(col)
+        if val is None or str(val).strip() == '':
+            continue
+        if col == 'month':
+            val = int(val)
+        else:
+            val = str(val).strip().upper()
+        filters.append((col, val))
+    return tuple(filters)
+
+
+class MapCache:
+    '''
+    Class describing the on-disk LRU cache of rendered maps
+    '''
+    def __init__(self, directory=CACHE_DIR, max_bytes=MAX_CACHE_BYTES,
+                 database=DATABASE_FILENAME, min_age=MIN_AGE_SECONDS,
+                 prerender_dir=PRERENDER_DIR, geometry_store=GEOMETRY_STORE):
+        '''
+        Inputs:
+            directory (str): directory the maps are stored in
+            max_bytes (int): total size of maps to keep
+            database (str): path of the database the maps are drawn from
+            min_age (float): seconds since its last use before a map can be
+                evicted
+            prerender_dir (str): directory of the maps pre-rendered by the
+                build
+            geometry_store (str): path of the geometry store the maps are
+                drawn from
+        '''
+        self.directory = directory
+        self.prerender_dir = prerender_dir
+        self.max_bytes = max_bytes
+        self.database = database
+        self.geometry_store = geometry_store
+        self.min_age = min_age
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.cleanup_needed = threading.Event()
+        self.cleanup_thread = None
+        os.makedirs(directory, exist_ok=True)
+        os.makedirs(prerender_dir, exist_ok=True)
+
+    def key(self, args_to_ui):
+        '''
+        Inputs:
+            args_to_ui (dict): arguments passed into django interface
+        Returns: (str) cache key of the map for these filters and the
+            current database and geometry store builds
+        '''
+        ident = json.dumps([file_version(self.database),
+                            file_version(self.geometry_store),
+                            normalize_filters(args_to_ui)])
+        return hashlib.sha256(ident.encode()).hexdigest()
+
+    def path(self, key):
+        '''
+        Returns (str) the path a map with this key is stored at
+        '''
+        return os.path.join(self.directory, key + '.png')
+
+    def prerendered_path(self, key):
+        '''
+        Returns (str) the path a map with this key is pre-rendered at
+        '''
+        return os.path.join(self.prerender_dir, key + '.png')
+
+    def find(self, key):
+        '''
+        Looks a map up by its key, among the pre-rendered maps and then the
+        cached ones, marking a cached map as recently used
+
+        Inputs:
+            key (str): cache key of the map
+        Returns: (str) path of the map, or None if there is none
+        '''
+        path = self.prerendered_path(key)
+        if os.path.exists(path):
+            return path
+        path = self.path(key)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def get(self, args_to_ui):
+        '''
+        Looks a map up, marking it as recently used
+
+        Inputs:
+            args_to_ui (dict): arguments passed into django interface
+        Returns: (str) path of the map, or None on a miss
+        '''
+        path = self.find(self.key(args_to_ui))
+        with self.lock:
+            if path is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return path
+
+    def render_path(self, key):
+        '''
+        Gives a private file to render a map into before adding it, so that
+        concurrent renders never write to the same file. While the file
+        exists, status reports the map as pending to every worker.
+
+        Inputs:
+            key (str): cache key of the map to be rendered
+        Returns: (str) temporary path in the cache directory
+        '''
+        return '{}.{}.{}.tmp.png'.format(self.path(key), os.getpid(),
+                                         threading.get_ident())
+
+    def claim_path(self, key):
+        '''
+        Returns (str) the path of the file a map's render is claimed with
+        '''
+        return self.path(key) + CLAIM_SUFFIX
+
+    def claim(self, key):
+        '''
+        Claims the render of a map for this worker by creating its claim
+        file, which only one worker can do. The map is then rendered into
+        the claim file and added, which releases the claim; a failed render
+        must delete it. Until then status reports the map as pending to
+        every worker.
+
+        Inputs:
+            key (str): cache key of the map to be rendered
+        Returns: (str) path of the claim file to render the map into, or
+            None if another worker has already claimed it
+        '''
+        path = self.claim_path(key)
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return None
+        os.close(fd)
+        return path
+
+    def claimed(self):
+        '''
+        Returns (int) the number of maps claimed by any worker and not yet
+        added or given up
+        '''
+        with os.scandir(self.directory) as it:
+            return sum(1 for entry in it if entry.name.endswith(CLAIM_SUFFIX))
+
+    def add(self, key, png_file):
+        '''
+        Moves a map rendered into render_path into the cache, and wakes the
+        background cleanup
+
+        Inputs:
+            key (str): cache key of the map
+            png_file (str): path the map was rendered to
+        Returns: (str) path of the cached map
+        '''
+        path = self.path(key)
+        os.replace(png_file, path)
+        self.schedule_cleanup()
+        return path
+
+    def add_prerendered(self, key, png_file):
+        '''
+        Moves a map pre-rendered by the build into the pre-rendered maps
+
+        Inputs:
+            key (str): cache key of the map
+            png_file (str): path the map was rendered to, on the same file
+                system
+        Returns: (str) path of the pre-rendered map
+        '''
+        path = self.prerendered_path(key)
+        os.replace(png_file, path)
+        return path
+
+    def prune_prerendered(self, keys):
+        '''
+        Deletes the pre-rendered maps of earlier builds, along with any
+        renders they left behind
+
+        Inputs:
+            keys (collection): cache keys of the maps to keep
+        Returns: (int) number of files deleted
+        '''
+        keep = {key + '.png' for key in keys}
+        deleted = 0
+        with os.scandir(self.prerender_dir) as it:
+            for entry in it:
+                if entry.name in keep:
+                    continue
+                try:
+                    os.remove(entry.path)
+                    deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+    def status(self, key):
+        '''
+        Checks on a map by its key, as seen by any worker sharing the cache
+        directory
+
+        Inputs:
+            key (str): cache key of the map
+        Returns: (str) 'ready' if the map is cached, 'pending' if it is
+            being rendered, 'missing' otherwise
+        '''
+        path = self.path(key)
+        if os.path.exists(self.prerendered_path(key)) or \
+                os.path.exists(path):
+            return 'ready'
+        if glob.glob(glob.escape(path) + '.*.tmp.png'):
+            return 'pending'
+        return 'missing'
+
+    def schedule_cleanup(self):
+        '''
+        Asks the background cleanup thread to run, starting it if needed
+        '''
+        with self.lock:
+            if self.cleanup_thread is None:
+                self.cleanup_thread = threading.Thread(
+                    target=self.cleanup_loop, name='map-cache-cleanup',
+                    daemon=True)
+                self.cleanup_thread.start()
+        self.cleanup_needed.set()
+
+    def cleanup_loop(self):
+        '''
+        Evicts maps whenever a map is added, and every
+        CLEANUP_INTERVAL_SECONDS in case other workers added maps
+        '''
+        while True:
+            self.cleanup_needed.wait(CLEANUP_INTERVAL_SECONDS)
+            self.cleanup_needed.clear()
+            try:
+                self.evict()
+                self.remove_stale_renders()
+            except OSError as e:
+                print('Map cache cleanup failed: {}'.format(e))
+
+    def entries(self):
+        '''
+        Returns (lst) of (mtime, size, path) for each cached map, least
+        recently used first
+        '''
+        entries = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.png') or \
+                        entry.name.endswith('.tmp.png'):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return sorted(entries)
+
+    def evict(self):
+        '''
+        Deletes the least recently used maps until the cache fits in
+        max_bytes, never deleting maps used in the last min_age seconds
+
+        Returns: (int) number of maps deleted
+        '''
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        cutoff = time.time() - self.min_age
+        deleted = 0
+        for mtime, size, path in entries:
+            if total <= self.max_bytes or mtime > cutoff:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            deleted += 1
+        return deleted
+
+    def remove_stale_renders(self):
+        '''
+        Deletes temporary renders abandoned more than STALE_RENDER_SECONDS
+        ago
+
+        Returns: (int) number of files deleted
+        '''
+        cutoff = time.time() - STALE_RENDER_SECONDS
+        deleted = 0
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if not entry.name.endswith('.tmp.png'):
+                    continue
+                try:
+                    if entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                        deleted += 1
+                except FileNotFoundError:
+                    pass
+        return deleted
+
+    def static_name(self, path):
+        '''
+        Returns (str) the name of a cached map relative to static/, for the
+        template's static tag
+        '''
+        return os.path.relpath(path, STATIC_DIR).replace(os.sep, '/')
+
+    def stats(self):
+        '''
+        Returns (dict) this worker's hits, misses and hit rate
+        '''
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {'hits': hits, 'misses': misses,
+                'hit_rate': hits / lookups if lookups else 0.0}
@@ -8,10 +8,33 @@ import sqlite3
 import os
 import sys
 sys.path.append("../")
-import create_map
 import shutil
+from create_map import file_version
+from map_cache import MapCache
+from render_pool import RenderPool
+import substring_index
 
 DATABASE_FILENAME = os.path.join('../school_access.sqlite3')
+PERCENT_COLS = ["Percent with Broadband", "2019 Attendance Rate"]
+DEFAULT_MAP = "default_map.png"
+MAP_CACHE = MapCache(database=DATABASE_FILENAME)
+RENDER_POOL = RenderPool(MAP_CACHE)
+
+SORT_COLUMNS = {"School Name" : "s.Name", "Community" : "s.Community", "City" : "s.City",
+                "Grade Level" : "s.Grade_Level_Cat",
+                "Percent with Broadband" : "s.Percent_Broadband",
+                "2019 Attendance Rate" : "s.Attendance",
+                "Monthly Covid Rate" : "s.Covid_Rates",
+                "Suggested Action" : "s.Suggested_Action"}
+# Filters of the search form, each with the condition it adds to the query
+FORM_FILTERS = {"city": "s.City = ?", "grade_level": "s.Grade_Level_Cat = ?",
+                "month": "s.Month = ?"}
+RESULTS_QUERY = '''
+        SELECT s.Name AS "School Name", s.Community, s.City, s.Grade_Level_Cat as "Grade Level",
+        s.Percent_Broadband as "Percent with Broadband", s.Attendance AS "2019 Attendance Rate",
+        s.Covid_Rates AS "Monthly Covid Rate per 100k", s.Month, s.Year, s.Suggested_Action AS "Suggested Action"
+        FROM categorized_schools AS s
+        '''
 
 def query_results(args_from_ui):
     '''
@@ -24,64 +47,173 @@ def query_results(args_from_ui):
         header, table (lst, lst) - header is a list of strings of the column
             names for the output table. table is the data to be displayed
             on the django interface table based on args_from_ui.
+        map_info (dict) - the map for this search, see request_map
     '''
 
-    delete_old_image()
-
     connection = sqlite3.connect(DATABASE_FILENAME)
     c = connection.cursor()
+    s, args = build_query(args_from_ui, c)
 
-    keys = args_from_ui.keys()
-    args = []
+    table = c.execute(s, args).fetchall()
+    header = get_header(c)
+    table = format_percentages(header, table)
 
-    col_dict = {"School Name" : "s.Name", "Community" : "s.Community", "City" : "s.City",
-                "Grade Level" : "s.Grade_Level_Cat", "Percent with Broadband" : "s.Percent_Broadband",
-                "2019 Attendance Rate" : "s.Attendance", "Monthly Covid Rate" : "s.Covid_Rates",
-                "Suggested Action" : "s.Suggested_Action"}
+    if args_from_ui and args_from_ui['city'] != "NONE":
+        map_info = request_map(args_from_ui)
+    else:
+        return header, [], {"status": "ready", "key": None,
+                            "file": default_map()}
 
-    s = '''
-        SELECT s.Name AS "School Name", s.Community, s.City, s.Grade_Level_Cat as "Grade Level",
-        s.Percent_Broadband as "Percent with Broadband", s.Attendance AS "2019 Attendance Rate",
-        s.Covid_Rates AS "Monthly Covid Rate per 100k", s.Month, s.Year, s.Suggested_Action AS "Suggested Action"
-        FROM categorized_schools AS s
-        WHERE 
-        '''
+    c.close()
+
+    return header, table, map_info
+
+
+def build_query(args_from_ui, cursor):
+    '''
+    Builds the results query of a search. The city, month and grade level
+    filters are each a prefix of one of the categorized_schools indexes
+    (see reopening_guide.CATEGORIZED_INDEXES); the names matched by school
+    and community searches are stored in temporary tables of the cursor's
+    connection.
+
+    Inputs:
+        args_from_ui (dict) - arguments passed into django interface
+        cursor (sqlite3 Cursor) - cursor the query will be run with
+    Returns: (str, lst) the query and its parameters
+    '''
+    search = substring_index.load_search(DATABASE_FILENAME,
+                                         file_version(DATABASE_FILENAME))
+    keys = args_from_ui.keys()
+    conditions = []
+    args = []
+    ranks = []
 
-    if len(keys) == 0:
-        s = s.strip("WHERE \n")
     if "school" in keys:
-        s += "s.Name LIKE upper('%'||?||'%') AND "
-        args.append(args_from_ui['school'])
+        add_matches(cursor, "school_matches",
+                    search.search("Name", args_from_ui['school'],
+                                  cursor.connection))
+        conditions.append("s.Name IN (SELECT value FROM temp.school_matches)")
+        ranks.append("(SELECT rank FROM temp.school_matches "
+                     "WHERE value = s.Name)")
     if "neighborhood" in keys:
-        s += "s.Community LIKE upper('%'||?||'%') AND "
-        args.append(args_from_ui['neighborhood'])
-    if "city" in keys:
-        s += "s.City = ? AND "
-        args.append(args_from_ui['city'])
-    if "grade_level" in keys:
-        s += "s.Grade_Level_Cat = ? AND "
-        args.append(args_from_ui['grade_level'])
-    if "month" in keys:
-        s += "s.Month = ? AND "
-        args.append(args_from_ui['month'])
-
-    s = s.strip(" AND ")
-
+        add_matches(cursor, "community_matches",
+                    search.search("Community", args_from_ui['neighborhood'],
+                                  cursor.connection))
+        conditions.append("s.Community IN "
+                          "(SELECT value FROM temp.community_matches)")
+        ranks.append("(SELECT rank FROM temp.community_matches "
+                     "WHERE value = s.Community)")
+    for key, condition in FORM_FILTERS.items():
+        if key in keys:
+            conditions.append(condition)
+            args.append(args_from_ui[key])
+
+    s = RESULTS_QUERY
+    if conditions:
+        s += "WHERE " + " AND ".join(conditions)
     if "sort_by" in keys:
-        s += " ORDER BY " + col_dict[args_from_ui['sort_by']] + " DESC"
+        s += " ORDER BY " + SORT_COLUMNS[args_from_ui['sort_by']] + " DESC"
+    elif ranks:
+        # Best school and community matches first
+        s += " ORDER BY " + ", ".join(ranks)
+    return s, args
 
-    table = c.execute(s, args).fetchall()
-    header = get_header(c)
 
-    if args_from_ui and args_from_ui['city'] != "NONE":
-        create_map.create_viz(args_from_ui)
-    else:
-        shutil.copyfile("../default_image.png", "static/school_map.png")
-        return header, []
+def add_matches(cursor, table, values):
+    '''
+    Stores the names matched by a school or community search, with their
+    rank, in a temporary table of the connection for the query to filter and
+    order on
 
-    c.close()
+    Inputs:
+        cursor (sqlite3 Cursor): cursor of the search's connection
+        table (str): name of the temporary table
+        values (lst): names matched, best first, from substring_index
+    '''
+    cursor.execute("CREATE TEMP TABLE " + table +
+                   " (value TEXT PRIMARY KEY, rank INTEGER)")
+    cursor.executemany("INSERT OR IGNORE INTO temp." + table +
+                       " VALUES (?, ?)",
+                       [(value, rank) for rank, value in enumerate(values)])
+
+
+def request_map(args_from_ui):
+    '''
+    Asks RENDER_POOL for the map of the search without waiting for it to be
+    drawn. Each map has its own file, named by its cache key, so concurrent
+    requests never share an output path.
+
+    Inputs:
+        args_from_ui (dict) - arguments passed into django interface
+    Returns: (dict) with the map's status ("ready", "pending" or "busy"),
+        its cache key to poll map_status with, and its file relative to
+        static/ once it is ready (the default map until then)
+    '''
+    status, key = RENDER_POOL.request(args_from_ui)
+    return {"status": status, "key": key, "file": map_file(status, key)}
 
-    return header, table
+
+def map_status(key):
+    '''
+    Checks on a map requested by request_map, from any worker
+
+    Inputs:
+        key (str) - cache key of the map
+    Returns: (dict) with the map's status ("ready", "pending" or "missing"),
+        its file relative to static/ and this worker's map cache hits and
+        misses
+    '''
+    status = RENDER_POOL.status(key)
+    return {"status": status, "key": key, "file": map_file(status, key),
+            "cache": MAP_CACHE.stats()}
+
+
+def map_file(status, key):
+    '''
+    Returns (str) the map to show, relative to static/: the pre-rendered or
+    cached map if it is ready and the default map otherwise
+    '''
+    if status == "ready":
+        path = MAP_CACHE.find(key)
+        if path is not None:
+            return MAP_CACHE.static_name(path)
+    return default_map()
+
+
+def default_map():
+    '''
+    Puts a copy of the default image in static/ if there is none yet
+
+    Returns: (str) the default map, relative to static/
+    '''
+    path = os.path.join("static", DEFAULT_MAP)
+    if not os.path.exists(path):
+        temp_path = "{}.{}.tmp".format(path, os.getpid())
+        shutil.copyfile("../default_image.png", temp_path)
+        os.replace(temp_path, path)
+    return DEFAULT_MAP
+
+
+def format_percentages(header, table):
+    '''
+    Formats the share columns of the results, which are stored as numbers
+    between 0 and 1, as percentages for display
+
+    Inputs:
+        header (lst): column names of the results
+        table (lst): result rows
+    Returns: (lst) result rows with the share columns formatted
+    '''
+    positions = [header.index(col) for col in PERCENT_COLS if col in header]
+    formatted = []
+    for row in table:
+        row = list(row)
+        for i in positions:
+            if row[i] is not None:
+                row[i] = '{:,.2%}'.format(row[i])
+        formatted.append(tuple(row))
+    return formatted
 
 
 def get_header(cursor):
@@ -97,11 +229,3 @@ def get_header(cursor):
         header.append(s)
 
     return header
-
-
-def delete_old_image():
-    '''
-    Deletes the old school_map.png file in static/ to make room for new one.
-    '''
-    if os.path.exists("static/school_map.png"):
-        os.remove("static/school_map.png")
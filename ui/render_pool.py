@@ -0,0 +1,145 @@
+'''
+Asynchronous map rendering
+
+Maps are drawn in a bounded pool of worker processes so that a search
+returns its results table straight away. A render job is keyed on the map's
+cache key and claimed in the shared cache directory before it is submitted,
+so identical searches made while the map is being drawn share one job, even
+across web workers. Once MAX_PENDING_RENDERS maps are claimed by any worker,
+new maps are refused until the pools catch up. The page polls for the map by
+its key.
+'''
+
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+RENDER_WORKERS = 2
+MAX_PENDING_RENDERS = 8
+
+
+def render(args_to_ui, render_path):
+    '''
+    Draws a map inside a worker process. create_map (and with it geopandas
+    and matplotlib) is imported once per worker, on its first job.
+
+    Inputs:
+        args_to_ui (dict): arguments passed into django interface
+        render_path (str): path to save the map to
+    Returns: (str) render_path
+    '''
+    import create_map
+    return create_map.create_viz(args_to_ui, render_path)
+
+
+class RenderPool:
+    '''
+    Class describing the pool of map rendering processes and its in-flight
+    jobs
+    '''
+    def __init__(self, cache, max_workers=RENDER_WORKERS,
+                 max_pending=MAX_PENDING_RENDERS):
+        '''
+        Inputs:
+            cache (MapCache): cache the rendered maps are added to
+            max_workers (int): number of rendering processes
+            max_pending (int): number of maps claimed by all web workers at
+                once, beyond which new maps are refused
+        '''
+        self.cache = cache
+        self.max_workers = max_workers
+        self.max_pending = max_pending
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.executor = None
+
+    def request(self, args_to_ui):
+        '''
+        Asks for the map of a search, starting a render job if it is neither
+        cached nor already being rendered
+
+        Inputs:
+            args_to_ui (dict): arguments passed into django interface
+        Returns: (tuple) of the map's status and cache key. The status is
+            'ready' if the map is cached, 'pending' if it is being rendered
+            by this or another worker and 'busy' if the queue is full.
+        '''
+        key = self.cache.key(args_to_ui)
+        if self.cache.get(args_to_ui) is not None:
+            return 'ready', key
+        with self.lock:
+            if key in self.jobs:
+                return 'pending', key
+            if self.cache.claimed() >= self.max_pending:
+                return 'busy', key
+            render_path = self.cache.claim(key)
+            if render_path is None:
+                return 'pending', key
+            try:
+                future = self.submit(args_to_ui, render_path)
+            except Exception:
+                os.remove(render_path)
+                raise
+            self.jobs[key] = future
+        future.add_done_callback(
+            lambda done: self.finish(key, render_path, done))
+        return 'pending', key
+
+    def submit(self, args_to_ui, render_path):
+        '''
+        Submits a render job, starting the pool on first use. A pool broken
+        by the death of one of its processes (killed for lack of memory,
+        say) refuses every later job, so it is replaced.
+
+        Inputs:
+            args_to_ui (dict): arguments passed into django interface
+            render_path (str): path to save the map to
+        Returns: (Future) the job
+        '''
+        if self.executor is not None:
+            try:
+                return self.executor.submit(render, args_to_ui, render_path)
+            except BrokenProcessPool:
+                print('Map render pool broken, starting a new one')
+                self.executor.shutdown(wait=False)
+        # Workers are spawned rather than forked from the threaded web
+        # server
+        self.executor = ProcessPoolExecutor(
+            self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+        return self.executor.submit(render, args_to_ui, render_path)
+
+    def finish(self, key, render_path, future):
+        '''
+        Adds a finished map to the cache, or discards a failed render
+
+        Inputs:
+            key (str): cache key of the map
+            render_path (str): path the map was rendered to
+            future (Future): the finished job
+        '''
+        try:
+            error = future.exception()
+            if error is None:
+                self.cache.add(key, render_path)
+            else:
+                print('Map render failed: {!r}'.format(error))
+                if os.path.exists(render_path):
+                    os.remove(render_path)
+        finally:
+            with self.lock:
+                self.jobs.pop(key, None)
+
+    def status(self, key):
+        '''
+        Checks on a map requested by this or another worker
+
+        Inputs:
+            key (str): cache key of the map
+        Returns: (str) 'ready', 'pending' or 'missing'
+        '''
+        with self.lock:
+            if key in self.jobs:
+                return 'pending'
+        return self.cache.status(key)
@@ -4,4 +4,5 @@ from . import views
 
 urlpatterns = [
     path('', views.home, name='home'),
+    path('map/<str:key>', views.map_view, name='map'),
 ]
@@ -3,17 +3,21 @@ import traceback
 import sys
 import csv
 import os
+import re
 
 from functools import reduce
 from operator import and_
 
 from django.shortcuts import render
+from django.http import Http404, JsonResponse
+from django.templatetags.static import static
 from django import forms
 
-from query_schools import query_results
+from query_schools import query_results, default_map, map_status
 
 NOPREF_STR = 'No preference'
 RES_DIR = os.path.join(os.path.dirname(__file__), '..', 'res')
+MAP_KEY = re.compile(r'^[0-9a-f]{64}$')
 COLUMN_NAMES = dict(
     school='School',
     community='Community',
@@ -27,12 +31,13 @@ COLUMN_NAMES = dict(
 
 def _valid_result(res):
     """Validate results returned by query_results."""
-    (HEADER, RESULTS) = [0, 1]
+    (HEADER, RESULTS, MAP) = [0, 1, 2]
     ok = (isinstance(res, list))
     ok = (isinstance(res, (tuple, list)) and
-          len(res) == 2 and
+          len(res) == 3 and
           isinstance(res[HEADER], (tuple, list)) and
-          isinstance(res[RESULTS], (tuple, list)))
+          isinstance(res[RESULTS], (tuple, list)) and
+          isinstance(res[MAP], dict))
     if not ok:
         return False
 
@@ -144,10 +149,15 @@ def home(request):
     elif not _valid_result(res):
         context['result'] = None
         context['err'] = ('Return of query_results has the wrong data type. '
-                          'Should be a tuple of length 4 with one string and '
-                          'three lists.')
+                          'Should be a tuple of length 3 with two lists and '
+                          'one dict.')
     else:
-        columns, result = res
+        columns, result, map_info = res
+        context['map_file'] = map_info['file']
+        if map_info['status'] == 'pending':
+            context['map_key'] = map_info['key']
+        elif map_info['status'] == 'busy':
+            context['map_busy'] = True
 
         # Wrap in tuple if result is not already
         if result and isinstance(result[0], str):
@@ -157,5 +167,17 @@ def home(request):
         context['num_results'] = len(result)
         context['columns'] = [COLUMN_NAMES.get(col, col) for col in columns]
 
+    if 'map_file' not in context:
+        context['map_file'] = default_map()
     context['form'] = form
     return render(request, 'index.html', context)
+
+
+def map_view(request, key):
+    """Report whether a map is ready, for the page to poll."""
+    if not MAP_KEY.match(key):
+        raise Http404('Unknown map')
+    map_info = map_status(key)
+    return JsonResponse({'status': map_info['status'],
+                         'url': static(map_info['file']),
+                         'cache': map_info['cache']})